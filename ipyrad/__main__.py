@@ -416,6 +416,9 @@ def parse_command_line():
         type=str, nargs="?", const="default",
         help="connect to ipcluster profile (default: 'default')")
 
+    parser.add_argument("--profile", action='store_true',
+        help="write time, memory and I/O used by each step to s*_profile files")
+
     parser.add_argument("--download", metavar="download", dest="download",
         type=str, nargs="*", default=None, #const="default",
         help="download fastq files by accession (e.g., SRP or SRR)")
@@ -606,7 +609,8 @@ def main():
                 force=args.force, 
                 preview=args.preview, 
                 show_cluster=1, 
-                ipyclient=ipyclient)
+                ipyclient=ipyclient,
+                profile=args.profile)
                      
         if args.results:
             showstats(parsedict)
@@ -2,8 +2,11 @@
 
 """ import assembly funcs """
 
+from . import profiler
 from . import demultiplex
 from . import rawedit
+from . import clustfile
+from . import storage
 from . import cluster_within
 from . import jointestimate
 from . import consens_se
@@ -0,0 +1,93 @@
+#!/usr/bin/env python2.7
+
+"""
+Long-lived helper process that runs muscle alignments for an engine. It is
+started as a script, not imported with ipyrad, so that it stays small and
+forking muscle from it is cheap. Batches of fasta strings, each followed
+by the sizes of its groups of fastas that run together, are read from
+stdin and the alignments are written to stdout, all as length-prefixed
+binary frames, so nothing passes through a shell.
+
+usage: python aligner.py <muscle binary> <max concurrent muscle processes>
+"""
+
+import sys
+import struct
+import subprocess
+
+
+
+def read_frame(instream):
+    """ read a list of strings, or None if the stream was closed """
+    header = instream.read(4)
+    if len(header) < 4:
+        return None
+    nitems = struct.unpack("<I", header)[0]
+    items = []
+    for _ in xrange(nitems):
+        size = struct.unpack("<I", instream.read(4))[0]
+        items.append(instream.read(size))
+    return items
+
+
+
+def write_frame(outstream, items):
+    """ write a list of strings """
+    outstream.write(struct.pack("<I", len(items)))
+    for item in items:
+        outstream.write(struct.pack("<I", len(item)))
+        outstream.write(item)
+    outstream.flush()
+
+
+
+def align(muscle, fastas, sizes, nprocs):
+    """
+    align each fasta with its own muscle process. The fastas come in 
+    consecutive groups of the given sizes (e.g., the read1s and read2s of 
+    a pair), and all fastas of a group run at the same time, together with
+    as many more whole groups as fit in nprocs processes. muscle reads all
+    of its input before writing anything, so inputs are all written before
+    outputs are read.
+    """
+    aligned = []
+    idx = 0
+    gidx = 0
+    while gidx < len(sizes):
+        nrun = sizes[gidx]
+        gidx += 1
+        while (gidx < len(sizes)) and (nrun + sizes[gidx] <= nprocs):
+            nrun += sizes[gidx]
+            gidx += 1
+        procs = []
+        for fasta in fastas[idx:idx+nrun]:
+            proc = subprocess.Popen([muscle, "-quiet", "-in", "-"],
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+            proc.stdin.write(fasta+"\n")
+            proc.stdin.close()
+            procs.append(proc)
+        idx += nrun
+        for proc in procs:
+            aligned.append(proc.stdout.read())
+            proc.stdout.close()
+            proc.wait()
+    return aligned
+
+
+
+def main():
+    """ serve batches until stdin is closed """
+    muscle = sys.argv[1]
+    nprocs = int(sys.argv[2])
+    while 1:
+        fastas = read_frame(sys.stdin)
+        if fastas is None:
+            break
+        sizes = [int(i) for i in read_frame(sys.stdin)]
+        write_frame(sys.stdout, align(muscle, fastas, sizes, nprocs))
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python2.7
+
+"""
+Blocked gzip (BGZF) output with a tabix index, as written by bgzip and
+tabix from htslib. A BGZF file is a series of gzip members of at most 64Kb
+each, so it is readable by gzip/zcat, and a record can be located by a
+virtual offset (compressed offset of its block << 16 | offset within the
+uncompressed block). The .tbi index maps each CHROM and POS range of a
+sorted VCF to the virtual offsets of its records.
+"""
+
+from __future__ import print_function
+# pylint: disable=E1101
+
+import zlib
+import struct
+
+from ipyrad.assemble.util import IPyradError
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+
+
+class BgzfWriter(object):
+    """
+    Writes text to a BGZF file in blocks of BGZF_BLOCK uncompressed bytes.
+    tell() returns the virtual offset of the next byte written.
+    """
+    def __init__(self, path, level=6):
+        self.path = path
+        self.level = level
+        self.handle = open(path, 'wb')
+        self.buffer = []
+        self.buflen = 0
+        self.offset = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def tell(self):
+        """ virtual offset of the end of the written data """
+        return (self.offset << 16) | self.buflen
+
+
+    def write(self, text):
+        """ buffer text and write out every full block """
+        self.buffer.append(text)
+        self.buflen += len(text)
+        if self.buflen >= BGZF_BLOCK:
+            data = "".join(self.buffer)
+            start = 0
+            while len(data) - start >= BGZF_BLOCK:
+                self._write_block(data[start:start + BGZF_BLOCK])
+                start += BGZF_BLOCK
+            self.buffer = [data[start:]]
+            self.buflen = len(data) - start
+
+
+    def _write_block(self, data):
+        """ compress data to a single gzip member with the BC extra field """
+        compobj = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata = compobj.compress(data) + compobj.flush()
+        block = "".join([
+            BGZF_HEADER,
+            struct.pack("<H", len(cdata) + 25),
+            cdata,
+            struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data)),
+            ])
+        self.handle.write(block)
+        self.offset += len(block)
+
+
+    def close(self):
+        """ write the buffered data and the empty EOF block """
+        if self.handle.closed:
+            return
+        if self.buflen:
+            self._write_block("".join(self.buffer))
+        self.buffer = []
+        self.buflen = 0
+        self.handle.write(BGZF_EOF)
+        self.handle.close()
+
+
+
+class TabixIndex(object):
+    """
+    Tabix index of a BGZF compressed VCF. Records must be added in file
+    order, sorted by position within each CHROM, with all records of a
+    CHROM together.
+    """
+    def __init__(self):
+        self.names = []
+        self.bins = []
+        self.linear = []
+        self.lastpos = -1
+
+
+    def add(self, chrom, beg, end, vstart, vend):
+        """
+        add a record spanning the 0-based half-open interval beg-end and
+        the virtual offsets vstart-vend of the file.
+        """
+        if not self.names or self.names[-1] != chrom:
+            if chrom in self.names:
+                raise IPyradError(UNSORTED_VCF.format(chrom))
+            self.names.append(chrom)
+            self.bins.append({})
+            self.linear.append([])
+            self.lastpos = -1
+        if beg < self.lastpos:
+            raise IPyradError(UNSORTED_VCF.format(chrom))
+        self.lastpos = beg
+        end = max(end, beg + 1)
+
+        ## merge with the last chunk of the bin if it is contiguous
+        chunks = self.bins[-1].setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == vstart:
+            chunks[-1][1] = vend
+        else:
+            chunks.append([vstart, vend])
+
+        ## first record overlapping each 16Kb window
+        linear = self.linear[-1]
+        last = (end - 1) >> TBX_LINEAR_SHIFT
+        if len(linear) <= last:
+            linear.extend([None] * (last + 1 - len(linear)))
+        for win in xrange(beg >> TBX_LINEAR_SHIFT, last + 1):
+            if linear[win] is None:
+                linear[win] = vstart
+
+
+    def write(self, path):
+        """ write the index BGZF compressed to path """
+        names = "".join([i + "\0" for i in self.names])
+        parts = [
+            "TBI\1",
+            struct.pack("<i", len(self.names)),
+            struct.pack("<6i", *TBX_VCF_CONF),
+            struct.pack("<i", len(names)),
+            names,
+            ]
+        for bins, linear in zip(self.bins, self.linear):
+            parts.append(struct.pack("<i", len(bins)))
+            for abin in sorted(bins):
+                chunks = bins[abin]
+                parts.append(struct.pack("<Ii", abin, len(chunks)))
+                for vstart, vend in chunks:
+                    parts.append(struct.pack("<QQ", vstart, vend))
+
+            ## windows without records start at the previous record
+            offsets = []
+            prev = 0
+            for voff in linear:
+                prev = prev if voff is None else voff
+                offsets.append(prev)
+            parts.append(struct.pack("<i", len(offsets)))
+            parts.append(struct.pack("<{}Q".format(len(offsets)), *offsets))
+        parts.append(struct.pack("<Q", 0))
+
+        with BgzfWriter(path) as out:
+            out.write("".join(parts))
+
+
+
+def reg2bin(beg, end):
+    """ smallest bin of the tabix/BAM binning scheme containing beg-end """
+    end -= 1
+    for shift, offset in TBX_LEVELS:
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+
+
+### GLOBALS
+
+## uncompressed bytes per block, as in bgzip
+BGZF_BLOCK = 0xff00
+
+## gzip header with the BC extra subfield, up to the block size
+BGZF_HEADER = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+
+## the empty block that ends a BGZF file
+BGZF_EOF = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"\
+           "\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+## format (VCF), CHROM, POS and END columns, meta char and lines to skip
+TBX_VCF_CONF = (2, 1, 2, 0, ord("#"), 0)
+
+## 16Kb windows of the linear index
+TBX_LINEAR_SHIFT = 14
+
+## (shift, first bin) of each level of bins, smallest first
+TBX_LEVELS = [(14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)]
+
+UNSORTED_VCF = """\
+    VCF records of {} are not sorted together by position, cannot index.
+    """
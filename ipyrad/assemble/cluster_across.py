@@ -29,6 +29,8 @@ import numpy as np
 import dask.array as da
 import ipyrad
 from ipyrad.assemble.util import IPyradWarningExit, progressbar, clustdealer, fullcomp
+from ipyrad.assemble.profiler import profiled
+from ipyrad.assemble.storage import chunk_loci, create_dataset
 #from ipyrad.assemble.cluster_within import muscle_call, parsemuscle
 
 try:
@@ -313,7 +315,8 @@ def multi_muscle_align(data, samples, ipyclient):
     jobs = {}
     for idx in xrange(len(clustbits)):
         args = [data, samples, clustbits[idx]]
-        jobs[idx] = lbview.apply(persistent_popen_align3, *args)
+        jobs[idx] = lbview.apply(
+            profiled(data, persistent_popen_align3, "aligning clusters"), *args)
     allwait = len(jobs)
     elapsed = datetime.timedelta(seconds=int(time.time()-start))
     progressbar(20, 0, printstr.format(elapsed), spacer=data._spacer)
@@ -400,12 +403,9 @@ def build_indels(data, samples, ipyclient):
 
     ## prepare for next substep by removing the singlecat result files if 
     ## they exist. 
-    snames = [i.name for i in samples]
-    snames.sort()
-    smpios = [os.path.join(data.dirs.across, i+'.tmp.h5') for i in snames]
-    for smpio in smpios:
-        if os.path.exists(smpio):
-            os.remove(smpio)
+    catgdir = os.path.join(data.dirs.across, data.name+"-catgs")
+    if os.path.exists(catgdir):
+        shutil.rmtree(catgdir)
 
 
 
@@ -644,7 +644,8 @@ def build_h5_array(data, samples, nloci):
     Sets up all of the h5 arrays that we will fill. 
     The catg array of prefiltered loci  is 4-dimensional (Big), so one big 
     array would overload memory, we need to fill it in slices. 
-    This will be done in multicat (singlecat) and fill_superseqs.
+    This will be done in multicat (singlecat) and fill_superseqs, where
+    catgs and nalleles are added as virtual datasets.
     """
 
     ## sort to ensure samples will be in alphabetical order, tho they should be.
@@ -659,56 +660,33 @@ def build_h5_array(data, samples, nloci):
     data.clust_database = os.path.join(data.dirs.across, data.name+".clust.hdf5")
     io5 = h5py.File(data.clust_database, 'w')
 
-    ## chunk to approximately 2 chunks per core
-    chunks = ((nloci // (data.cpus*2)) + (nloci % (data.cpus*2)))
-
-    ## Number of elements in hdf5 chunk may not exceed 500MB
-    ## This is probably not actually optimal, to have such
-    ## enormous chunk sizes, could probably explore efficiency
-    ## of smaller chunk sizes on very very large datasets
-    chunklen = chunks * len(samples) * maxlen * 4
-    while chunklen > int(500e6):
-        chunks = (chunks // 2) + (chunks % 2)
-        chunklen = chunks * len(samples) * maxlen * 4
+    ## chunk to approximately 2 chunks per core unless set by the user. All
+    ## datasets are chunked by blocks of this many loci, which is also the 
+    ## size of the slices read in step 7.
+    chunks = chunk_loci(data, len(samples), maxlen, nloci)
+    compression = data._hackersonly["database_compression"]
     LOGGER.info("chunks in build_h5_array: %s", chunks)
 
     data.chunks = chunks
     LOGGER.info("nloci is %s", nloci)
     LOGGER.info("chunks is %s", data.chunks)
 
-    ## INIT FULL CATG ARRAY
-    ## store catgs with a .10 loci chunk size
-    supercatg = io5.create_dataset("catgs", (nloci, len(samples), maxlen, 4),
-                                    dtype=np.uint32,
-                                    chunks=(chunks, 1, maxlen, 4),
-                                    compression="gzip")
-    superseqs = io5.create_dataset("seqs", (nloci, len(samples), maxlen),
-                                    dtype="|S1",
-                                    #dtype=np.uint8,
-                                    chunks=(chunks, len(samples), maxlen),
-                                    compression='gzip')
-    superalls = io5.create_dataset("nalleles", (nloci, len(samples)),
-                                    dtype=np.uint8,
-                                    chunks=(chunks, len(samples)),
-                                    compression="gzip")
-    superchroms = io5.create_dataset("chroms", (nloci, 3), 
-                                     dtype=np.int64, 
-                                     chunks=(chunks, 3),
-                                     compression="gzip")
+    ## catgs and nalleles are added as virtual datasets over the per-sample
+    ## files once they are written (see build_catg_database).
+    superseqs = create_dataset(io5, "seqs", (nloci, len(samples), maxlen),
+                               "|S1", chunks, compression)
+    superchroms = create_dataset(io5, "chroms", (nloci, 3), 
+                                 np.int64, chunks, compression)
 
     ## allele count storage
-    supercatg.attrs["chunksize"] = (chunks, 1, maxlen, 4)
-    supercatg.attrs["samples"] = [i.name for i in samples]
     superseqs.attrs["chunksize"] = (chunks, len(samples), maxlen)
     superseqs.attrs["samples"] = [i.name for i in samples]
-    superalls.attrs["chunksize"] = (chunks, len(samples))
-    superalls.attrs["samples"] = [i.name for i in samples]
     superchroms.attrs["chunksize"] = (chunks, len(samples))
     superchroms.attrs["samples"] = [i.name for i in samples]
 
     ## array for pair splits locations, dup and ind filters
-    io5.create_dataset("splits", (nloci, ), dtype=np.uint16)
-    io5.create_dataset("duplicates", (nloci, ), dtype=np.bool_)
+    create_dataset(io5, "splits", (nloci, ), np.uint16, chunks, compression)
+    create_dataset(io5, "duplicates", (nloci, ), np.bool_, chunks, compression)
 
     ## close the big boy
     io5.close()
@@ -812,7 +790,10 @@ def get_seeds_and_hits(uhandle, bseeds, snames):
 
 def new_multicat(data, samples, ipyclient):
     """
-    Calls 'singlecat()' for all samples to build index files.
+    Calls 'singlecat()' for all samples in parallel. Each writes the sample's
+    catg, nalleles and chroms in locus order to its own file, and the catgs
+    and nalleles arrays of the database are then virtual datasets that map
+    to these files, so no sample has to wait on another to be written.
     """
 
     ## track progress
@@ -825,22 +806,11 @@ def new_multicat(data, samples, ipyclient):
     nloci = get_nloci(data)
     build_h5_array(data, samples, nloci)
 
-    ## parallel client (reserve engine 0 for data entry), if/else here in case
-    ## user has only one engine.
-    if len(ipyclient) > 1:
-        filler = ipyclient.load_balanced_view(targets=[0])
-        smallview = ipyclient.load_balanced_view(targets=ipyclient.ids[1::2])
-    else:
-        filler = ipyclient.load_balanced_view(targets=[0])
-        smallview = ipyclient.load_balanced_view(targets=[0])                
-
-    ## First submit a sleeper job as temp_flag for cleanups
-    last_sample = 0
-    cleanups = {}
-    cleanups[last_sample] = filler.apply(time.sleep, 0.0)
+    ## parallel client
+    lbview = ipyclient.load_balanced_view()
 
     ## fill the duplicates filter array
-    async = smallview.apply(fill_dups_arr, data)
+    async = lbview.apply(fill_dups_arr, data)
     while 1:
         elapsed = datetime.timedelta(seconds=int(time.time() - start))
         progressbar(20, 0, printstr.format(elapsed), spacer=data._spacer)
@@ -850,13 +820,14 @@ def new_multicat(data, samples, ipyclient):
     if not async.successful():
         raise IPyradWarningExit(async.result())
 
-    ## Get all existing .tmp.h5 files. If files exist then assume that we are
-    ## restarting an interrupted job. We need to check for each one whether it 
-    ## has it finished being built, and whether it has been written to the 
-    ## large array yet.
+    ## Per-sample catg files that exist are from an interrupted job that is 
+    ## being restarted. Singlecat writes to a .tmp file and renames it when
+    ## it is finished, so any that exist are complete. 
     snames = [i.name for i in samples]
     snames.sort()
-    smpios = {i:os.path.join(data.dirs.across, i+'.tmp.h5') for i in snames}
+    catgdir = os.path.join(data.dirs.across, data.name+"-catgs")
+    if not os.path.exists(catgdir):
+        os.mkdir(catgdir)
 
     ## send 'singlecat()' jobs to engines
     bseeds = os.path.join(data.dirs.across, data.name+".tmparrs.h5")
@@ -864,209 +835,103 @@ def new_multicat(data, samples, ipyclient):
     for sample in samples:
         sidx = snames.index(sample.name)
         args = (data, sample, bseeds, sidx, nloci)
+        if not os.path.exists(catg_path(data, sample.name)):
+            jobs[sample.name] = lbview.apply(
+                profiled(data, singlecat, "indexing clusters", sample), *args)
 
-        ## Only build it if it doesn't already exist. Singlecat removes
-        ## unfinished files if interrupted, so .tmp.h5 should not exist
-        ## unless the file is ready to be entered. 
-        if not os.path.exists(smpios[sample.name]):
-            jobs[sample.name] = smallview.apply(singlecat, *args)
-
-    ## track progress of singlecat jobs and submit writing jobs for finished
-    ## singlecat files (.tmp.h5).
+    ## track progress of singlecat jobs
     alljobs = len(jobs)
     while 1:
-        ## check for finished jobs
-        curkeys = jobs.keys()
-        for key in curkeys:
-            async = jobs[key]
-            if async.ready():
-                if async.successful():
-                    ## submit cleanup for finished job
-                    args = (data, data.samples[key], snames.index(key))
-                    with filler.temp_flags(after=cleanups[last_sample]):
-                        cleanups[key] = filler.apply(write_to_fullarr, *args)
-                        last_sample = key
-                        del jobs[key]
-                else:
-                    if not async.successful():
-                        raise IPyradWarningExit(async.result())
-
-        ## print progress or break
+        finished = [i for i in jobs.values() if i.ready()]
         elapsed = datetime.timedelta(seconds=int(time.time() - start))
-        progressbar(alljobs, alljobs-len(jobs), printstr.format(elapsed), spacer=data._spacer)
+        progressbar(alljobs, len(finished), printstr.format(elapsed), spacer=data._spacer)
         time.sleep(0.1)
-        if not jobs:
-            break        
+        if len(finished) == alljobs:
+            break
+        if not all([i.successful() for i in finished]):
+            break
 
-    ## add the dask_chroms func for reference data
-    if 'reference' in data.paramsdict["assembly_method"]:
-        with filler.temp_flags(after=cleanups.values()):
-            cleanups['ref'] = filler.apply(dask_chroms, *(data, samples))
+    ## check for errors
+    for key in jobs:
+        if jobs[key].ready() and not jobs[key].successful():
+            err = " error in singlecat ({}) {}".format(key, jobs[key].result())
+            LOGGER.error(err)
+            raise IPyradWarningExit(err)
 
     ## ------- print breakline between indexing and writing database ---------
     print("")
 
-    ## track progress of databaseing
+    ## fill chroms from the per-sample files for reference data
     start = time.time()
     printstr = " building database     | {} | s6 |"
-    while 1:
-        finished = [i for i in cleanups.values() if i.ready()]
-        elapsed = datetime.timedelta(seconds=int(time.time() - start))
-        progressbar(len(cleanups), len(finished), printstr.format(elapsed), spacer=data._spacer)
-        time.sleep(0.1)
-        ## break if one failed, or if finished
-        if not all([i.successful() for i in finished]):
-            break
-        if len(cleanups) == len(finished):
-            break
-
-    ## check for errors
-    for job in cleanups:
-        if cleanups[job].ready():
-            if not cleanups[job].successful():
-                raise IPyradWarningExit((job, cleanups[job].result()))
-
-
-
-def multicat(data, samples, ipyclient):
-    """
-    Runs singlecat and cleanup jobs for each sample.
-    For each sample this fills its own hdf5 array with catg data & indels.
-    This is messy, could use simplifiying.
-    """
+    if 'reference' in data.paramsdict["assembly_method"]:
+        async = lbview.apply(
+            profiled(data, dask_chroms, "building database"), *(data, samples))
+        while 1:
+            elapsed = datetime.timedelta(seconds=int(time.time() - start))
+            progressbar(2, 0, printstr.format(elapsed), spacer=data._spacer)
+            time.sleep(0.1)
+            if async.ready():
+                break
+        if not async.successful():
+            raise IPyradWarningExit(async.result())
 
-    ## progress ticker
-    start = time.time()
-    printstr = " indexing clusters     | {} | s6 |"
+    ## map the per-sample files into the database
+    build_catg_database(data, samples, nloci)
     elapsed = datetime.timedelta(seconds=int(time.time() - start))
-    progressbar(20, 0, printstr.format(elapsed))
-
-    ## parallel client
-    lbview = ipyclient.load_balanced_view()
+    progressbar(2, 2, printstr.format(elapsed), spacer=data._spacer)
 
-    ## First submit a sleeper job as temp_flag for cleanups
-    last_sample = 0
-    cleanups = {}
-    cleanups[last_sample] = lbview.apply(time.sleep, 0.0)
 
-    ## get samples and names, sorted
-    snames = [i.name for i in samples]
-    snames.sort()
-
-    ## Build an array for quickly indexing consens reads from catg files.
-    ## save as a npy int binary file.
-    uhandle = os.path.join(data.dirs.across, data.name+".utemp.sort")
-    bseeds = os.path.join(data.dirs.across, data.name+".tmparrs.h5")
-
-    ## send as first async1 job
-    async1 = lbview.apply(get_seeds_and_hits, *(uhandle, bseeds, snames))
-    async2 = lbview.apply(fill_dups_arr, data)
-
-    ## progress bar for seed/hit sorting
-    while not (async1.ready() and async2.ready()):
-        elapsed = datetime.timedelta(seconds=int(time.time() - start))
-        progressbar(20, 0, printstr.format(elapsed))
-        time.sleep(0.1)
-    if not async1.successful():
-        raise IPyradWarningExit("error in get_seeds: %s", async1.exception())
-    if not async2.successful():
-        raise IPyradWarningExit("error in fill_dups: %s", async2.exception())
-
-    ## make a limited njobs view based on mem limits 
-    ## is using smallview necessary? (yes, it is for bad libraries)
-    smallview = ipyclient.load_balanced_view(targets=ipyclient.ids[::2])
-
-    ## make sure there are no old tmp.h5 files 
-    smpios = [os.path.join(data.dirs.across, sample.name+'.tmp.h5') \
-              for sample in samples]
-    for smpio in smpios:
-        if os.path.exists(smpio):
-            os.remove(smpio)
 
-    ## send 'singlecat()' jobs to engines
-    jobs = {}
-    for sample in samples:
-        sidx = snames.index(sample.name)
-        jobs[sample.name] = smallview.apply(singlecat, *(data, sample, bseeds, sidx))
+def catg_path(data, sname):
+    """ path of the per-sample catg file that the database catgs map to """
+    return os.path.join(data.dirs.across, data.name+"-catgs", sname+".catg.hdf5")
 
-    ## check for finished and submit disk-writing job when finished
-    alljobs = len(jobs)
-    while 1:
-        ## check for finished jobs
-        curkeys = jobs.keys()
-        for key in curkeys:
-            async = jobs[key]
-            if async.ready():
-                if async.successful():
-                    ## submit cleanup for finished job
-                    args = (data, data.samples[key], snames.index(key))
-                    with lbview.temp_flags(after=cleanups[last_sample]):
-                        cleanups[key] = lbview.apply(write_to_fullarr, *args)
-                    last_sample = key
-                    del jobs[key]
-                else:
-                    err = jobs[key].exception()
-                    errmsg = "singlecat error: {} {}".format(key, err)
-                    raise IPyradWarningExit(errmsg)
-        ## print progress or break
-        elapsed = datetime.timedelta(seconds=int(time.time() - start))
-        progressbar(alljobs, alljobs-len(jobs), printstr.format(elapsed))
-        time.sleep(0.1)
-        if not jobs:
-            break
 
-    ## add the dask_chroms func for reference data
-    if 'reference' in data.paramsdict["assembly_method"]:
-        with lbview.temp_flags(after=cleanups.values()):
-            cleanups['ref'] = lbview.apply(dask_chroms, *(data, samples))
 
-    ## wait for "write_to_fullarr" jobs to finish
-    print("")
-    start = time.time()
-    printstr = " building database     | {} | s6 |"
-    while 1:
-        finished = [i for i in cleanups.values() if i.ready()]
-        elapsed = datetime.timedelta(seconds=int(time.time() - start))
-        progressbar(len(cleanups), len(finished), printstr.format(elapsed))
-        time.sleep(0.1)
-        ## break if one failed, or if finished
-        if not all([i.successful() for i in finished]):
-            break
-        if len(cleanups) == len(finished):
-            break
+def build_catg_database(data, samples, nloci):
+    """
+    Creates the catgs (nloci, nsamples, maxlen, 4) and nalleles (nloci, 
+    nsamples) datasets of the database as virtual datasets over the sample
+    files written by singlecat. Source paths are stored relative to the
+    database so the project directory can be moved.
+    """
+    samples.sort(key=lambda x: x.name)
+    maxlen = data._hackersonly["max_fragment_length"] + 20
+    chunks = data.chunks
+    catlayout = h5py.VirtualLayout(shape=(nloci, len(samples), maxlen, 4), 
+                                   dtype=np.uint32)
+    alllayout = h5py.VirtualLayout(shape=(nloci, len(samples)), 
+                                   dtype=np.uint8)
+
+    for sidx, sample in enumerate(samples):
+        smpio = catg_path(data, sample.name)
+        if not os.path.exists(smpio):
+            raise IPyradWarningExit(MISSING_CATG.format(sample.name, smpio))
+        relpath = os.path.relpath(smpio, os.path.dirname(data.clust_database))
+        catlayout[:, sidx] = h5py.VirtualSource(
+            relpath, "icatg", shape=(nloci, maxlen, 4))
+        alllayout[:, sidx] = h5py.VirtualSource(
+            relpath, "inall", shape=(nloci, ))
 
-    ## check for errors
-    for job in cleanups:
-        if cleanups[job].ready():
-            if not cleanups[job].successful():
-                err = " error in write_to_fullarr ({}) {}"\
-                     .format(job, cleanups[job].result())
-                LOGGER.error(err)
-                raise IPyradWarningExit(err)
-
-    ## remove large indels array file and singlecat tmparr file
-    ifile = os.path.join(data.dirs.across, data.name+".tmp.indels.hdf5")
-    if os.path.exists(ifile):
-        os.remove(ifile)
-    if os.path.exists(bseeds):
-        os.remove(bseeds)
-    for sh5 in [os.path.join(data.dirs.across, i.name+".tmp.h5") for i in samples]:
-        os.remove(sh5)
-
-    ## print final progress
-    elapsed = datetime.timedelta(seconds=int(time.time() - start))
-    progressbar(10, 10, printstr.format(elapsed))
-    print("")
+    with h5py.File(data.clust_database, 'r+') as io5:
+        supercatg = io5.create_virtual_dataset("catgs", catlayout, fillvalue=0)
+        superalls = io5.create_virtual_dataset("nalleles", alllayout, fillvalue=0)
+        supercatg.attrs["chunksize"] = (chunks, 1, maxlen, 4)
+        supercatg.attrs["samples"] = [i.name for i in samples]
+        superalls.attrs["chunksize"] = (chunks, len(samples))
+        superalls.attrs["samples"] = [i.name for i in samples]
 
 
 
 ## This is where indels are imputed
 def singlecat(data, sample, bseeds, sidx, nloci):
     """
-    Orders catg data for each sample into the final locus order. This allows
-    all of the individual catgs to simply be combined later. They are also in
-    the same order as the indels array, so indels are inserted from the indel
-    array that is passed in.
+    Orders catg data for each sample into the final locus order and inserts
+    indels from the indel array, then writes it to the sample's catg file. 
+    The sample's catg is read in blocks and scattered into a disk-backed 
+    array in locus order, which is then written out in database chunks, so
+    neither the input nor the output is held in memory whole.
     """
 
     LOGGER.info("in single cat here")
@@ -1078,99 +943,68 @@ def singlecat(data, sample, bseeds, sidx, nloci):
         ## get hits just for this sample and sort them by sample order index
         hits = io5["uarr"][:]
         hits = hits[hits[:, 1] == sidx, :]
-        #hits = hits[hits[:, 2].argsort()]
         ## get seeds just for this sample and sort them by sample order index
         seeds = io5["seedsarr"][:]
         seeds = seeds[seeds[:, 1] == sidx, :]
-        #seeds = seeds[seeds[:, 2].argsort()]
         full = np.concatenate((seeds, hits))
-        full = full[full[:, 0].argsort()]
+        ## sorted by the sample's catg index so it can be read in order
+        full = full[full[:, 2].argsort()]
 
     ## still using max+20 len limit, rare longer merged reads get trimmed
     ## we need to allow room for indels to be added too
     maxlen = data._hackersonly["max_fragment_length"] + 20
+    chunks = data.chunks
 
-    ## we'll fill a new catg and alleles arr for this sample in locus order,
-    ## which is known from seeds and hits
-    ocatg = np.zeros((nloci, maxlen, 4), dtype=np.uint32)
-    onall = np.zeros(nloci, dtype=np.uint8)
-    ochrom = np.zeros((nloci, 3), dtype=np.int64)
-    
     ## grab the sample's data and write to ocatg and onall
     if not sample.files.database:
         raise IPyradWarningExit("missing catg file - {}".format(sample.name))
 
-    with h5py.File(sample.files.database, 'r') as io5:
-        ## get it and delete it
-        catarr = io5["catg"][:]
-        tmp = catarr[full[:, 2], :maxlen, :]
-        del catarr
-        ocatg[full[:, 0], :tmp.shape[1], :] = tmp
-        del tmp
-
-        ## get it and delete it
-        nall = io5["nalleles"][:]
-        onall[full[:, 0]] = nall[full[:, 2]]
-        del nall
-
-        ## fill the reference data
-        if isref:
-            chrom = io5["chroms"][:]
-            ochrom[full[:, 0]] = chrom[full[:, 2]]
-            del chrom
+    ## a sparse disk-backed catg for this sample in locus order
+    smpio = catg_path(data, sample.name)
+    scatter = smpio + ".tmp.scatter"
+    ocatg = np.memmap(scatter, dtype=np.uint32, mode="w+", shape=(nloci, maxlen, 4))
+    onall = np.zeros(nloci, dtype=np.uint8)
+    ochrom = np.zeros((nloci, 3), dtype=np.int64)
 
-    ## get indel locations for this sample
+    with h5py.File(sample.files.database, 'r') as io5:
+        catg = io5["catg"]
+        block = catg.chunks[0] if catg.chunks else chunks
+        for cidx in xrange(0, catg.shape[0], block):
+            end = cidx + block
+            lo, hi = np.searchsorted(full[:, 2], [cidx, end])
+            if lo == hi:
+                continue
+            rows = full[lo:hi]
+            tmp = catg[cidx:end, :maxlen, :]
+            ocatg[rows[:, 0], :tmp.shape[1], :] = tmp[rows[:, 2] - cidx]
+            onall[rows[:, 0]] = io5["nalleles"][cidx:end][rows[:, 2] - cidx]
+            ## fill the reference data
+            if isref:
+                ochrom[rows[:, 0]] = io5["chroms"][cidx:end][rows[:, 2] - cidx]
+            del tmp
+
+    ## insert indels and write the sample's file one database chunk at a time
     ipath = os.path.join(data.dirs.across, data.name+".tmp.indels.hdf5")
-    with h5py.File(ipath, 'r') as ih5:
-        indels = ih5["indels"][sidx, :, :maxlen]
-
-    ## insert indels into ocatg
-    newcatg = inserted_indels(indels, ocatg)
-    del ocatg, indels
-    
-    ## save individual tmp h5 data
-    smpio = os.path.join(data.dirs.across, sample.name+'.tmp.h5')
-    with h5py.File(smpio, 'w') as oh5:
-        oh5.create_dataset("icatg", data=newcatg, dtype=np.uint32)
-        oh5.create_dataset("inall", data=onall, dtype=np.uint8)
+    compression = data._hackersonly["database_compression"]
+    with h5py.File(ipath, 'r') as ih5, h5py.File(smpio+".tmp", 'w') as oh5:
+        icatg = create_dataset(oh5, "icatg", (nloci, maxlen, 4), 
+                               np.uint32, chunks, compression)
+        inall = create_dataset(oh5, "inall", (nloci, ), 
+                               np.uint8, chunks, compression)
+        inall[:] = onall
         if isref:
-            oh5.create_dataset("ichrom", data=ochrom, dtype=np.int64)
-
-
+            ichrom = create_dataset(oh5, "ichrom", (nloci, 3), 
+                                    np.int64, chunks, compression)
+            ichrom[:] = ochrom
+        for cidx in xrange(0, nloci, chunks):
+            end = min(cidx + chunks, nloci)
+            indels = ih5["indels"][sidx, cidx:end, :maxlen]
+            icatg[cidx:end] = inserted_indels(indels, np.array(ocatg[cidx:end]))
 
-## This func could potentially be replaced entirely by making 
-## a dask array made up concatenating all of the individual 
-## .tmp.h5 arrays. Reading from that might be a bit slower, tho.
-## Something to consider since it would be parallel, while this 
-## step is not. If this step proves to be too slow in uber
-## big assemblies then we should try the other approach.
-def write_to_fullarr(data, sample, sidx):
-    """ writes arrays to h5 disk """
-
-    ## enter ref data?
-    #isref = 'reference' in data.paramsdict["assembly_method"]
-    LOGGER.info("writing fullarr %s %s", sample.name, sidx)
-
-    ## save big arrays to disk temporarily
-    with h5py.File(data.clust_database, 'r+') as io5:
-        ## open views into the arrays we plan to fill
-        chunk = io5["catgs"].attrs["chunksize"][0]
-        catg = io5["catgs"]
-        nall = io5["nalleles"]
-
-        ## adding an axis to newcatg makes it write about 1000X faster.
-        smpio = os.path.join(data.dirs.across, sample.name+'.tmp.h5')
-        with h5py.File(smpio) as indat:
-
-            ## grab all of the data from this sample's arrays
-            newcatg = indat["icatg"] #[:]
-            onall = indat["inall"]   #[:]
-
-            ## enter it into the full array one chunk at a time
-            for cidx in xrange(0, catg.shape[0], chunk):
-                end = cidx + chunk
-                catg[cidx:end, sidx:sidx+1, :] = np.expand_dims(newcatg[cidx:end, :], axis=1)
-                nall[:, sidx:sidx+1] = np.expand_dims(onall, axis=1)
+    ## the finished file marks this sample as done for restarts
+    del ocatg
+    os.remove(scatter)
+    os.rename(smpio+".tmp", smpio)
 
 
 
@@ -1180,8 +1014,8 @@ def dask_chroms(data, samples):
     """
     
     ## example concatenating with dask
-    h5s = [os.path.join(data.dirs.across, s.name+".tmp.h5") for s in samples]
-    handles = [h5py.File(i) for i in h5s]
+    h5s = [catg_path(data, s.name) for s in samples]
+    handles = [h5py.File(i, 'r') for i in h5s]
     dsets = [i['/ichrom'] for i in handles]
     arrays = [da.from_array(dset, chunks=(10000, 3)) for dset in dsets]
     stack = da.stack(arrays, axis=2)
@@ -1653,6 +1487,9 @@ def clean_and_build_concat(data, samples, randomseed, ipyclient):
         os.remove(catclust)
     if os.path.exists(data.clust_database):
         os.remove(data.clust_database)
+    catgdir = os.path.join(data.dirs.across, data.name+"-catgs")
+    if os.path.exists(catgdir):
+        shutil.rmtree(catgdir)
 
     ## get parallel view
     start = time.time()
@@ -1832,11 +1669,18 @@ def cleanup_tempfiles(data):
         if os.path.exists(rfile):
             os.remove(rfile)
 
-    ## remove singlecat related h5 files
-    smpios = glob.glob(os.path.join(data.dirs.across, '*.tmp.h5'))
+    ## remove unfinished singlecat files. The finished ones are kept since
+    ## the catgs of the database map to them.
+    smpios = glob.glob(os.path.join(data.dirs.across, data.name+"-catgs", "*.tmp*"))
     for smpio in smpios:
         if os.path.exists(smpio):
             os.remove(smpio)
 
 
 
+### GLOBALS
+
+MISSING_CATG = """\
+    Missing the catg file of sample {} at {}. 
+    Re-run step 6 with the force flag.
+    """
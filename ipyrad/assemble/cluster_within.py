@@ -17,8 +17,10 @@ from __future__ import print_function
 
 import os
 import io
+import sys
 import gzip
 import glob
+import socket
 import itertools
 
 import numpy as np
@@ -31,6 +33,10 @@ import ipyparallel as ipp
 
 from refmap import *
 from util import *
+from clustfile import ClustFile, ClustWriter, clustbin_path, clustgaps_path, \
+                      current_clustbin, cluster_text, CLUSTBLOCK, GAPS_UNKNOWN
+from aligner import read_frame, write_frame
+from profiler import profiled
 
 ## Python3 subprocess is faster for muscle-align
 try:
@@ -57,8 +63,14 @@ def get_quick_depths(data, sample):
         sample.files.clusters = os.path.join(
             data.dirs.clusts, sample.name+".clustS.gz")
 
-    ## get new clustered loci
+    ## get new clustered loci, from the binary container if there is one. 
+    ## The text parser below counts the newline in the seq length, so +1 
+    ## keeps maxlen the same.
     fclust = data.samples[sample.name].files.clusters
+    if current_clustbin(fclust):
+        with ClustFile(current_clustbin(fclust)) as clusts:
+            return clusts.widths() + 1, clusts.depths()
+
     clusters = gzip.open(fclust, 'r')
     pairdealer = itertools.izip(*[iter(clusters)]*2)
 
@@ -181,8 +193,11 @@ def sample_cleanup(data, sample):
         usort = os.path.join(data.dirs.clusts, sample.name+".utemp.sort")
         hhandle = os.path.join(data.dirs.clusts, sample.name+".htemp")
         clusters = os.path.join(data.dirs.clusts, sample.name+".clust.gz")
+        clustbin = clustbin_path(clusters)
+        clustgaps = clustgaps_path(clusters)
 
-        for f in [derepfile, mergefile, uhandle, usort, hhandle, clusters]:
+        for f in [derepfile, mergefile, uhandle, usort, hhandle, clusters, 
+                  clustbin, clustgaps]:
             try:
                 os.remove(f)
             except:
@@ -190,155 +205,232 @@ def sample_cleanup(data, sample):
 
 
 
-## winner, rigorously testing in sequential and parallel against other funcs
-def persistent_popen_align3(clusts, maxseqs=200, is_gbs=False):
-    """ keeps a persistent bash shell open and feeds it muscle alignments """
+class MuscleAligner(object):
+    """
+    Keeps an aligner.py helper process open for the life of an align job
+    and sends it batches of fasta strings to align with muscle. Forking 
+    muscle from the small helper is much cheaper than from an engine, and 
+    up to nprocs alignments run at the same time. The fastas of a group 
+    (e.g., the read1s and read2s of a pair) always run together.
+    """
+    def __init__(self, nprocs=1):
+        self.proc = sps.Popen([sys.executable, ALIGNER, ipyrad.bins.muscle, 
+                               str(nprocs)],
+                              stdin=sps.PIPE,
+                              stdout=sps.PIPE,
+                              close_fds=True)
+
+
+    def align(self, fastas, sizes=None):
+        """ 
+        return the aligned fasta string for each fasta string. sizes are 
+        the lengths of the consecutive groups of fastas, one each if None.
+        """
+        if sizes is None:
+            sizes = [1] * len(fastas)
+        write_frame(self.proc.stdin, fastas)
+        write_frame(self.proc.stdin, [str(i) for i in sizes])
+        aligned = read_frame(self.proc.stdout)
+        if aligned is None:
+            raise IPyradError("aligner process exited unexpectedly")
+        return aligned
+
+
+    def close(self):
+        """ close the helper process """
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.wait()
+
+
+
+def muscle_align_clusters(clusts, maxseqs=200, is_gbs=False, ungapped=None):
+    """ 
+    aligns clusters with muscle in batches sent to a persistent aligner 
+    process. Replaces feeding echo|muscle commands to a bash shell. Clusters
+    flagged in ungapped are already aligned and are only formatted.
+    """
+    if ungapped is None:
+        ungapped = [False] * len(clusts)
+    aligner = MuscleAligner(ALIGN_PROCS)
+    aligned = []
+    try:
+        for idx in xrange(0, len(clusts), ALIGN_BATCH):
+            aligned.extend(align_batch(
+                aligner, 
+                clusts[idx:idx+ALIGN_BATCH], 
+                ungapped[idx:idx+ALIGN_BATCH], 
+                maxseqs, is_gbs))
+    finally:
+        aligner.close()
 
-    ## create a separate shell for running muscle in, this is much faster
-    ## than spawning a separate subprocess for each muscle call
-    proc = sps.Popen(["bash"], 
-                     stdin=sps.PIPE, 
-                     stdout=sps.PIPE, 
-                     universal_newlines=True)
+    ## return the aligned clusters
+    return aligned
 
-    ## iterate over clusters in this file until finished
-    aligned = []
-    for clust in clusts:
 
-        ## new alignment string for read1s and read2s
-        align1 = ""
-        align2 = ""
 
-        ## don't bother aligning if only one seq
+def align_batch(aligner, clusts, ungapped, maxseqs, is_gbs):
+    """ aligns a batch of clusters with a single call to the aligner """
+
+    ## get the muscle inputs for each cluster, none if there is only one seq
+    ## or it is ungapped, read1s and read2s if the cluster can be split at a 
+    ## PE insert, and otherwise the whole seqs.
+    jobs = []
+    for clust, flag in zip(clusts, ungapped):
         if clust.count(">") == 1:
-            aligned.append(clust.replace(">", "").strip())
-        else:
+            jobs.append([])
+            continue
+        if flag:
+            jobs.append(None)
+            continue
 
-            ## do we need to split the alignment? (is there a PE insert?)
-            try:
-                ## make into list (only read maxseqs lines, 2X cuz names)
-                lclust = clust.split()[:maxseqs*2]
-
-                ## try to split cluster list at nnnn separator for each read
-                lclust1 = list(itertools.chain(*zip(\
-                     lclust[::2], [i.split("nnnn")[0] for i in lclust[1::2]])))
-                lclust2 = list(itertools.chain(*zip(\
-                     lclust[::2], [i.split("nnnn")[1] for i in lclust[1::2]])))
-
-                ## put back into strings
-                clust1 = "\n".join(lclust1)
-                clust2 = "\n".join(lclust2)
-
-                ## Align the first reads.
-                ## The muscle command with alignment as stdin and // as splitter
-                cmd1 = "echo -e '{}' | {} -quiet -in - ; echo {}"\
-                        .format(clust1, ipyrad.bins.muscle, "//")
-
-                ## send cmd1 to the bash shell
-                print(cmd1, file=proc.stdin)
-
-                ## read the stdout by line until splitter is reached
-                ## meaning that the alignment is finished.
-                for line in iter(proc.stdout.readline, '//\n'):
-                    align1 += line
-
-                ## Align the second reads.
-                ## The muscle command with alignment as stdin and // as splitter
-                cmd2 = "echo -e '{}' | {} -quiet -in - ; echo {}"\
-                        .format(clust2, ipyrad.bins.muscle, "//")
-
-                ## send cmd2 to the bash shell
-                print(cmd2, file=proc.stdin)
-
-                ## read the stdout by line until splitter is reached
-                ## meaning that the alignment is finished.
-                for line in iter(proc.stdout.readline, '//\n'):
-                    align2 += line
-
-                ## join up aligned read1 and read2 and ensure names order matches
-                la1 = align1[1:].split("\n>")
-                la2 = align2[1:].split("\n>")
-                dalign1 = dict([i.split("\n", 1) for i in la1])
-                dalign2 = dict([i.split("\n", 1) for i in la2])
-                align1 = []
-                try:
-                    keys = sorted(dalign1.keys(), key=DEREP, reverse=True)
-                except ValueError as inst:
-                    ## Lines is empty. This means the call to muscle alignment failed.
-                    ## Not sure how to handle this, but it happens only very rarely.
-                    LOGGER.error("Muscle alignment failed: Bad clust - {}\nBad lines - {}"\
-                                .format(clust, lines))
-                    continue
+        ## make into list (only read maxseqs lines, 2X cuz names)
+        lclust = clust.split()[:maxseqs*2]
+        try:
+            ## try to split cluster list at nnnn separator for each read
+            lclust1, lclust2 = split_pairs(lclust)
+            jobs.append(["\n".join(lclust1), "\n".join(lclust2)])
 
-                ## put seed at top of alignment
-                seed = [i for i in keys if i.split(";")[-1][0]=="*"][0]
-                keys.pop(keys.index(seed))
-                keys = [seed] + keys
-                for key in keys:
-                    align1.append("\n".join([key, 
-                                    dalign1[key].replace("\n", "")+"nnnn"+\
-                                    dalign2[key].replace("\n", "")]))
+        ## Either reads are SE, or at least some pairs are merged.
+        except IndexError:
+            jobs.append(["\n".join(lclust)])
 
-                ## append aligned cluster string
-                aligned.append("\n".join(align1).strip())
+    ## align all of them, the read1s and read2s of a pair together
+    results = iter(aligner.align(
+        list(itertools.chain(*[i for i in jobs if i])),
+        [len(i) for i in jobs if i]))
+
+    ## parse results in order
+    aligned = []
+    for clust, job in zip(clusts, jobs):
+        ## don't bother aligning if only one seq
+        if job == []:
+            aligned.append(clust.replace(">", "").strip())
+            continue
 
-            ## Malformed clust. Dictionary creation with only 1 element will raise.
-            except ValueError as inst:
-                LOGGER.debug("Bad PE cluster - {}\nla1 - {}\nla2 - {}".format(\
-                                clust, la1, la2))
+        ## already aligned, only format it the same as muscle results
+        if job is None:
+            clust1 = parse_ungapped(clust, maxseqs, is_gbs)
 
-            ## Either reads are SE, or at least some pairs are merged.
+        ## join up aligned read1 and read2. A pair that fails here is 
+        ## realigned as single-end.
+        elif len(job) == 2:
+            align1 = next(results)
+            align2 = next(results)
+            try:
+                clust1 = parse_pe_alignment(clust, align1, align2)
             except IndexError:
-                    
-                ## limit the number of input seqs
                 lclust = "\n".join(clust.split()[:maxseqs*2])
+                clust1 = parse_se_alignment(
+                    clust, aligner.align([lclust])[0], is_gbs)
+        else:
+            clust1 = parse_se_alignment(clust, next(results), is_gbs)
 
-                ## the muscle command with alignment as stdin and // as splitter
-                cmd = "echo -e '{}' | {} -quiet -in - ; echo {}"\
-                            .format(lclust, ipyrad.bins.muscle, "//")
+        if clust1:
+            aligned.append(clust1)
+    return aligned
 
-                ## send cmd to the bash shell (TODO: PIPE could overflow here!)
-                print(cmd, file=proc.stdin)
 
-                ## read the stdout by line until // is reached. This BLOCKS.
-                for line in iter(proc.stdout.readline, '//\n'):
-                    align1 += line
 
-                ## remove '>' from names, and '\n' from inside long seqs                
-                lines = align1[1:].split("\n>")
+def parse_ungapped(clust, maxseqs, is_gbs):
+    """ 
+    formats a cluster that needs no alignment the same way as the muscle 
+    results are formatted, with only maxseqs seqs and the seed on top. 
+    """
+    lclust = clust.split()[:maxseqs*2]
+    try:
+        lclust1, lclust2 = split_pairs(lclust)
+        return parse_pe_alignment(clust, "\n".join(lclust1), "\n".join(lclust2))
+    except IndexError:
+        return parse_se_alignment(clust, "\n".join(lclust), is_gbs)
 
-                try:
-                    ## find seed of the cluster and put it on top.
-                    seed = [i for i in lines if i.split(";")[-1][0]=="*"][0]
-                    lines.pop(lines.index(seed))
-                    lines = [seed] + sorted(lines, key=DEREP, reverse=True)
-                except ValueError as inst:
-                    ## Lines is empty. This means the call to muscle alignment failed.
-                    ## Not sure how to handle this, but it happens only very rarely.
-                    LOGGER.error("Muscle alignment failed: Bad clust - {}\nBad lines - {}"\
-                                .format(clust, lines))
-                    continue
 
-                ## format remove extra newlines from muscle
-                aa = [i.split("\n", 1) for i in lines]
-                align1 = [i[0]+'\n'+"".join([j.replace("\n", "") for j in i[1:]]) for i in aa]
-                
-                ## trim edges in sloppy gbs/ezrad data. Maybe relevant to other types too...
-                if is_gbs:
-                    align1 = gbs_trim(align1)
-
-                ## append to aligned
-                aligned.append("\n".join(align1).strip())
-               
-    # cleanup
-    proc.stdout.close()
-    if proc.stderr:
-        proc.stderr.close()
-    proc.stdin.close()
-    proc.wait()
 
-    ## return the aligned clusters
-    return aligned   
+def split_pairs(lclust):
+    """ 
+    splits a cluster list of names and seqs into lists for read1 and read2 
+    at the nnnn separator. Raises IndexError if any seq is not a pair.
+    """
+    lclust1 = list(itertools.chain(*zip(\
+         lclust[::2], [i.split("nnnn")[0] for i in lclust[1::2]])))
+    lclust2 = list(itertools.chain(*zip(\
+         lclust[::2], [i.split("nnnn")[1] for i in lclust[1::2]])))
+    return lclust1, lclust2
+
+
+
+def parse_pe_alignment(clust, align1, align2):
+    """ 
+    joins aligned read1s and read2s with the seed on top, or returns None 
+    if the alignment failed.
+    """
+    try:
+        ## join up aligned read1 and read2 and ensure names order matches
+        la1 = align1[1:].split("\n>")
+        la2 = align2[1:].split("\n>")
+        dalign1 = dict([i.split("\n", 1) for i in la1])
+        dalign2 = dict([i.split("\n", 1) for i in la2])
+        align1 = []
+        try:
+            keys = sorted(dalign1.keys(), key=DEREP, reverse=True)
+        except ValueError as inst:
+            ## Lines is empty. This means the call to muscle alignment failed.
+            ## Not sure how to handle this, but it happens only very rarely.
+            LOGGER.error("Muscle alignment failed: Bad clust - {}\nBad lines - {}"\
+                        .format(clust, la1))
+            return None
+
+        ## put seed at top of alignment
+        seed = [i for i in keys if i.split(";")[-1][0]=="*"][0]
+        keys.pop(keys.index(seed))
+        keys = [seed] + keys
+        for key in keys:
+            align1.append("\n".join([key, 
+                            dalign1[key].replace("\n", "")+"nnnn"+\
+                            dalign2[key].replace("\n", "")]))
+
+        ## return aligned cluster string
+        return "\n".join(align1).strip()
+
+    ## Malformed clust. Dictionary creation with only 1 element will raise.
+    except ValueError as inst:
+        LOGGER.debug("Bad PE cluster - {}\nla1 - {}\nla2 - {}".format(\
+                        clust, align1, align2))
+        return None
+
+
+
+def parse_se_alignment(clust, align1, is_gbs):
+    """ 
+    formats an aligned cluster with the seed on top, or returns None if the 
+    alignment failed.
+    """
+    ## remove '>' from names, and '\n' from inside long seqs                
+    lines = align1[1:].split("\n>")
+
+    try:
+        ## find seed of the cluster and put it on top.
+        seed = [i for i in lines if i.split(";")[-1][0]=="*"][0]
+        lines.pop(lines.index(seed))
+        lines = [seed] + sorted(lines, key=DEREP, reverse=True)
+    except ValueError as inst:
+        ## Lines is empty. This means the call to muscle alignment failed.
+        ## Not sure how to handle this, but it happens only very rarely.
+        LOGGER.error("Muscle alignment failed: Bad clust - {}\nBad lines - {}"\
+                    .format(clust, lines))
+        return None
+
+    ## format remove extra newlines from muscle
+    aa = [i.split("\n", 1) for i in lines]
+    align1 = [i[0]+'\n'+"".join([j.replace("\n", "") for j in i[1:]]) for i in aa]
+    
+    ## trim edges in sloppy gbs/ezrad data. Maybe relevant to other types too...
+    if is_gbs:
+        align1 = gbs_trim(align1)
+
+    ## return aligned cluster string
+    return "\n".join(align1).strip()
+
 
 
 def gbs_trim(align1):
@@ -393,30 +485,39 @@ DEREP = lambda x: int(x.split("=")[-1].split(";")[0])
 
 
 ## max-internal-indels could be modified if we add it to hackerz dict.
-def align_and_parse(handle, max_internal_indels=5, is_gbs=False):
-    """ much faster implementation for aligning chunks """
+def align_and_parse(clustfile, chunk, outhandle, max_internal_indels=5, is_gbs=False):
+    """ 
+    much faster implementation for aligning chunks. Reads its chunk of 
+    clusters by index from the unaligned cluster container and writes the
+    aligned clusters to a container at outhandle. Clusters in which vsearch
+    found no gaps are not sent to muscle. Returns the number of clusters
+    filtered for indels and the number that bypassed muscle.
+    """
 
-    ## data are already chunked, read in the whole thing. bail if no data.
+    ## read in the whole chunk. bail if no data.
     try:
-        with open(handle, 'rb') as infile:
-            clusts = infile.read().split("//\n//\n")
-            ## remove any empty spots
-            clusts = [i for i in clusts if i]
+        with ClustFile(clustfile) as infile:
+            start, stop = align_chunk_range(len(infile), chunk)
+            clusts = [cluster_text(names, seqs) for names, seqs, _ \
+                      in infile.iter_clusters(start, stop)]
+            ungapped = infile.ungapped(start, stop)
             ## Skip entirely empty chunks
             if not clusts:
                 raise IPyradError
     except (IOError, IPyradError):
-        LOGGER.debug("skipping empty chunk - {}".format(handle))
-        return 0
+        LOGGER.debug("skipping empty chunk - {} {}".format(clustfile, chunk))
+        return 0, 0
 
     ## count discarded clusters for printing to stats later
     highindels = 0
+    bypassed = sum(1 for clust, flag in zip(clusts, ungapped) \
+                   if flag and clust.count(">") > 1)
 
     ## iterate over clusters sending each to muscle, splits and aligns pairs
     try:
-        aligned = persistent_popen_align3(clusts, 200, is_gbs)
+        aligned = muscle_align_clusters(clusts, 200, is_gbs, ungapped)
     except Exception as inst:
-        LOGGER.debug("Error in handle - {} - {}".format(handle, inst))
+        LOGGER.debug("Error in handle - {} - {}".format(clustfile, inst))
         #raise IPyradWarningExit("error hrere {}".format(inst))
         aligned = []        
 
@@ -438,17 +539,28 @@ def align_and_parse(handle, max_internal_indels=5, is_gbs=False):
         else:
             highindels += 1
 
-    ## write to file after
+    ## write to a binary cluster container after
     if refined:
-        outhandle = handle.rsplit(".", 1)[0]+".aligned"
-        with open(outhandle, 'wb') as outfile:
-            outfile.write("\n//\n//\n".join(refined)+"\n")
+        with ClustWriter(outhandle) as outfile:
+            outfile.add_text(refined)
+    return highindels, bypassed
 
-    ## remove the old tmp file
-    log_level = logging.getLevelName(LOGGER.getEffectiveLevel())
-    if not log_level == "DEBUG":
-        os.remove(handle)
-    return highindels
+
+
+def align_chunk_range(nloci, chunk, nchunks=10):
+    """
+    first and last cluster of an align chunk. Chunks grow in size so that
+    the first chunk, which holds the largest clusters and takes longer to
+    align, is the smallest. The last chunk takes everything left.
+    """
+    optim = (nloci//20) + (nloci%20)
+    inc = optim // nchunks
+    start = sum([optim + (idx * inc) for idx in xrange(chunk)])
+    if chunk == nchunks - 1:
+        stop = nloci
+    else:
+        stop = start + optim + (chunk * inc)
+    return min(start, nloci), min(stop, nloci)
 
 
 
@@ -484,6 +596,15 @@ def build_clusters(data, sample, maxindels):
     which contain un-aligned clusters. Hits to seeds are only kept in the
     cluster if the number of internal indels is less than 'maxindels'.
     By default, we set maxindels=6 for this step (within-sample clustering).
+    The number of gaps vsearch reported for each seq is written alongside
+    the clusters (.gaps) so that ungapped clusters can skip muscle. vsearch
+    does not count terminal gaps, so hits that do not cover the full length
+    of both the query and the seed (qcov, tcov < 100) are GAPS_UNKNOWN.
+
+    Derep reads are not loaded into memory. Each seq needed for a cluster is
+    listed with its position in the output, and the list is joined against 
+    the derep file after both are sorted by name (see join_dereps). Sorting
+    is done by unix sort using at most _hackersonly["build_clusters_memory"].
     """
 
     ## If reference assembly then here we're clustering the unmapped reads
@@ -496,113 +617,174 @@ def build_clusters(data, sample, maxindels):
     usort = os.path.join(data.dirs.clusts, sample.name+".utemp.sort")
     hhandle = os.path.join(data.dirs.clusts, sample.name+".htemp")
 
-    ## create an output file to write clusters to
-    sample.files.clusters = os.path.join(data.dirs.clusts, sample.name+".clust.gz")
-    clustsout = gzip.open(sample.files.clusters, 'wb')
+    ## tmp files for the join
+    tmpfiles = [os.path.join(data.dirs.clusts, sample.name+i) for i in \
+                [".derep.tab", ".derep.sort", ".request", ".request.sort", 
+                 ".joined", ".joined.sort"]]
+    dereptab, derepsort, request, reqsort, joined, joinsort = tmpfiles
+    memory = data._hackersonly["build_clusters_memory"]
 
     ## Sort the uhandle file so we can read through matches efficiently
-    cmd = ["sort", "-k", "2", uhandle, "-o", usort]
-    proc = sps.Popen(cmd, close_fds=True)
-    _ = proc.communicate()[0]
-
-    ## load ALL derep reads into a dictionary (this can be a few GB of RAM)
-    ## and is larger if names are larger. We are grabbing two lines at a time.
-    alldereps = {}
-    with open(derepfile, 'rb') as ioderep:
+    external_sort(uhandle, usort, ["-k", "2"], memory, data.dirs.clusts)
+
+    ## list the seqs needed by their names and the order they are written 
+    ## in: the seed then hits of each cluster, then the seeds with no hits.
+    with open(request, 'wb') as out:
+        nlines = 0
+        with open(usort, 'rb') as insort:
+            lastseed = 0
+            for line in insort:
+                hit, seed, _, ind, ori, qcov, tcov = line.strip().split()
+                if seed != lastseed:
+                    out.write("{}\t{:012d}\ts\t+\t0\n".format(seed, 2*nlines))
+                    lastseed = seed
+                ## only save if not too many indels
+                if int(ind) <= maxindels:
+                    ## hits aligned at an offset have terminal gaps
+                    if float(qcov) < 100 or float(tcov) < 100:
+                        ind = GAPS_UNKNOWN
+                    out.write("{}\t{:012d}\th\t{}\t{}\n"\
+                              .format(hit, 2*nlines+1, ori, ind))
+                else:
+                    LOGGER.info("filtered by maxindels: %s %s", ind, hit)
+                nlines += 1
+
+        with open(hhandle, 'rb') as iotemp:
+            nohits = itertools.izip(*[iter(iotemp)]*2)
+            for nnn, _ in nohits:
+                out.write("{}\t{:012d}\tn\t+\t0\n".format(nnn.strip()[1:], 2*nlines))
+                nlines += 1
+
+    ## write derep reads as tab separated name and seq
+    with open(derepfile, 'rb') as ioderep, open(dereptab, 'wb') as out:
         dereps = itertools.izip(*[iter(ioderep)]*2)
         for namestr, seq in dereps:
-            nnn, sss = [i.strip() for i in namestr, seq]
-            alldereps[nnn[1:]] = sss
+            out.write("{}\t{}\n".format(namestr.strip()[1:], seq.strip()))
 
-    ## store observed seeds (this could count up to >million in bad data sets)
-    seedsseen = set()
+    ## join seqs to the requests by name, then put them back in order
+    external_sort(dereptab, derepsort, ["-t", "\t", "-k", "1,1"], 
+                  memory, data.dirs.clusts)
+    external_sort(request, reqsort, ["-t", "\t", "-k", "1,1"], 
+                  memory, data.dirs.clusts)
+    join_dereps(derepsort, reqsort, joined)
+    external_sort(joined, joinsort, ["-t", "\t", "-k", "1,1"], 
+                  memory, data.dirs.clusts)
 
-    ## Iterate through the usort file grabbing matches to build clusters
-    with open(usort, 'rb') as insort:
-        ## iterator, seed null, seqlist null
-        isort = iter(insort)
-        lastseed = 0
+    ## create an output file to write clusters to
+    sample.files.clusters = os.path.join(data.dirs.clusts, sample.name+".clust.gz")
+    clustsout = gzip.open(sample.files.clusters, 'wb')
+    gapsout = open(clustgaps_path(sample.files.clusters), 'wb')
+
+    ## Iterate through the joined seqs in order building clusters
+    with open(joinsort, 'rb') as injoin:
         fseqs = []
+        fgaps = []
         seqlist = []
-        seqsize = 0
-        while 1:
-            ## grab the next line
-            try:
-                hit, seed, _, ind, ori, _ = isort.next().strip().split()
-            except StopIteration:
-                break
-
-            ## same seed, append match
-            if seed != lastseed:
-                seedsseen.add(seed)
-                ## store the last cluster (fseq), count it, and clear fseq
-                if fseqs:
-                    ## sort fseqs by derep after pulling out the seed
-                    fseqs = [fseqs[0]] + sorted(fseqs[1:], key=lambda x: \
-                        int(x.split(";size=")[1].split(";")[0]), reverse=True)                    
-                    seqlist.append("\n".join(fseqs))
-                    seqsize += 1
-                    fseqs = []
-
-                ## occasionally write/dump stored clusters to file and clear mem
-                if not seqsize % 10000:
-                    if seqlist:
-                        clustsout.write("\n//\n//\n".join(seqlist)+"\n//\n//\n")
-                        ## reset list and counter
-                        seqlist = []
-
-                ## store the new seed on top of fseq list
-                fseqs.append(">{}*\n{}".format(seed, alldereps[seed]))
-                lastseed = seed
+        gapslist = []
+        for line in injoin:
+            _, kind, name, ori, ind, seq = line.rstrip("\n").split("\t")
 
             ## add match to the seed
-            ## revcomp if orientation is reversed (comp preserves nnnn)
-            if ori == "-":
-                seq = comp(alldereps[hit])[::-1]
-            else:
-                seq = alldereps[hit]
-            ## only save if not too many indels
-            if int(ind) <= maxindels:
-                fseqs.append(">{}{}\n{}".format(hit, ori, seq))
-            else:
-                LOGGER.info("filtered by maxindels: %s %s", ind, seq)
+            if kind == "h":
+                fseqs.append(">{}{}\n{}".format(name, ori, seq))
+                fgaps.append(int(ind))
+                continue
+
+            ## new seed, store the last cluster and clear fseqs
+            if fseqs:
+                ## sort fseqs by derep after pulling out the seed
+                ## and keep the gap counts in the same order
+                order = [0] + sorted(range(1, len(fseqs)), key=lambda x: \
+                    int(fseqs[x].split(";size=")[1].split(";")[0]), reverse=True)
+                seqlist.append("\n".join([fseqs[i] for i in order]))
+                gapslist.extend([fgaps[i] for i in order])
+
+            ## occasionally write/dump stored clusters to file and clear mem
+            if len(seqlist) == 10000:
+                clustsout.write("\n//\n//\n".join(seqlist)+"\n//\n//\n")
+                write_gaps(gapsout, gapslist)
+                seqlist = []
+                gapslist = []
+
+            ## store the new seed on top of fseq list
+            fseqs = [">{}*\n{}".format(name, seq)]
+            fgaps = [0]
 
     ## write whatever is left over to the clusts file
     if fseqs:
-        seqlist.append("\n".join(fseqs))
+        order = [0] + sorted(range(1, len(fseqs)), key=lambda x: \
+            int(fseqs[x].split(";size=")[1].split(";")[0]), reverse=True)
+        seqlist.append("\n".join([fseqs[i] for i in order]))
+        gapslist.extend([fgaps[i] for i in order])
     if seqlist:
         clustsout.write("\n//\n//\n".join(seqlist)+"\n//\n//\n")
+        write_gaps(gapsout, gapslist)
 
-    ## now write the seeds that had no hits. Make dict from htemp
-    with open(hhandle, 'rb') as iotemp:
-        nohits = itertools.izip(*[iter(iotemp)]*2)
-        seqlist = []
-        seqsize = 0
-        while 1:
-            try:
-                nnn, _ = [i.strip() for i in nohits.next()]
-            except StopIteration:
-                break
-
-            ## occasionally write to file
-            if not seqsize % 10000:
-                if seqlist:
-                    clustsout.write("\n//\n//\n".join(seqlist)+"\n//\n//\n")
-                    ## reset list and counter
-                    seqlist = []
-
-            ## append to list if new seed
-            if nnn[1:] not in seedsseen:
-                seqlist.append("{}*\n{}".format(nnn, alldereps[nnn[1:]]))
-                seqsize += 1
+    ## close the file handles and remove tmp files
+    clustsout.close()
+    gapsout.close()
+    for tmpfile in tmpfiles:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
 
-    ## write whatever is left over to the clusts file
-    if seqlist:
-        clustsout.write("\n//\n//\n".join(seqlist))#+"\n//\n//\n")
 
-    ## close the file handle
-    clustsout.close()
-    del alldereps
+
+def external_sort(infile, outfile, keys, memory, tmpdir):
+    """ 
+    sorts a text file with unix sort in the C locale, using at most memory
+    (a sort -S size, e.g., "1G") and writing temporary files to tmpdir.
+    """
+    cmd = ["sort"] + keys + ["-S", str(memory), "-T", tmpdir, infile, "-o", outfile]
+    env = dict(os.environ, LC_ALL="C")
+    proc = sps.Popen(cmd, env=env, stderr=sps.PIPE, close_fds=True)
+    err = proc.communicate()[1]
+    if proc.returncode:
+        raise IPyradWarningExit(SORT_ERROR.format(" ".join(cmd), err))
+
+
+
+def join_dereps(derepsort, reqsort, joined):
+    """
+    Sorted-merge join of the name sorted requests against the name sorted
+    derep reads. Writes each request with its seq (revcomped if the hit 
+    matched the minus strand), and skips the no-hit entries of seeds that 
+    already have a cluster. Only one derep read is held in memory.
+    """
+    with open(derepsort, 'rb') as iderep, \
+         open(reqsort, 'rb') as ireq, \
+         open(joined, 'wb') as out:
+
+        dereps = (i.rstrip("\n").split("\t") for i in iderep)
+        requests = (i.rstrip("\n").split("\t") for i in ireq)
+        dname, dseq = "", ""
+        for name, group in itertools.groupby(requests, key=lambda x: x[0]):
+            ## advance derep reads to this name. Sorted in the C locale, so
+            ## names compare the same in python.
+            while dname < name:
+                try:
+                    dname, dseq = next(dereps)
+                except StopIteration:
+                    break
+            if dname != name:
+                raise IPyradError(MISSING_DEREP.format(name, derepsort))
+
+            group = list(group)
+            isseed = any(i[2] == "s" for i in group)
+            for _, key, kind, ori, ind in group:
+                if (kind == "n") and isseed:
+                    continue
+                ## revcomp if orientation is reversed (comp preserves nnnn)
+                if ori == "-":
+                    seq = comp(dseq)[::-1]
+                else:
+                    seq = dseq
+                out.write("\t".join([key, kind, name, ori, ind, seq])+"\n")
+
+
+
+def write_gaps(gapsout, gaps):
+    """ append vsearch gap counts to a .gaps file as uint16 """
+    np.minimum(gaps, GAPS_UNKNOWN).astype(np.uint16).tofile(gapsout)
 
 
 
@@ -640,8 +822,6 @@ def new_apply_jobs(data, samples, ipyclient, nthreads, maxindels, force):
     ## is datatype gbs? used in alignment-trimming by align_and_parse()
     is_gbs = bool("gbs" in data.paramsdict["datatype"])
 
-    ## Two view objects, threaded and unthreaded
-    lbview = ipyclient.load_balanced_view()
     start = time.time()
     elapsed = datetime.timedelta(seconds=int(time.time()-start))
     firstfunc = "derep_concat_split"
@@ -649,23 +829,14 @@ def new_apply_jobs(data, samples, ipyclient, nthreads, maxindels, force):
     #printstr = " {}      | {} | s3 |".format(PRINTSTR[], elapsed)
     progressbar(10, 0, printstr, spacer=data._spacer)
 
-    ## TODO: for HPC systems this should be done to make sure targets are spread
-    ## among different nodes.
-    if nthreads:
-        if nthreads < len(ipyclient.ids):
-            thview = ipyclient.load_balanced_view(targets=ipyclient.ids[::nthreads])
-        elif nthreads == 1:
-            thview = ipyclient.load_balanced_view()
-        else:
-            if len(ipyclient) > 40:
-                thview = ipyclient.load_balanced_view(targets=ipyclient.ids[::4])
-            else:
-                thview = ipyclient.load_balanced_view(targets=ipyclient.ids[::2])
-
-
     ## get list of jobs/dependencies as a DAG for all pre-align funcs.
     dag, joborder = build_dag(data, samples)
 
+    ## place each job on the engines of one host, packed by its estimated
+    ## memory and threads. Jobs with the same targets share a view.
+    placement = schedule_dag(data, dag, ipyclient, nthreads)
+    views = {}
+
     ## dicts for storing submitted jobs and results
     results = {}
 
@@ -688,22 +859,24 @@ def new_apply_jobs(data, samples, ipyclient, nthreads, maxindels, force):
             args = [data, sample, nthreads, force]
         elif funcstr in ["build_clusters"]:
             args = [data, sample, maxindels]
+        elif funcstr in ["ref_fetch_chunk"]:
+            args = [data, sample, int(chunk)]
         elif funcstr in ["muscle_align"]:
+            clustfile = clustbin_path(
+                os.path.join(data.dirs.clusts, sample.name+".clust.gz"))
             handle = os.path.join(data.tmpdir, 
-                        "{}_chunk_{}.ali".format(sample.name, chunk))
-            args = [handle, maxindels, is_gbs]
+                        "{}_chunk_{}.aligned.hdf5".format(sample.name, chunk))
+            args = [clustfile, int(chunk), handle, maxindels, is_gbs]
         else:
             args = [data, sample]
 
-        # submit and store AsyncResult object. Some jobs are threaded.
-        if nthreads and (funcstr in THREADED_FUNCS):
-            #LOGGER.info('submitting %s to %s-threaded view', funcstr, nthreads)
-            with thview.temp_flags(after=deps, block=False):
-                results[node] = thview.apply(func, *args)
-        else:
-            #LOGGER.info('submitting %s to single-threaded view', funcstr)
-            with lbview.temp_flags(after=deps, block=False):
-                results[node] = lbview.apply(func, *args)
+        # submit and store AsyncResult object to the view of its targets
+        targets = tuple(placement[node])
+        if targets not in views:
+            views[targets] = ipyclient.load_balanced_view(targets=list(targets))
+        with views[targets].temp_flags(after=deps, block=False):
+            results[node] = views[targets].apply(
+                profiled(data, func, PRINTSTR[funcstr], sample), *args)
 
     ## track jobs as they finish, abort if someone fails. This blocks here
     ## until all jobs are done. Keep track of which samples have failed so
@@ -725,21 +898,37 @@ def new_apply_jobs(data, samples, ipyclient, nthreads, maxindels, force):
 
     ## Cleanup of successful samples, skip over failed samples
     badaligns = {}
+    bypassed = {}
+    mapsecs = {}
     for sample in samples:
         ## The muscle_align step returns the number of excluded bad alignments
+        ## and of clusters that did not need to be aligned, summed over chunks
+        ## and mapreads returns the seconds it spent mapping
         for async in results:
             func, chunk, sname = async.split("-", 2)
             if (func == "muscle_align") and (sname == sample.name):
                 if results[async].successful():
-                    badaligns[sample] = int(results[async].get())
+                    nbad, nbypass = results[async].get()
+                    badaligns[sample] = badaligns.get(sample, 0) + int(nbad)
+                    bypassed[sample] = bypassed.get(sample, 0) + int(nbypass)
+            elif (func == "mapreads") and (sname == sample.name):
+                if results[async].successful():
+                    mapsecs[sample] = results[async].get()
 
     ## for the samples that were successful:
     for sample in badaligns:
         ## store the result
-        sample.stats_dfs.s3.filtered_bad_align = badaligns[sample]
+        sample.stats_dfs.s3["filtered_bad_align"] = badaligns[sample]
+        sample.stats_dfs.s3["aligns_bypassed"] = bypassed[sample]
         ## store all results
         try:
             sample_cleanup(data, sample)
+            ## mapping throughput, in reads (or pairs) mapped or not per sec
+            if sample in mapsecs:
+                nreads = sample.stats["refseq_mapped_reads"] \
+                       + sample.stats["refseq_unmapped_reads"]
+                sample.stats_dfs.s3["refseq_reads_per_sec"] = \
+                       nreads / max(mapsecs[sample], 1e-3)
         except Exception as inst:
             msg = "  Sample {} failed this step. See ipyrad_log.txt.\
                   ".format(sample.name)
@@ -779,6 +968,11 @@ def build_dag(data, samples):
         ## append final reconcat jobs
         dag.add_node("{}-{}-{}".format("reconcat", 0, sname))
 
+        ## append jobs fetching the mapped reads of each block of regions
+        if "ref_merge_regions" in joborder:
+            for chunk in xrange(REF_FETCH_CHUNKS):
+                dag.add_node("{}-{}-{}".format("ref_fetch_chunk", chunk, sname))
+
     ## ORDER OF JOBS: add edges/dependency between jobs: (first-this, then-that)
     for sname in snames:
         for sname2 in snames:
@@ -803,11 +997,152 @@ def build_dag(data, samples):
                 ## each chunk of its own sample has finished aligning.
                 dag.add_edge("{}-{}-{}".format("muscle_align", chunk, sname),
                              "{}-{}-{}".format("reconcat", 0, sname))
-    ## return the dag
+
+        ## the regions are fetched in parallel chunks between merging regions
+        ## and joining the clusters of the chunks.
+        if "ref_merge_regions" in joborder:
+            for chunk in xrange(REF_FETCH_CHUNKS):
+                dag.add_edge("{}-{}-{}".format("ref_merge_regions", 0, sname),
+                             "{}-{}-{}".format("ref_fetch_chunk", chunk, sname))
+                dag.add_edge("{}-{}-{}".format("ref_fetch_chunk", chunk, sname),
+                             "{}-{}-{}".format("ref_build_and_muscle_chunk", 0, sname))
+
+    ## return the dag and the order in which to track its jobs
+    if "ref_merge_regions" in joborder:
+        idx = joborder.index("ref_merge_regions") + 1
+        joborder = joborder[:idx] + ["ref_fetch_chunk"] + joborder[idx:]
     return dag, joborder
 
 
 
+def get_engine_resources():
+    """ 
+    returns the hostname, total memory in bytes (or None if unknown) and
+    number of cpus of the machine an engine is running on.
+    """
+    try:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        memory = None
+    try:
+        import multiprocessing
+        ncpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        ncpus = None
+    return socket.gethostname(), memory, ncpus
+
+
+
+def get_host_resources(ipyclient):
+    """ 
+    groups engine ids by host and returns a dict of 
+    {host: {"eids": [...], "memory": bytes, "ncpus": n}}
+    """
+    dview = ipyclient.direct_view()
+    resources = dview.apply_sync(get_engine_resources)
+    hosts = {}
+    for eid, (host, memory, ncpus) in zip(ipyclient.ids, resources):
+        if host not in hosts:
+            hosts[host] = {"eids": [], "memory": memory, "ncpus": ncpus}
+        hosts[host]["eids"].append(eid)
+    return hosts
+
+
+
+def estimate_job(data, sample, funcstr, nthreads):
+    """
+    estimates the peak memory (bytes) and threads used by a step 3 job from
+    the size of the sample's edited reads, which exist before any step 3 
+    job has run. Later files (derep, clusters) scale with it.
+    """
+    size = 0
+    for fastqs in sample.files.edits:
+        for fastq in fastqs:
+            if fastq and os.path.exists(str(fastq)):
+                fsize = os.path.getsize(fastq)
+                if fastq.endswith(".gz"):
+                    fsize *= GZIP_RATIO
+                size += fsize
+
+    ## build_clusters sorts within a fixed memory budget
+    memory = JOB_MEMORY_OVERHEAD + int(size * JOB_MEMORY_FACTOR.get(funcstr, 0))
+    if funcstr == "build_clusters":
+        memory += parse_memory_size(data._hackersonly["build_clusters_memory"])
+
+    threads = 1
+    if nthreads and (funcstr in THREADED_FUNCS):
+        threads = nthreads
+    ## muscle_align runs up to ALIGN_PROCS muscle processes at once
+    elif funcstr == "muscle_align":
+        threads = ALIGN_PROCS
+    return memory, threads
+
+
+
+def parse_memory_size(size):
+    """ bytes in a unix sort -S style size, e.g., 500M or 2G """
+    size = str(size).strip().upper()
+    ## a percent of RAM is not known until the job runs
+    if size.endswith("%"):
+        return 0
+    units = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size) * 2**10)
+
+
+
+def schedule_dag(data, dag, ipyclient, nthreads):
+    """
+    Places each job of the step 3 DAG on the engines of one host. For each
+    type of job (and host) the number of jobs that can run at once is the 
+    number of engines divided by the job's threads, limited further so that
+    their estimated memory fits in MAX_HOST_MEMORY of the host's RAM. A job 
+    is submitted to one lead engine of each of those slots, so a threaded 
+    job leaves its other engines idle for its threads. Jobs are assigned 
+    largest first to the host with the fewest jobs per slot of that type.
+    Returns {node: [engine ids]} and logs the placement.
+    """
+    hosts = get_host_resources(ipyclient)
+    LOGGER.info("step 3 hosts: %s", hosts)
+
+    ## group jobs by type, they run at about the same time for all samples
+    jobtypes = {}
+    for node in dag.nodes():
+        funcstr, _, sname = node.split("-", 2)
+        mem, threads = estimate_job(data, data.samples[sname], funcstr, nthreads)
+        jobtypes.setdefault(funcstr, []).append((mem, threads, node))
+
+    placement = {}
+    for funcstr, jobs in jobtypes.items():
+        nassigned = dict((host, 0) for host in hosts)
+        for mem, threads, node in sorted(jobs, reverse=True):
+            ## get the engines that the job can use on each host
+            leads = {}
+            for host, res in hosts.items():
+                nthr = min(threads, len(res["eids"]))
+                slots = len(res["eids"]) // nthr
+                if res["memory"]:
+                    memslots = int(res["memory"] * MAX_HOST_MEMORY) // mem
+                    slots = max(1, min(slots, memslots))
+                leads[host] = res["eids"][::nthr][:slots]
+
+            ## fewest jobs per slot, then most memory
+            host = min(hosts, key=lambda x: (
+                (nassigned[x] + 1) / float(len(leads[x])), 
+                -(hosts[x]["memory"] or 0)))
+            nassigned[host] += 1
+            placement[node] = leads[host]
+
+            if hosts[host]["memory"] and (mem > hosts[host]["memory"] * MAX_HOST_MEMORY):
+                LOGGER.warn("job %s may need %.1fGB, more than is free on %s",
+                            node, mem / 1e9, host)
+            LOGGER.info("placed %s on %s engines %s (mem=%.2fGB threads=%s)",
+                        node, host, leads[host], mem / 1e9, threads)
+    return placement
+
+
+
 def _plot_dag(dag, results, snames):
     """
     makes plot to help visualize the DAG setup. For developers only.
@@ -1098,6 +1433,8 @@ def data_cleanup(data):
                 'clusters_total':'{:.0f}'.format,
                 'clusters_hidepth':'{:.0f}'.format,
                 'filtered_bad_align':'{:.0f}'.format,
+                'aligns_bypassed':'{:.0f}'.format,
+                'refseq_reads_per_sec':'{:.0f}'.format,
                 'avg_depth_stat':'{:.2f}'.format,
                 'avg_depth_mj':'{:.2f}'.format,
                 'avg_depth_total':'{:.2f}'.format,
@@ -1216,7 +1553,7 @@ def cluster(data, sample, nthreads, force):
            "-id", str(data.paramsdict["clust_threshold"]),
            "-minsl", str(minsl),
            "-userout", uhandle,
-           "-userfields", "query+target+id+gaps+qstrand+qcov",
+           "-userfields", "query+target+id+gaps+qstrand+qcov+tcov",
            "-maxaccepts", "1",
            "-maxrejects", "0",
            "-threads", str(nthreads),
@@ -1253,57 +1590,44 @@ def cluster(data, sample, nthreads, force):
 
 def muscle_chunker(data, sample):
     """
-    Splits the muscle alignment into chunks. Each chunk is run on a separate
-    computing core. Because the largest clusters are at the beginning of the 
-    clusters file, assigning equal clusters to each file would put all of the 
-    large cluster, that take longer to align, near the top. So instead we 
-    randomly distribute the clusters among the files. If assembly method is
-    reference then this step is just a placeholder and nothing happens. 
+    Writes the unaligned clusters into a binary container in one pass. Each
+    computing core then reads its own chunk of clusters from the container
+    by index (see align_chunk_range) so that no tmp chunk files are written.
+    The vsearch gap counts from build_clusters are stored with the seqs, and
+    seqs appended later (reference clusters) are marked as GAPS_UNKNOWN.
+    If assembly method is reference then ref_build_and_muscle_chunk already
+    wrote the container and nothing happens. 
     """
     ## log our location for debugging
     LOGGER.info("inside muscle_chunker")
 
-    ## only chunk up denovo data, refdata has its own chunking method which 
-    ## makes equal size chunks, instead of uneven chunks like in denovo
+    ## only convert denovo data, refdata writes its own container
     if data.paramsdict["assembly_method"] != "reference":
-        ## get the number of clusters
         clustfile = os.path.join(data.dirs.clusts, sample.name+".clust.gz")
-        with iter(gzip.open(clustfile, 'rb')) as clustio:
-            nloci = sum(1 for i in clustio if "//" in i) // 2
-            #tclust = clustio.read().count("//")//2
-            optim = (nloci//20) + (nloci%20)
-            LOGGER.info("optim for align chunks: %s", optim)
-
-        ## write optim clusters to each tmp file
-        clustio = gzip.open(clustfile, 'rb')
-        inclusts = iter(clustio.read().strip().split("//\n//\n"))
-        
-        ## splitting loci so first file is smaller and last file is bigger
-        inc = optim // 10
-        for idx in range(10):
-            ## how big is this chunk?
-            this = optim + (idx * inc)
-            left = nloci-this
-            if idx == 9:
-                ## grab everything left
-                grabchunk = list(itertools.islice(inclusts, int(1e9)))
-            else:
-                ## grab next chunks-worth of data
-                grabchunk = list(itertools.islice(inclusts, this))
-                nloci = left
-
-            ## write the chunk to file
-            tmpfile = os.path.join(data.tmpdir, sample.name+"_chunk_{}.ali".format(idx))
-            with open(tmpfile, 'wb') as out:
-                out.write("//\n//\n".join(grabchunk))
+        with gzip.open(clustfile, 'rb') as clustio:
+            inclusts = clustio.read().split("//\n//\n")
+
+        ## load gap counts and fill in any seqs that have none
+        gapsfile = clustgaps_path(clustfile)
+        nseqs = sum(i.count(">") for i in inclusts)
+        if os.path.exists(gapsfile):
+            gaps = np.fromfile(gapsfile, dtype=np.uint16)
+        else:
+            gaps = np.zeros(0, dtype=np.uint16)
+        if gaps.shape[0] > nseqs:
+            LOGGER.warn("gap counts do not match clusters: %s", gapsfile)
+            gaps = np.zeros(0, dtype=np.uint16)
+        gaps = np.concatenate([gaps, np.zeros(nseqs - gaps.shape[0], 
+                                              dtype=np.uint16) + GAPS_UNKNOWN])
 
-        ## write the chunk to file
-        #grabchunk = list(itertools.islice(inclusts, left))
-        #if grabchunk:
-        #    tmpfile = os.path.join(data.tmpdir, sample.name+"_chunk_9.ali")
-        #    with open(tmpfile, 'a') as out:
-        #        out.write("\n//\n//\n".join(grabchunk))
-        clustio.close()
+        with ClustWriter(clustbin_path(clustfile)) as out:
+            srow = 0
+            for idx in xrange(0, len(inclusts), CLUSTBLOCK):
+                block = inclusts[idx:idx+CLUSTBLOCK]
+                erow = srow + sum(i.count(">") for i in block)
+                out.add_text(block, gaps[srow:erow])
+                srow = erow
+            LOGGER.info("clusters for align chunks: %s", out.nclusters)
 
 
 
@@ -1313,25 +1637,29 @@ def reconcat(data, sample):
     try:
         ## get chunks
         chunks = glob.glob(os.path.join(data.tmpdir,
-                 sample.name+"_chunk_[0-9].aligned"))
+                 sample.name+"_chunk_[0-9].aligned.hdf5"))
 
-        ## sort by chunk number, cuts off last 8 =(aligned)
-        chunks.sort(key=lambda x: int(x.rsplit("_", 1)[-1][:-8]))
+        ## sort by chunk number
+        chunks.sort(key=lambda x: int(x.rsplit("_", 1)[-1].split(".")[0]))
         LOGGER.info("chunk %s", chunks)
         ## concatenate finished reads
         sample.files.clusters = os.path.join(data.dirs.clusts,
                                              sample.name+".clustS.gz")
-        ## reconcats aligned clusters
-        with gzip.open(sample.files.clusters, 'wb') as out:
+        ## reconcats aligned clusters into the binary container
+        with ClustWriter(clustbin_path(sample.files.clusters)) as out:
             for fname in chunks:
-                with open(fname) as infile:
-                    dat = infile.read()
-                    ## avoids mess if last chunk was empty
-                    if dat.endswith("\n"):
-                        out.write(dat+"//\n//\n")
-                    else:
-                        out.write(dat+"\n//\n//\n")
+                with ClustFile(fname) as infile:
+                    out.add_file(infile)
                 os.remove(fname)
+
+        ## write the text clustS file for compatibility, or remove an old one
+        if data._hackersonly["write_clust_text"]:
+            with ClustFile(clustbin_path(sample.files.clusters)) as clusts:
+                clusts.write_text(sample.files.clusters)
+            ## the container stays current only if it is not older
+            os.utime(clustbin_path(sample.files.clusters), None)
+        elif os.path.exists(sample.files.clusters):
+            os.remove(sample.files.clusters)
     except Exception as inst:
         LOGGER.error("Error in reconcat {}".format(inst))
         raise
@@ -1499,8 +1827,36 @@ def run(data, samples, noreverse, maxindels, force, preview, ipyclient):
 
 ### GLOBALS
 
+## helper script that runs muscle, and clusters sent to it at a time
+ALIGNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aligner.py")
+ALIGN_BATCH = 200
+
+## muscle processes run at once by the aligner of a muscle_align job, so
+## the read1s and read2s of a pair are aligned at the same time
+ALIGN_PROCS = 2
+
 THREADED_FUNCS = ["derep_concat_split", "cluster", "mapreads"]
 
+## rough peak memory of step 3 jobs as a multiple of the uncompressed size
+## of a sample's edited reads, plus a fixed overhead for the engine.
+JOB_MEMORY_FACTOR = {
+    "derep_concat_split" :   1.0,
+    "mapreads" :             0.5,
+    "cluster" :              0.5,
+    "build_clusters" :       0.0,
+    "ref_merge_regions" :    0.05,
+    "ref_fetch_chunk" :      0.05,
+    "ref_build_and_muscle_chunk" : 0.05,
+    "muscle_chunker" :       0.5,
+    "muscle_align" :         0.05,
+    "reconcat" :             0.05,
+    }
+JOB_MEMORY_OVERHEAD = 2**28
+GZIP_RATIO = 4
+
+## fraction of a host's memory that scheduled jobs may use
+MAX_HOST_MEMORY = 0.8
+
 PRINTSTR = {
     #"derep_concat_split" : "concat+dereplicate",
     "derep_concat_split" : "dereplicating     ",
@@ -1511,8 +1867,10 @@ PRINTSTR = {
     "muscle_chunker" :     "chunking          ",
     "muscle_align" :       "aligning          ",
     "reconcat" :           "concatenating     ",
+    "ref_merge_regions" :  "merging regions   ",
+    "ref_fetch_chunk" :    "fetch mapped reads",
     "ref_build_and_muscle_chunk" : 
-                           "fetch mapped reads",
+                           "joining clusters  ",
     }
 
 
@@ -1522,6 +1880,8 @@ FUNCDICT = {
     "cluster" :            cluster,
     "build_clusters" :     build_clusters,
     "ref_muscle_chunker" : ref_muscle_chunker,
+    "ref_merge_regions" :  ref_merge_regions,
+    "ref_fetch_chunk" :    ref_fetch_chunk,
     "ref_build_and_muscle_chunk" : ref_build_and_muscle_chunk,    
     "muscle_chunker" :     muscle_chunker,
     "muscle_align" :       align_and_parse, #muscle_align,
@@ -1540,6 +1900,7 @@ JOBORDER = {
     "reference" : [
         "derep_concat_split",
         "mapreads",
+        "ref_merge_regions",
         "ref_build_and_muscle_chunk",
         "muscle_chunker",  ## <- doesn't do anything but hold back aligning jobs
         #"ref_muscle_chunker",
@@ -1549,6 +1910,7 @@ JOBORDER = {
         "mapreads",
         "cluster",
         "build_clusters",
+        "ref_merge_regions",
         "ref_build_and_muscle_chunk",
         "muscle_chunker"
         ], 
@@ -1562,6 +1924,16 @@ JOBORDER = {
     }   
 
 
+SORT_ERROR = """\
+    Error sorting files while building clusters.
+    cmd: {}
+    error: {}
+    """
+
+MISSING_DEREP = """\
+    Clustered read {} was not found in the derep reads ({}).
+    """
+
 NO_UHITS_ERROR = """\
     No clusters (.utemp hits) found for {}. If you are running preview mode and
     the size of the truncated input file isn't big enough try increasing the
@@ -0,0 +1,372 @@
+#!/usr/bin/env python2.7
+
+"""
+Binary container for within-sample clusters. Stores the names, seqs,
+sizes and orientations of every seq plus an index of where each cluster
+ends, so that clusters can be read by index without parsing the text
+*.clustS.gz format from the start.
+"""
+
+from __future__ import print_function
+# pylint: disable=E1101
+# pylint: disable=W0212
+# pylint: disable=C0301
+
+import os
+import gzip
+import itertools
+import numpy as np
+
+from ipyrad.assemble.util import IPyradError, clustdealer, parse_cluster
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+import warnings
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    import h5py
+
+
+
+def clustbin_path(clustfile):
+    """ path of the binary container that goes with a text clusters file """
+    return clustfile.rsplit(".gz", 1)[0] + ".hdf5"
+
+
+
+def current_clustbin(clustfile):
+    """
+    path of the binary container of a text clusters file if it exists and
+    is at least as new as the text file, else None. Step 3 touches the
+    container after writing the text file from it, so a newer text file
+    was rewritten without it (e.g., by an older version of ipyrad).
+    """
+    binfile = clustbin_path(clustfile)
+    if not os.path.exists(binfile):
+        return None
+    if os.path.exists(clustfile) and \
+        (os.path.getmtime(clustfile) > os.path.getmtime(binfile)):
+        LOGGER.info("ignoring container older than %s", clustfile)
+        return None
+    return binfile
+
+
+
+def clustgaps_path(clustfile):
+    """ path of the vsearch gap counts that go with a text clusters file """
+    return clustfile.rsplit(".gz", 1)[0] + ".gaps"
+
+
+
+class ClustWriter(object):
+    """
+    Appends clusters to a new container. Clusters are added as text, in the
+    same format as the clust files ("name\\nseq\\nname\\nseq"), or copied
+    in blocks from another container.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.io5 = h5py.File(path, 'w')
+        for key, dtype in CLUSTDSETS:
+            self.io5.create_dataset(key, (0,),
+                                    dtype=dtype,
+                                    maxshape=(None,),
+                                    chunks=(CLUSTCHUNK,),
+                                    compression="lzf")
+        self.nseqs = 0
+        self.nbytes = 0
+        self.nnames = 0
+        self.nclusters = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def _extend(self, key, arr):
+        """ append arr to the end of a dataset """
+        dset = self.io5[key]
+        end = dset.shape[0]
+        dset.resize((end + arr.shape[0],))
+        dset[end:] = arr
+
+
+    def add_text(self, clusts, gaps=None):
+        """ 
+        parse a list of text clusters and append them, optionally with the
+        number of gaps vsearch reported for each seq.
+        """
+        clusts = [i for i in clusts if i.strip()]
+        if not clusts:
+            return
+        lines = [i.strip().split("\n") for i in clusts]
+        names = list(itertools.chain(*[i[0::2] for i in lines]))
+        seqs = list(itertools.chain(*[i[1::2] for i in lines]))
+        if len(names) != len(seqs):
+            raise IPyradError(BAD_CLUSTER_TEXT.format(self.path))
+
+        sizes = np.array([int(i.split(";")[-2][5:]) for i in names], dtype=np.uint32)
+        oris = np.fromstring("".join([i[-1] for i in names]), dtype=np.uint8)
+        nseqs = np.array([len(i) // 2 for i in lines], dtype=np.int64)
+        self.add_arrays(
+            np.fromstring("".join(names), dtype=np.uint8),
+            np.array([len(i) for i in names], dtype=np.int64),
+            np.fromstring("".join(seqs), dtype=np.uint8),
+            np.array([len(i) for i in seqs], dtype=np.int64),
+            sizes, oris, nseqs, gaps)
+
+
+    def add_arrays(self, names, namelens, seqs, seqlens, sizes, oris, nseqs, 
+                   gaps=None):
+        """
+        append clusters given as byte arrays of names and seqs, the length
+        of each, and the number of seqs in each cluster. Seqs without gap
+        counts are stored as GAPS_UNKNOWN.
+        """
+        if gaps is None:
+            gaps = np.zeros(sizes.shape[0], dtype=np.uint16) + GAPS_UNKNOWN
+        self._extend("names", names)
+        self._extend("nameends", self.nnames + np.cumsum(namelens))
+        self._extend("seqs", seqs)
+        self._extend("seqends", self.nbytes + np.cumsum(seqlens))
+        self._extend("sizes", sizes)
+        self._extend("oris", oris)
+        self._extend("gaps", gaps)
+        self._extend("clustends", self.nseqs + np.cumsum(nseqs))
+        self.nnames += int(namelens.sum())
+        self.nbytes += int(seqlens.sum())
+        self.nseqs += int(nseqs.sum())
+        self.nclusters += nseqs.shape[0]
+
+
+    def add_file(self, clustfile):
+        """ copy all clusters from another container """
+        for block in clustfile.iter_blocks():
+            self.add_arrays(*block)
+
+
+    def close(self):
+        """ close the file """
+        self.io5.close()
+
+
+
+class ClustFile(object):
+    """
+    Read access to a container written by ClustWriter. Only the index of
+    cluster ends is held in memory, seqs and names are read in blocks.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.io5 = h5py.File(path, 'r')
+        self.clustends = self.io5["clustends"][:]
+        self.nclusters = self.clustends.shape[0]
+
+
+    def __len__(self):
+        return self.nclusters
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        """ close the file """
+        self.io5.close()
+
+
+    def _rows(self, start, stop):
+        """ first and last seq rows of clusters start to stop """
+        srow = int(self.clustends[start - 1]) if start else 0
+        erow = int(self.clustends[stop - 1]) if stop else 0
+        return srow, erow
+
+
+    def _slab(self, key, endkey, srow, erow):
+        """ bytes and lengths of rows srow to erow of a names/seqs dataset """
+        ends = self.io5[endkey][srow:erow]
+        first = int(self.io5[endkey][srow - 1]) if srow else 0
+        lens = np.diff(np.concatenate([[first], ends]))
+        return self.io5[key][first:first + int(lens.sum())], lens
+
+
+    def depths(self):
+        """ total number of reads (sum of sizes) in each cluster """
+        sizes = self.io5["sizes"][:].astype(np.int64)
+        if not sizes.shape[0]:
+            return np.zeros(0, dtype=np.int64)
+        return np.add.reduceat(sizes, np.concatenate([[0], self.clustends[:-1]]))
+
+
+    def widths(self):
+        """ length of the last seq in each cluster """
+        seqends = self.io5["seqends"][:]
+        lasts = self.clustends - 1
+        starts = np.where(lasts > 0, seqends[np.maximum(lasts - 1, 0)], 0)
+        return seqends[lasts] - starts
+
+
+    def ungapped(self, start=0, stop=None):
+        """
+        bool for each cluster from start to stop, True if vsearch reported 
+        no gaps for any seq and all seqs are the same length, in which case
+        the cluster is already aligned. Hits that vsearch aligned with
+        terminal gaps are stored as GAPS_UNKNOWN by build_clusters.
+        """
+        stop = self.nclusters if stop is None else min(stop, self.nclusters)
+        if (stop <= start) or ("gaps" not in self.io5):
+            return np.zeros(max(stop - start, 0), dtype=np.bool_)
+        srow, erow = self._rows(start, stop)
+        seqends = self.io5["seqends"][max(srow - 1, 0):erow]
+        lens = np.diff(seqends) if srow else np.diff(np.concatenate([[0], seqends]))
+        gaps = self.io5["gaps"][srow:erow]
+        firsts = np.concatenate([[srow], self.clustends[start:stop - 1]]) - srow
+        nogaps = np.logical_and.reduceat(gaps == 0, firsts)
+        samelen = np.maximum.reduceat(lens, firsts) == np.minimum.reduceat(lens, firsts)
+        return nogaps & samelen
+
+
+    def iter_blocks(self, start=0, stop=None, blocksize=None):
+        """
+        yield the arrays of blocks of clusters from start to stop, in the
+        order taken by ClustWriter.add_arrays.
+        """
+        stop = self.nclusters if stop is None else min(stop, self.nclusters)
+        blocksize = blocksize or CLUSTBLOCK
+        for bstart in xrange(start, stop, blocksize):
+            bstop = min(bstart + blocksize, stop)
+            srow, erow = self._rows(bstart, bstop)
+            names, namelens = self._slab("names", "nameends", srow, erow)
+            seqs, seqlens = self._slab("seqs", "seqends", srow, erow)
+            nseqs = np.diff(np.concatenate([[srow], self.clustends[bstart:bstop]]))
+            yield (names, namelens, seqs, seqlens,
+                   self.io5["sizes"][srow:erow],
+                   self.io5["oris"][srow:erow],
+                   nseqs)
+
+
+    def iter_clusters(self, start=0, stop=None, blocksize=None):
+        """
+        yield (names, seqs, reps) for each cluster from start to stop, the
+        same as parse_cluster returns.
+        """
+        for block in self.iter_blocks(start, stop, blocksize):
+            names, namelens, seqs, seqlens, sizes, _, nseqs = block
+            names = split_bytes(names, namelens)
+            seqs = split_bytes(seqs, seqlens)
+            sizes = sizes.astype(np.int64).tolist()
+            row = 0
+            for nseq in nseqs:
+                yield (names[row:row + nseq],
+                       seqs[row:row + nseq],
+                       sizes[row:row + nseq])
+                row += nseq
+
+
+    def get(self, idx):
+        """ return (names, seqs, reps) of a single cluster """
+        if not 0 <= idx < self.nclusters:
+            raise IndexError("cluster {} not in {}".format(idx, self.path))
+        return next(self.iter_clusters(idx, idx + 1))
+
+
+    def write_text(self, outfile):
+        """ write all clusters to a text clust file (gzipped if .gz) """
+        fopen = gzip.open if outfile.endswith(".gz") else open
+        with fopen(outfile, 'wb') as out:
+            for names, seqs, _ in self.iter_clusters():
+                out.write(cluster_text(names, seqs) + "\n//\n//\n")
+
+
+
+def split_bytes(arr, lens):
+    """ split a byte array into a list of strings with the given lengths """
+    data = arr.tostring()
+    ends = np.cumsum(lens).tolist()
+    return [data[i:j] for i, j in zip([0] + ends[:-1], ends)]
+
+
+
+def cluster_text(names, seqs):
+    """ text form of a cluster, as in the clust files """
+    return "\n".join(itertools.chain(*zip(names, seqs)))
+
+
+
+def iter_clusters(clustfile):
+    """
+    yield (names, seqs, reps) for each cluster of a sample, from the binary
+    container if it is current and otherwise by parsing the text clust file.
+    """
+    binfile = current_clustbin(clustfile)
+    if binfile:
+        with ClustFile(binfile) as clusts:
+            for clust in clusts.iter_clusters():
+                yield clust
+    else:
+        with gzip.open(clustfile, 'rb') as clusters:
+            pairdealer = itertools.izip(*[iter(clusters)]*2)
+            done = 0
+            while not done:
+                try:
+                    done, chunk = clustdealer(pairdealer, 1)
+                except IndexError:
+                    raise IPyradError("  clustfile formatting error in %s", chunk)
+                if chunk:
+                    yield parse_cluster(chunk)
+
+
+
+def write_clustbin(clustfile):
+    """
+    build the binary container of a text clust file, for samples that were
+    clustered before containers were written.
+    """
+    binfile = clustbin_path(clustfile)
+    with ClustWriter(binfile + ".tmp") as out:
+        block = []
+        for names, seqs, _ in iter_clusters(clustfile):
+            block.append(cluster_text(names, seqs))
+            if len(block) == CLUSTBLOCK:
+                out.add_text(block)
+                block = []
+        out.add_text(block)
+    os.rename(binfile + ".tmp", binfile)
+    return binfile
+
+
+
+### GLOBALS
+
+## datasets of a container and their dtypes
+CLUSTDSETS = [
+    ("names", np.uint8),
+    ("nameends", np.int64),
+    ("seqs", np.uint8),
+    ("seqends", np.int64),
+    ("sizes", np.uint32),
+    ("oris", np.uint8),
+    ("gaps", np.uint16),
+    ("clustends", np.int64),
+    ]
+
+## gap count of seqs that were not clustered by vsearch (e.g., aligned seqs)
+GAPS_UNKNOWN = np.iinfo(np.uint16).max
+
+## hdf5 chunk length of each dataset, and clusters read per block
+CLUSTCHUNK = 2**16
+CLUSTBLOCK = 5000
+
+BAD_CLUSTER_TEXT = """\
+    Found a cluster with a name but no sequence while writing {}
+    """
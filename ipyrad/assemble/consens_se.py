@@ -20,7 +20,12 @@ import glob
 import io
 import os
 from ipyrad.assemble.jointestimate import recal_hidepth
-from util import TRANSFULL, progressbar, IPyradError, IPyradWarningExit, clustdealer, PRIORITY, MINOR
+from ipyrad.assemble.clustfile import ClustFile, clustbin_path, current_clustbin, \
+                                      write_clustbin
+from ipyrad.assemble.refmap import reference_index
+from util import TRANSFULL, progressbar, IPyradWarningExit, PRIORITY, MINOR, \
+                 stack_cluster, stack_counts
+from profiler import profiled
 
 from collections import Counter
 
@@ -35,7 +40,8 @@ with warnings.catch_warnings():
 
 def get_binom(base1, base2, estE, estH):
     """
-    return probability of base call
+    return probability of base call. Works elementwise on arrays of base
+    counts as well as on single values.
     """
         
     prior_homo = (1. - estH) / 2.
@@ -53,22 +59,20 @@ def get_binom(base1, base2, estE, estH):
     homob *= prior_homo
     
     ## final 
-    probabilities = [homoa, homob, hetprob]
-    bestprob = max(probabilities)/float(sum(probabilities))
+    bestprob = np.maximum(np.maximum(homoa, homob), hetprob) / \
+               (homoa + homob + hetprob)
 
     ## return
-    if hetprob > homoa:
-        return True, bestprob
-    else:
-        return False, bestprob
+    return hetprob > homoa, bestprob
 
 
 
-def removerepeats(consens, arrayed):
+def removerepeats(consens, arrayed, reps):
     """
     Checks for interior Ns in consensus seqs and removes those that are at
     low depth, here defined as less than 1/3 of the average depth. The prop 1/3
     is chosen so that mindepth=6 requires 2 base calls that are not in [N,-].
+    arrayed has one row per seq, each standing for reps[row] reads.
     """
 
     ## default trim no edges
@@ -129,11 +133,11 @@ def removerepeats(consens, arrayed):
         arrayed = arr1
 
     ## get column counts of Ns and -s
-    ndepths = np.sum(arrayed == 'N', axis=0)
-    idepths = np.sum(arrayed == '-', axis=0)
+    ndepths = np.sum((arrayed == 'N') * reps[:, None], axis=0)
+    idepths = np.sum((arrayed == '-') * reps[:, None], axis=0)
 
     ## get proportion of bases that are N- at each site
-    nons = ((ndepths + idepths) / float(arrayed.shape[0])) >= 0.75
+    nons = ((ndepths + idepths) / float(reps.sum())) >= 0.75
     ## boolean of whether base was called N
     isn = consens == "N"
     ## make ridx
@@ -147,9 +151,10 @@ def removerepeats(consens, arrayed):
 
 
 
-def newconsensus(data, sample, tmpchunk, optim):
+def newconsensus(data, sample, start, optim):
     """ 
-    new faster replacement to consensus 
+    new faster replacement to consensus. Calls optim clusters starting at 
+    cluster index start of the sample's cluster container.
     """
     ## do reference map funcs?
     isref = "reference" in data.paramsdict["assembly_method"]
@@ -158,12 +163,12 @@ def newconsensus(data, sample, tmpchunk, optim):
     data._este = data.stats.error_est.mean()
     data._esth = data.stats.hetero_est.mean()
 
-    ## get number relative to tmp file
-    tmpnum = int(tmpchunk.split(".")[-1])
+    ## tmp files are numbered by the first cluster in the chunk
+    tmpnum = start
 
     ## prepare data for reading
-    clusters = open(tmpchunk, 'rb')
-    pairdealer = itertools.izip(*[iter(clusters)]*2)    
+    clusters = ClustFile(clustbin_path(sample.files.clusters))
+    clustiter = clusters.iter_clusters(start, start + optim)
     maxlen = data._hackersonly["max_fragment_length"]
 
     ## write to tmp cons to file to be combined later
@@ -182,7 +187,7 @@ def newconsensus(data, sample, tmpchunk, optim):
 
     ## if reference-mapped then parse the fai to get index number of chroms
     if isref:
-        fai = pd.read_csv(data.paramsdict["reference_sequence"] + ".fai", 
+        fai = pd.read_csv(reference_index(data) + ".fai", 
                 names=['scaffold', 'size', 'sumsize', 'a', 'b'],
                 sep="\t")
         faidict = {j:i for i,j in enumerate(fai.scaffold)}
@@ -209,22 +214,17 @@ def newconsensus(data, sample, tmpchunk, optim):
         maxhet = data.paramsdict["max_Hs_consens"][0]
         maxn = data.paramsdict["max_Ns_consens"][0]
 
-    ## load the refmap dictionary if refmapping
+    ## clusters that pass the depth filter are held in a batch until it is 
+    ## full, then their stacks are base called together and filtered in order
+    batch = []
     done = 0
     while not done:
-        try:
-            done, chunk = clustdealer(pairdealer, 1)
-        except IndexError:
-            raise IPyradError("clustfile formatting error in %s", chunk)
-
-        if chunk:
-            ## get names and seqs
-            piece = chunk[0].strip().split("\n")
-            names = piece[0::2]
-            seqs = piece[1::2]
+        clust = next(clustiter, None)
+        done = clust is None
 
-            ## pull replicate read info from seqs
-            reps = [int(sname.split(";")[-2][5:]) for sname in names]
+        if clust:
+            ## get names, seqs and replicate read info
+            names, seqs, reps = clust
 
             ## IF this is a reference mapped read store the chrom and pos info
             ## -1 defaults to indicating an anonymous locus, since we are using
@@ -246,72 +246,84 @@ def newconsensus(data, sample, tmpchunk, optim):
                     
             ## apply read depth filter
             if nfilter1(data, reps):
+                batch.append(stack_cluster(seqs, reps, maxlen) + (ref_position,))
+            else:
+                #LOGGER.debug("@depth")
+                filters['depth'] += 1
 
-                ## get stacks of base counts
-                sseqs = [list(seq) for seq in seqs]
-                arrayed = np.concatenate(
-                    [[seq]*rep for seq, rep in zip(sseqs, reps)])
-                arrayed = arrayed[:, :maxlen]
-                
-                ## get consens call for each site, applies paralog-x-site filter
-                #consens = np.apply_along_axis(basecall, 0, arrayed, data)
-                consens = basecaller(
-                    arrayed, 
-                    data.paramsdict["mindepth_majrule"], 
-                    data.paramsdict["mindepth_statistical"],
-                    data._esth, 
-                    data._este,
-                    )
-
-                ## apply a filter to remove low coverage sites/Ns that
-                ## are likely sequence repeat errors. This is only applied to
-                ## clusters that already passed the read-depth filter (1)
-                if "N" in consens:
-                    try:
-                        consens, arrayed = removerepeats(consens, arrayed)
-
-                    except ValueError as _:
-                        LOGGER.info("Caught a bad chunk w/ all Ns. Skip it.")
-                        continue
-
-                ## get hetero sites
-                hidx = [i for (i, j) in enumerate(consens) \
-                            if j in list("RKSYWM")]
-                nheteros = len(hidx)
-                
-                ## filter for max number of hetero sites
-                if nfilter2(nheteros, maxhet):
-                    ## filter for maxN, & minlen
-                    if nfilter3(consens, maxn):
-                        ## counter right now
-                        current = counters["nconsens"]
-                        ## get N alleles and get lower case in consens
-                        consens, nhaps = nfilter4(consens, hidx, arrayed)
-                        ## store the number of alleles observed
-                        nallel[current] = nhaps
-
-                        ## store a reduced array with only CATG
-                        catg = np.array(\
-                            [np.sum(arrayed == i, axis=0)  \
-                            for i in list("CATG")],
-                            dtype='uint32').T
-                        catarr[current, :catg.shape[0], :] = catg
-                        refarr[current] = ref_position
-
-                        ## store the seqdata for tmpchunk
-                        storeseq[counters["name"]] = "".join(list(consens))
-                        counters["name"] += 1
-                        counters["nconsens"] += 1
-                        counters["heteros"] += nheteros
+        ## wait for a full batch unless this is the end of the chunk
+        if not batch or (len(batch) < CONSENS_BATCH and not done):
+            continue
+
+        ## get stacks of base counts
+        stacks = np.zeros(
+            (len(batch), maxlen, len(STACKORDER)), dtype=np.uint32)
+        for idx, (arr, reps, _) in enumerate(batch):
+            stacks[idx, :arr.shape[1]] = stack_counts(arr, reps, STACKORDER)
+
+        ## get consens call for each site, applies paralog-x-site filter
+        calls = basecaller(
+            stacks, 
+            data.paramsdict["mindepth_majrule"], 
+            data.paramsdict["mindepth_statistical"],
+            data._esth, 
+            data._este,
+            )
+
+        for idx, (arr, reps, ref_position) in enumerate(batch):
+            consens = calls[idx, :arr.shape[1]].view("S1")
+            arrayed = arr.view("S1")
+            trimmed = False
+
+            ## apply a filter to remove low coverage sites/Ns that
+            ## are likely sequence repeat errors. This is only applied to
+            ## clusters that already passed the read-depth filter (1)
+            if "N" in consens:
+                try:
+                    consens, arrayed = removerepeats(consens, arrayed, reps)
+                    trimmed = True
+
+                except ValueError as _:
+                    LOGGER.info("Caught a bad chunk w/ all Ns. Skip it.")
+                    continue
+
+            ## get hetero sites
+            hidx = [i for (i, j) in enumerate(consens) \
+                        if j in list("RKSYWM")]
+            nheteros = len(hidx)
+            
+            ## filter for max number of hetero sites
+            if nfilter2(nheteros, maxhet):
+                ## filter for maxN, & minlen
+                if nfilter3(consens, maxn):
+                    ## counter right now
+                    current = counters["nconsens"]
+                    ## get N alleles and get lower case in consens
+                    consens, nhaps = nfilter4(consens, hidx, arrayed, reps)
+                    ## store the number of alleles observed
+                    nallel[current] = nhaps
+
+                    ## store a reduced array with only CATG, taken from the 
+                    ## stack unless repeats were removed from arrayed
+                    if trimmed:
+                        catg = stack_counts(arrayed.view(np.uint8), reps)
                     else:
-                        #LOGGER.debug("@haplo")
-                        filters['maxn'] += 1
+                        catg = stacks[idx, :arr.shape[1]][:, CATGINDEX]
+                    catarr[current, :catg.shape[0], :] = catg
+                    refarr[current] = ref_position
+
+                    ## store the seqdata for tmpchunk
+                    storeseq[counters["name"]] = "".join(list(consens))
+                    counters["name"] += 1
+                    counters["nconsens"] += 1
+                    counters["heteros"] += nheteros
                 else:
-                    #LOGGER.debug("@hetero")
-                    filters['maxh'] += 1
+                    #LOGGER.debug("@haplo")
+                    filters['maxn'] += 1
             else:
-                #LOGGER.debug("@depth")
-                filters['depth'] += 1
+                #LOGGER.debug("@hetero")
+                filters['maxh'] += 1
+        batch = []
                 
     ## close infile io
     clusters.close()
@@ -338,84 +350,80 @@ def newconsensus(data, sample, tmpchunk, optim):
 
 
 
-def basecaller(arrayed, mindepth_majrule, mindepth_statistical, estH, estE):
+def basecaller(stacks, mindepth_majrule, mindepth_statistical, estH, estE):
     """
-    call all sites in a locus array.
+    call all sites in a batch of loci at once. stacks is an array of 
+    per-site base counts with shape (nloci, nsites, len(STACKORDER)), 
+    and the returned uint8 array has shape (nloci, nsites).
     """
 
-    ## an array to fill with consensus site calls
-    cons = np.zeros(arrayed.shape[1], dtype=np.uint8)
+    ## flatten to one row of counts per site, keep only the callable 
+    ## symbols (N and - are never called). Bases are in byte order so that 
+    ## argmax breaks ties toward the lower base like np.bincount does.
+    shape = stacks.shape[:-1]
+    counts = stacks[..., :NCALLED].reshape(-1, NCALLED).astype(np.int64)
+    rows = np.arange(counts.shape[0])
+
+    ## an array to fill with consensus site calls, empty sites stay N
+    cons = np.zeros(counts.shape[0], dtype=np.uint8)
     cons.fill(78)
-    arr = arrayed.view(np.uint8)
-    
-    ## iterate over columns
-    for col in xrange(arr.shape[1]):
-        ## the site of focus
-        carr = arr[:, col]
-        
-        ## make mask of N and - sites
-        mask = carr == 45
-        mask += carr == 78        
-        marr = carr[~mask]
-        
-        ## skip if only empties (e.g., N-)
-        if not marr.shape[0]:
-            cons[col] = 78
-        
-        ## skip if not variable
-        elif np.all(marr == marr[0]):
-            cons[col] = marr[0]
-        
-        ## estimate variable site call
-        else:
-            ## get allele freqs (first-most, second, third = p, q, r)
-            counts = np.bincount(marr)
-            
-            pbase = np.argmax(counts)
-            nump = counts[pbase]
-            counts[pbase] = 0
 
-            qbase = np.argmax(counts)
-            numq = counts[qbase]
-            counts[qbase] = 0
+    ## the most frequent base and the number of observed bases
+    pidx = counts.argmax(axis=1)
+    nobs = (counts > 0).sum(axis=1)
+
+    ## sites that are not variable get the only observed base
+    invar = nobs == 1
+    cons[invar] = CALLED[pidx[invar]]
+
+    ## estimate variable site calls from the first and second bases
+    vrows = rows[nobs > 1]
+    if vrows.size:
+        vcounts = counts[vrows]
+        vidx = np.arange(vrows.size)
+        pbase = pidx[vrows]
+        nump = vcounts[vidx, pbase]
+        vcounts[vidx, pbase] = 0
+        qbase = vcounts.argmax(axis=1)
+        numq = vcounts[vidx, qbase]
+        hets = HETCALLS[pbase, qbase]
+        calls = CALLED[pbase]
+
+        ## based on biallelic depth, too low is left as N
+        bidepth = nump + numq
+        called = bidepth >= mindepth_majrule
+        stat = called & (bidepth >= mindepth_statistical)
+        majr = called & ~stat
+
+        ## make majrule base calls
+        vcons = np.zeros(vrows.size, dtype=np.uint8)
+        vcons.fill(78)
+        tied = majr & (nump == numq)
+        vcons[majr] = calls[majr]
+        vcons[tied] = hets[tied]
+
+        ## make statistical base calls. If depth is too high reduce to
+        ## sampled ints. Only the unique pairs of depths need the binomial.
+        if stat.any():
+            snump = nump[stat]
+            snumq = numq[stat]
+            sdepth = bidepth[stat]
+            high = sdepth > 500
+            base1 = snump.copy()
+            base2 = snumq.copy()
+            base1[high] = (500 * (snump[high] / sdepth[high].astype(np.float64))).astype(np.int64)
+            base2[high] = (500 * (snumq[high] / sdepth[high].astype(np.float64))).astype(np.int64)
+            pairs, pinv = np.unique(base1 * 501 + base2, return_inverse=True)
+            ishet, prob = get_binom(pairs // 501, pairs % 501, estE, estH)
+            ishet = ishet[pinv]
+            prob = prob[pinv]
+            scons = np.where(ishet, hets[stat], calls[stat])
+            scons[prob < 0.95] = 78
+            vcons[stat] = scons
+
+        cons[vrows] = vcons
+    return cons.reshape(shape)
 
-            rbase = np.argmax(counts)
-            numr = counts[rbase]
-            
-            ## based on biallelic depth
-            bidepth = nump + numq 
-            if bidepth < mindepth_majrule:
-                cons[col] = 78
-            
-            else:
-                ## if depth is too high, reduce to sampled int
-                if bidepth > 500:
-                    base1 = int(500 * (nump / float(bidepth)))
-                    base2 = int(500 * (numq / float(bidepth)))
-                else:
-                    base1 = nump
-                    base2 = numq
-
-                ## make statistical base call  
-                if bidepth >= mindepth_statistical:
-                    ishet, prob = get_binom(base1, base2, estE, estH)
-                    #LOGGER.info("ishet, prob, b1, b2: %s %s %s %s", ishet, prob, base1, base2)
-                    if prob < 0.95:
-                        cons[col] = 78
-                    else:
-                        if ishet:
-                            cons[col] = TRANS[(pbase, qbase)]
-                        else:
-                            cons[col] = pbase
-                
-                ## make majrule base call
-                else: #if bidepth >= mindepth_majrule:
-                    if nump == numq:
-                        cons[col] = TRANS[(pbase, qbase)]
-                    else:
-                        cons[col] = pbase
-    return cons.view("S1")
-            
 
 
 TRANS = {
@@ -433,6 +441,26 @@ TRANS = {
          (65, 71): 82,
          }
 
+## symbol order of the last axis of a stacks array. Only the first NCALLED
+## symbols can be called as a consensus base (n is the pair separator), and 
+## they are in byte order so ties break the same way as in np.bincount.
+STACKORDER = "ACGTnN-"
+NCALLED = 5
+CALLED = np.fromstring(STACKORDER[:NCALLED], dtype=np.uint8)
+
+## ambiguity code for each pair of called symbols, N if there is none
+HETCALLS = np.zeros((NCALLED, NCALLED), dtype=np.uint8)
+HETCALLS.fill(78)
+for _pbase, _qbase in TRANS:
+    HETCALLS[STACKORDER.index(chr(_pbase)), STACKORDER.index(chr(_qbase))] = \
+        TRANS[(_pbase, _qbase)]
+
+## columns of a stacks array in the CATG order of the catg arrays
+CATGINDEX = [STACKORDER.index(i) for i in "CATG"]
+
+## number of loci that are base called together in a batch
+CONSENS_BATCH = 1000
+
 
 
 def nfilter1(data, reps):
@@ -467,7 +495,7 @@ def nfilter3(consens, maxn):
 
 
 
-def nfilter4(consens, hidx, arrayed):
+def nfilter4(consens, hidx, arrayed, reps):
     """ applies max haplotypes filter returns pass and consens"""
 
     ## if less than two Hs then there is only one allele
@@ -479,11 +507,14 @@ def nfilter4(consens, hidx, arrayed):
 
     ## remove any reads that have N or - base calls at hetero sites
     ## these cannot be used when calling alleles currently.
-    harray = harray[~np.any(harray == "-", axis=1)]
-    harray = harray[~np.any(harray == "N", axis=1)]
+    keep = ~np.any(harray == "-", axis=1) & ~np.any(harray == "N", axis=1)
+    harray = harray[keep]
+    hreps = reps[keep]
 
     ## get counts of each allele (e.g., AT:2, CG:2)
-    ccx = Counter([tuple(i) for i in harray])
+    ccx = Counter()
+    for hrow, hrep in zip(harray, hreps):
+        ccx[tuple(hrow)] += hrep
 
     ## Two possibilities we would like to distinguish, but we can't. Therefore,
     ## we just throw away low depth third alleles that are within seq. error.
@@ -494,7 +525,7 @@ def nfilter4(consens, hidx, arrayed):
     ## sequencing errors at hetero sites, making a third allele, or a new
     ## allelic combination that is not real.
     if len(ccx) > 2:
-        totdepth = harray.shape[0]
+        totdepth = hreps.sum()
         cutoff = max(1, totdepth // 10)
         alleles = [i for i in ccx if ccx[i] > cutoff]
     else:
@@ -657,40 +688,27 @@ def cleanup(data, sample, statsdicts):
 
 
 def chunk_clusters(data, sample):
-    """ split job into bits and pass to the client """
-
-    ## counter for split job submission
-    num = 0
+    """ 
+    get the ranges of clusters to pass to the client. Each engine reads its
+    range by index from the sample's cluster container, which is built from
+    the text clusters file here if the sample does not have one yet.
+    """
 
     ## set optim size for chunks in N clusters. The first few chunks take longer
     ## because they contain larger clusters, so we create 4X as many chunks as
     ## processors so that they are split more evenly.
     optim = int((sample.stats.clusters_total // data.cpus) + \
                 (sample.stats.clusters_total % data.cpus))
+    optim = max(optim, 1)
 
-    ## break up the file into smaller tmp files for each engine
-    ## chunking by cluster is a bit trickier than chunking by N lines
-    chunkslist = []
-
-    ## open to clusters
-    with gzip.open(sample.files.clusters, 'rb') as clusters:
-        ## create iterator to sample 2 lines at a time
-        pairdealer = itertools.izip(*[iter(clusters)]*2)
-
-        ## Use iterator to sample til end of cluster
-        done = 0
-        while not done:
-            ## grab optim clusters and write to file.
-            done, chunk = clustdealer(pairdealer, optim)
-            chunkhandle = os.path.join(data.dirs.clusts,
-                                    "tmp_"+str(sample.name)+"."+str(num*optim))
-            if chunk:
-                chunkslist.append((optim, chunkhandle))
-                with open(chunkhandle, 'wb') as outchunk:
-                    outchunk.write("//\n//\n".join(chunk)+"//\n//\n")
-                num += 1
+    ## get the number of clusters from the container index
+    clustbin = current_clustbin(sample.files.clusters)
+    if not clustbin:
+        clustbin = write_clustbin(sample.files.clusters)
+    with ClustFile(clustbin) as clusts:
+        nclusters = len(clusts)
 
-    return chunkslist
+    return [(optim, start) for start in xrange(0, nclusters, optim)]
 
 
 
@@ -792,8 +810,7 @@ def run(data, samples, force, ipyclient):
 
     finally:
         ## if process failed at any point delete tmp files
-        tmpcons = glob.glob(os.path.join(data.dirs.clusts, "tmp_*.[0-9]*"))
-        tmpcons += glob.glob(os.path.join(data.dirs.consens, "*_tmpcons.*"))
+        tmpcons = glob.glob(os.path.join(data.dirs.consens, "*_tmpcons.*"))
         tmpcons += glob.glob(os.path.join(data.dirs.consens, "*_tmpcats.*"))
         for tmpchunk in tmpcons:
             os.remove(tmpchunk)
@@ -817,7 +834,9 @@ def calculate_depths(data, samples, lbview):
     recaljobs = {}
     maxlens = []
     for sample in samples:
-        recaljobs[sample.name] = lbview.apply(recal_hidepth, *(data, sample))
+        recaljobs[sample.name] = lbview.apply(
+            profiled(data, recal_hidepth, "calculating depths", sample),
+            *(data, sample))
 
     ## block until finished
     while 1:
@@ -859,7 +878,9 @@ def make_chunks(data, samples, lbview):
     ## send off samples to be chunked
     lasyncs = {}
     for sample in samples:
-        lasyncs[sample.name] = lbview.apply(chunk_clusters, *(data, sample))
+        lasyncs[sample.name] = lbview.apply(
+            profiled(data, chunk_clusters, "chunking clusters", sample),
+            *(data, sample))
 
     ## block until finished
     while 1:
@@ -894,10 +915,11 @@ def process_chunks(data, samples, lasyncs, lbview):
     ## get chunklist from results
     for sample in samples:
         clist = lasyncs[sample.name].result()
-        for optim, chunkhandle in clist:
-            args = (data, sample, chunkhandle, optim)
+        for optim, cstart in clist:
+            args = (data, sample, cstart, optim)
             #asyncs[sample.name].append(lbview.apply_async(consensus, *args))
-            asyncs[sample.name].append(lbview.apply_async(newconsensus, *args))
+            asyncs[sample.name].append(lbview.apply_async(
+                profiled(data, newconsensus, "consens calling", sample), *args))
             elapsed = datetime.timedelta(seconds=int(time.time()-start))
             progressbar(10, 0, printstr.format(elapsed), spacer=data._spacer)
 
@@ -916,7 +938,9 @@ def process_chunks(data, samples, lasyncs, lbview):
     for sample in samples:
         rlist = asyncs[sample.name]
         statsdicts = [i.result() for i in rlist]
-        casyncs[sample.name] = lbview.apply(cleanup, *(data, sample, statsdicts))
+        casyncs[sample.name] = lbview.apply(
+            profiled(data, cleanup, "consens calling", sample),
+            *(data, sample, statsdicts))
     while 1:
         ready = [i.ready() for i in casyncs.values()]
         elapsed = datetime.timedelta(seconds=int(time.time()-start))
@@ -10,17 +10,27 @@ from __future__ import print_function
 
 import os
 import io
+import json
+import zlib
+import hashlib
 import gzip
+import Queue
+import socket
+import struct
 import glob
 import time
 import shutil
 import datetime
+import operator
 import itertools
 import cPickle as pickle
 import numpy as np
 import subprocess as sps
+import multiprocessing as mp
+from multiprocessing.managers import BaseManager
 from ipyrad.core.sample import Sample
 from ipyrad.assemble.util import *
+from ipyrad.assemble.profiler import profiled
 from collections import defaultdict, Counter
 
 import logging
@@ -490,18 +500,12 @@ def barmatch(data, tups, cutters, longbar, matchdict, fnum):
             """ finds barcode for variable barcode lengths"""
             return findbcode(cutters, longbar, read1)
 
-    ## get quart iterator of reads
-    if tups[0].endswith(".gz"):
-        ofunc = gzip.open
-    else:
-        ofunc = open
-
-    ## create iterators 
-    ofile1 = ofunc(tups[0], 'r')
+    ## create iterators, tups are files or record ranges of files
+    ofile1 = open_chunk(tups[0])
     fr1 = iter(ofile1) 
     quart1 = itertools.izip(fr1, fr1, fr1, fr1)
     if tups[1]:
-        ofile2 = ofunc(tups[1], 'r')
+        ofile2 = open_chunk(tups[1])
         fr2 = iter(ofile2)  
         quart2 = itertools.izip(fr2, fr2, fr2, fr2)
         quarts = itertools.izip(quart1, quart2)
@@ -621,6 +625,438 @@ def barmatch(data, tups, cutters, longbar, matchdict, fnum):
 
 
 
+## called by demux2() when _hackersonly["demultiplex_engine"] == "block"
+def blockmatch(data, tups, cutters, longbar, matchdict, fnum, shards=None):
+    """
+    Block-wise alternative to barmatch(). Reads are pulled in blocks of
+    waitchunk reads, the barcode window of every read in the block is
+    extracted at once into a numpy byte array, and windows are packed and
+    matched to samples by binary search in the BarcodeIndex (matchdict).
+    Writes the same tmp files and stats pickle as barmatch(), or if shards
+    is set, pushes compressed blocks to the shard writers instead of tmp
+    files (see start_shard_writers()).
+    """
+
+    ## how many reads to process in a block before writing to disk
+    waitchunk = int(1e6)
+
+    ## pid name for this engine
+    epid = os.getpid()
+
+    ## counters for total reads, those with cutsite, and those that matched
+    filestat = np.zeros(3, dtype=np.int)
+
+    ## stats dicts in the same format as barmatch()
+    samplehits = {}
+    dsort1 = {}
+    dsort2 = {}
+    dbars = {}
+    for sname in data.barcodes:
+        if "-technical-replicate-" in sname:
+            sname = sname.rsplit("-technical-replicate", 1)[0]
+        samplehits[sname] = 0
+        dsort1[sname] = []
+        dsort2[sname] = []
+        dbars[sname] = set()
+    barhits = {}
+    misses = {}
+    misses['_'] = 0
+
+    ## sorted packed barcode keys -> sample index
+    keys = matchdict.keys
+    bsidx = matchdict.sidx
+    snames = matchdict.snames
+
+    ## write to tmp files for collating, or straight to the shard writers
+    if shards:
+        writeblock = get_shard_pusher(shards)
+    else:
+        writeblock = lambda dsort, read: writetofile(data, dsort, read, epid)
+
+    ## open read files, tups are files or record ranges of files
+    ofile1 = open_chunk(tups[0])
+    ofile2 = None
+    if tups[1]:
+        ofile2 = open_chunk(tups[1])
+
+    datatype = data.paramsdict["datatype"]
+    while 1:
+        ## pull a block of reads, drop any trailing partial record
+        lines1 = list(itertools.islice(ofile1, 4 * waitchunk))
+        nreads = len(lines1) // 4
+        if not nreads:
+            break
+        lines1 = lines1[:nreads * 4]
+        lines2 = None
+        if ofile2:
+            lines2 = list(itertools.islice(ofile2, 4 * nreads))
+            nreads = min(nreads, len(lines2) // 4)
+            lines1 = lines1[:nreads * 4]
+            lines2 = lines2[:nreads * 4]
+
+        ## barcode windows, lengths of barcode1 and 2, and non-empty mask
+        windows, blen1, blen2, nonempty = block_barcodes(
+            data, cutters, longbar, lines1, lines2)
+
+        ## split records into object arrays of each line type
+        fields1 = [np.array(lines1[i::4], dtype=object) for i in range(4)]
+        if lines2:
+            fields2 = [np.array(lines2[i::4], dtype=object) for i in range(4)]
+
+        ## match packed windows against the index
+        kidx = matchdict.lookup(pack_barcodes(windows))
+        hits = kidx >= 0
+
+        ## update counters
+        nhits = int(hits.sum())
+        filestat[0] += nreads
+        filestat[1] += nhits + int((nonempty & ~hits).sum())
+        filestat[2] += nhits
+        misses["_"] += nreads - nhits
+
+        ## barhits counts each hit twice, as in barmatch()
+        kcounts = np.bincount(kidx[hits], minlength=keys.shape[0])
+        for kid in np.where(kcounts)[0]:
+            sname = snames[bsidx[kid]]
+            barc = unpack_barcode(keys[kid])
+            barhits[barc] = barhits.get(barc, 0) + 2 * int(kcounts[kid])
+            samplehits[sname] += int(kcounts[kid])
+            dbars[sname].add(barc)
+
+        ## group matched reads by sample keeping the input order
+        rsidx = np.where(hits, bsidx[kidx], -1)
+        hitrows = np.where(hits)[0]
+        hitrows = hitrows[np.argsort(rsidx[hitrows], kind="mergesort")]
+        bounds = np.searchsorted(rsidx[hitrows], np.arange(len(snames) + 1))
+
+        ## trim barcodes and store in bulk for each sample
+        for sid, sname in enumerate(snames):
+            rows = hitrows[bounds[sid]:bounds[sid + 1]]
+            if not rows.shape[0]:
+                continue
+            dsort1[sname].append(
+                trim_block(datatype, cutters, fields1, rows, blen1, 1))
+            if 'pair' in datatype:
+                dsort2[sname].append(
+                    trim_block(datatype, cutters, fields2, rows, blen2, 2))
+
+        ## write this block and clear dsorts
+        writeblock(dsort1, 1)
+        if 'pair' in datatype:
+            writeblock(dsort2, 2)
+        for sname in dsort1:
+            dsort1[sname] = []
+            dsort2[sname] = []
+
+    ## close open files
+    ofile1.close()
+    if ofile2:
+        ofile2.close()
+
+    ## ensures tmp files exist for every sample even if nothing matched
+    if not shards:
+        writetofile(data, dsort1, 1, epid)
+        if 'pair' in datatype:
+            writetofile(data, dsort2, 2, epid)
+
+    ## return stats in saved pickle b/c return_queue is too small
+    samplestats = [samplehits, barhits, misses, dbars]
+    outname = os.path.join(data.dirs.fastqs, "tmp_{}_{}.p".format(epid, fnum))
+    with open(outname, 'w') as wout:
+        pickle.dump([filestat, samplestats], wout)
+
+    return outname
+
+
+
+def barcode_window_width(data, longbar):
+    """ width of the barcode windows extracted by block_barcodes() """
+    if '3rad' in data.paramsdict["datatype"]:
+        return longbar[0] + 1 + longbar[2]
+    return longbar[0]
+
+
+
+def block_barcodes(data, cutters, longbar, lines1, lines2):
+    """
+    Extracts the barcode of every read in a block as a zero padded uint8
+    array of fixed width, using the same rules as getbarcode(),
+    findbcode() and find3radbcode(). For 3rad the two barcodes are joined
+    by '+'. Also returns the barcode lengths and a mask of reads for which
+    the barcode string was not empty. Barcodes that are longer than the 
+    window (no cutter found) are returned empty since they can never match,
+    but are still flagged as non-empty.
+    """
+    datatype = data.paramsdict["datatype"]
+    width = barcode_window_width(data, longbar)
+    seqs1 = lines1[1::4]
+    nreads = len(seqs1)
+    blen2 = np.zeros(nreads, dtype=np.int64)
+
+    if '3rad' in datatype:
+        ## both reads are searched for all cutters in order
+        allcuts = [i for j in cutters for i in j]
+        win1, blen1, found1 = cutter_windows(seqs1, allcuts, longbar[0])
+        win2, blen2, found2 = cutter_windows(lines2[1::4], allcuts, longbar[2])
+        ## join barcodes with '+', zero padding is skipped when packing
+        sep = np.zeros((nreads, 1), dtype=np.uint8) + ord("+")
+        mat = np.hstack([win1, sep, win2])
+        ## reads w/o a cutter get a barcode that can not match
+        mat[~(found1 & found2)] = 0
+        nonempty = np.ones(nreads, dtype=np.bool_)
+
+    elif longbar[1] == 'same':
+        if datatype == '2brad':
+            ## barcode is seq[:-(len(cut)+1)][-longbar:], seqs end in \n
+            lcut = len(cutters[0][0]) + 1
+            maxlen = max(len(i) for i in seqs1)
+            full = np.array(seqs1, dtype="S{}".format(max(maxlen, 1)))
+            full = full.view(np.uint8).reshape(nreads, -1)
+            lens = np.array([len(i) for i in seqs1], dtype=np.int64)
+            end = np.maximum(lens - lcut, 0)
+            beg = np.maximum(end - width, 0)
+            blen1 = end - beg
+            cols = beg[:, None] + np.arange(width)
+            mat = full[np.arange(nreads)[:, None],
+                       np.minimum(cols, full.shape[1] - 1)]
+            mat[np.arange(width) >= blen1[:, None]] = 0
+        else:
+            ## numpy truncates each string to the window width
+            mat = np.array(seqs1, dtype="S{}".format(width))
+            mat = mat.view(np.uint8).reshape(nreads, width)
+            blen1 = (mat != 0).sum(axis=1)
+        nonempty = blen1 > 0
+
+    else:
+        win1, blen1, found = cutter_windows(seqs1, cutters[0], longbar[0])
+        mat = win1
+        ## no cutter: the barcode is the whole search string and can't match
+        mat[~found] = 0
+        nonempty = (blen1 > 0) | ~found
+
+    return mat, blen1, blen2, nonempty
+
+
+
+def cutter_windows(seqs, cutters, maxbar):
+    """
+    Finds the rightmost occurrence of a cutter in the first
+    maxbar+len(cutter)+1 bases of each read, trying cutters in order,
+    and returns a (nreads, maxbar) uint8 array with the bases preceding
+    the cutter (zero padded), the barcode lengths, and a found mask.
+    Barcodes longer than maxbar can not match and are returned as not found.
+    """
+    nreads = len(seqs)
+    blens = np.zeros(nreads, dtype=np.int64)
+    found = np.zeros(nreads, dtype=np.bool_)
+    cutters = [i for i in cutters if i]
+    span = maxbar + max([len(i) for i in cutters] + [0]) + 1
+    mat = np.array(seqs, dtype="S{}".format(span))
+    mat = mat.view(np.uint8).reshape(nreads, span)
+
+    for cutter in cutters:
+        lcut = len(cutter)
+        cut = np.frombuffer(cutter, dtype=np.uint8)
+        ## search window for this cutter is seq[:maxbar+lcut+1]
+        npos = maxbar + 2
+        hit = np.ones((nreads, npos), dtype=np.bool_)
+        for cidx in xrange(lcut):
+            hit &= mat[:, cidx:cidx + npos] == cut[cidx]
+        anyhit = hit.any(axis=1) & ~found
+        ## position of the rightmost hit
+        last = npos - 1 - np.argmax(hit[:, ::-1], axis=1)
+        blens[anyhit] = last[anyhit]
+        found |= anyhit
+
+    ## barcodes longer than maxbar are too long to match anything
+    found &= blens <= maxbar
+    win = mat[:, :maxbar].copy()
+    win[np.arange(maxbar) >= blens[:, None]] = 0
+    return win, blens, found
+
+
+
+def trim_block(datatype, cutters, fields, rows, blens, read):
+    """
+    Returns a single string of the 4-line fastq records for rows of a block
+    with barcodes trimmed as done in barmatch(). fields is a list of four
+    object arrays (headers, seqs, '+' lines, quals). Rows that share a
+    barcode length (usually all rows of a sample) are trimmed in bulk.
+    """
+    heads, seqs, plus, quals = [i[rows] for i in fields]
+
+    ## only 3rad pays the cost of trimming R2
+    if read == 2 and '3rad' not in datatype:
+        recs = itertools.izip(heads, seqs, plus, quals)
+        return "".join(itertools.chain.from_iterable(recs))
+
+    ## slice to apply to seq and qual lines given a barcode length
+    if read == 1 and datatype == '2brad':
+        lcut = len(cutters[0][0]) + 1
+        getslice = lambda blen: slice(None, -(lcut + blen))
+        newline = "\n"
+    else:
+        getslice = lambda blen: slice(blen, None)
+        newline = ""
+
+    rblens = blens[rows]
+    if rblens.min() == rblens.max():
+        trim = operator.itemgetter(getslice(int(rblens[0])))
+        seqs = itertools.imap(trim, seqs)
+        quals = itertools.imap(trim, quals)
+    else:
+        seqs = [i[getslice(j)] for i, j in itertools.izip(seqs, rblens)]
+        quals = [i[getslice(j)] for i, j in itertools.izip(quals, rblens)]
+    if newline:
+        nls = itertools.repeat(newline)
+        recs = itertools.izip(heads, seqs, nls, plus, quals, nls)
+    else:
+        recs = itertools.izip(heads, seqs, plus, quals)
+    return "".join(itertools.chain.from_iterable(recs))
+
+
+
+## Sharded output for blockmatch(). Samples are split into shards and each
+## shard is served by a single writer process on the head node which
+## appends gzip members directly to the final fastq.gz files. Engines reach
+## the shard queues through a manager listening on the head node, so reads
+## are compressed once and written once, and no collate pass is needed.
+_SHARD_QUEUES = {}
+
+def _get_shard_queue(shard):
+    """ returns the queue for a shard, is only called in the server """
+    if shard not in _SHARD_QUEUES:
+        _SHARD_QUEUES[shard] = Queue.Queue(maxsize=SHARD_QUEUE_SIZE)
+    return _SHARD_QUEUES[shard]
+
+
+
+class ShardManager(BaseManager):
+    """ serves the shard queues to engines and shard writers """
+    pass
+
+ShardManager.register("get_shard_queue", callable=_get_shard_queue)
+
+
+
+def gzip_member(block, level=6):
+    """ compress a string into a single self-contained gzip member """
+    comp = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return comp.compress(block) + comp.flush()
+
+
+
+def start_shard_writers(data, nshards):
+    """
+    Starts the shard queue manager and one writer process per shard on the
+    head node. Returns the manager, writer processes, and the shards tuple
+    (address, authkey, nshards, shardmap) that is passed to engines.
+    """
+    ## samples are assigned to shards in sorted order
+    snames = sorted(set([i.rsplit("-technical-replicate", 1)[0] \
+                         for i in data.barcodes]))
+    shardmap = {sname: idx % nshards for idx, sname in enumerate(snames)}
+
+    ## listen on all interfaces so engines on other hosts can connect
+    authkey = os.urandom(16)
+    manager = ShardManager(address=("", 0), authkey=authkey)
+    manager.start()
+    address = (socket.gethostname(), manager.address[1])
+
+    ## create the queues before anyone else connects
+    for shard in xrange(nshards):
+        manager.get_shard_queue(shard)
+
+    writers = []
+    for shard in xrange(nshards):
+        ssnames = [i for i in snames if shardmap[i] == shard]
+        args = (data.dirs.fastqs, data.paramsdict["datatype"],
+                address, authkey, shard, ssnames)
+        proc = mp.Process(target=shard_writer, args=args)
+        proc.daemon = True
+        proc.start()
+        writers.append(proc)
+
+    return manager, writers, (address, authkey, nshards, shardmap)
+
+
+
+def stop_shard_writers(shardinfo, kill=False):
+    """
+    Sends a stop signal to each shard writer and waits for them to finish
+    writing, or kills them if kill. Then shuts down the manager.
+    """
+    manager, writers, shards = shardinfo
+    try:
+        if kill:
+            for proc in writers:
+                proc.terminate()
+        else:
+            for shard in xrange(shards[2]):
+                manager.get_shard_queue(shard).put(None)
+            for proc in writers:
+                proc.join()
+                if proc.exitcode:
+                    raise IPyradWarningExit(SHARD_WRITER_FAILED)
+    finally:
+        manager.shutdown()
+
+
+
+def shard_writer(fastqdir, datatype, address, authkey, shard, snames):
+    """
+    Runs in a writer process on the head node. Truncates the output files
+    of its samples and then appends compressed blocks from its queue until
+    it receives None.
+    """
+    manager = ShardManager(address=address, authkey=authkey)
+    manager.connect()
+    queue = manager.get_shard_queue(shard)
+
+    ## open final outfiles, starting each with an empty member
+    reads = [1, 2] if 'pair' in datatype else [1]
+    outs = {}
+    for sname in snames:
+        for read in reads:
+            handle = os.path.join(fastqdir, 
+                "{}_R{}_.fastq.gz".format(sname, read))
+            outs[(sname, read)] = open(handle, 'wb')
+            outs[(sname, read)].write(gzip_member(""))
+
+    try:
+        while 1:
+            item = queue.get()
+            if item is None:
+                break
+            sname, read, block = item
+            outs[(sname, read)].write(block)
+    finally:
+        for out in outs.values():
+            out.close()
+
+
+
+def get_shard_pusher(shards):
+    """
+    Connects an engine to the shard queues and returns a func with the same
+    call signature as writetofile() minus data and pid, which compresses
+    each sample's block and pushes it to the writer of that sample's shard.
+    """
+    address, authkey, nshards, shardmap = shards
+    manager = ShardManager(address=address, authkey=authkey)
+    manager.connect()
+    queues = [manager.get_shard_queue(i) for i in xrange(nshards)]
+
+    def pushtoshards(dsort, read):
+        """ compress and push non-empty blocks """
+        for sname in dsort:
+            block = "".join(dsort[sname])
+            if block:
+                queues[shardmap[sname]].put((sname, read, gzip_member(block)))
+    return pushtoshards
+
+
+
 def writetofastq(data, dsort, read):
     """ 
     Writes sorted data 'dsort dict' to a tmp files
@@ -800,8 +1236,10 @@ def prechecks2(data, force):
     cutters = [ambigcutters(i) for i in data.paramsdict["restriction_overhang"]]
     assert cutters, "Must enter a `restriction_overhang` for demultiplexing."
 
-    ## get matchdict
-    matchdict = inverse_barcodes(data)
+    ## get the barcode index, blockmatch uses it directly as matchdict
+    matchdict = get_barcode_index(data)
+    if data._hackersonly["demultiplex_engine"] != "block":
+        matchdict = matchdict.to_matchdict()
 
     ## return all
     return raws, longbar, cutters, matchdict
@@ -809,66 +1247,257 @@ def prechecks2(data, force):
 
 
 def inverse_barcodes(data):
-    """ Build full inverse barcodes dictionary """
+    """ 
+    Build full inverse barcodes dictionary, mapping every barcode and each
+    sequence within max_barcode_mismatch of it to its sample name. 
+    """
+    return get_barcode_index(data).to_matchdict()
 
-    matchdict = {}
-    bases = set("CATGN")
-    poss = set()
 
-    ## do perfect matches
-    for sname, barc in data.barcodes.items():
-        ## remove -technical-replicate-N if present
-        if "-technical-replicate-" in sname:
-            sname = sname.rsplit("-technical-replicate", 1)[0]
-        matchdict[barc] = sname
-        poss.add(barc)
 
-        if data.paramsdict["max_barcode_mismatch"] > 0:
-            ## get 1-base diffs
-            for idx1, base in enumerate(barc):
-                diffs = bases.difference(base)
-                for diff in diffs:
-                    lbar = list(barc)
-                    lbar[idx1] = diff
-                    tbar1 = "".join(lbar)
-                    if tbar1 not in poss:
-                        matchdict[tbar1] = sname                    
-                        poss.add(tbar1)
-                    else:
-                        if matchdict.get(tbar1) != sname:
-                            print("""\
-        Note: barcodes {}:{} and {}:{} are within {} base change of each other
-            Ambiguous barcodes that match to both samples will arbitrarily
-            be assigned to the first sample. If you do not like this idea 
-            then lower the value of max_barcode_mismatch and rerun step 1\n"""\
-        .format(sname, barc, 
-                matchdict[tbar1], data.barcodes[matchdict[tbar1]],
-                data.paramsdict["max_barcode_mismatch"]))
+## Packed barcode index ------------------------------------------------------
+## Barcodes are packed into integers using 3 bits per symbol so that N and
+## the '+' joining 3rad barcodes are represented, and so that the length of
+## a barcode is implicit (no symbol is 0). Up to 21 symbols fit in a uint64.
+BARCODE_SYMBOLS = np.zeros(256, dtype=np.uint64) + 7
+BARCODE_SYMBOLS[0] = 0
+for _idx, _base in enumerate("ACGTN+"):
+    BARCODE_SYMBOLS[ord(_base)] = _idx + 1
+MAX_BARCODE_SYMBOLS = 21
+
+
+
+def pack_barcodes(mat):
+    """ 
+    Packs a (nbarcodes, width) uint8 array of zero padded barcodes into
+    uint64 keys. Unknown characters pack to a symbol that is never in 
+    the index.
+    """
+    return pack_symbols(BARCODE_SYMBOLS[mat])
+
+
+
+def pack_symbols(syms):
+    """ 
+    Packs a (nbarcodes, width) uint64 array of symbols into uint64 keys.
+    Zeros (padding) anywhere in a row are skipped.
+    """
+    nonzero = (syms > 0).astype(np.uint64)
+    ## number of symbols after each position sets its shift
+    after = np.cumsum(nonzero[:, ::-1], axis=1)[:, ::-1] - nonzero
+    return np.bitwise_or.reduce(syms << (np.uint64(3) * after), axis=1)
+
+
+
+def unpack_barcode(key):
+    """ returns the barcode string for a packed key """
+    key = int(key)
+    barc = []
+    while key:
+        barc.append("ACGTN+"[(key & 7) - 1])
+        key >>= 3
+    return "".join(barc[::-1])
+
+
+
+class BarcodeIndex(object):
+    """
+    A sorted inverse barcode index stored as a .npy file (packed key, 
+    sample index, mismatch distance) and a .json sidecar (sample names,
+    checksum, collisions). The arrays are memory-mapped read-only, and 
+    pickling the index sends only its path, so engines share one copy.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path + ".json", 'r') as infile:
+            meta = json.load(infile)
+        self.snames = [str(i) for i in meta["snames"]]
+        self.checksum = meta["checksum"]
+        self.collisions = meta["collisions"]
+        arr = np.load(path + ".npy", mmap_mode="r")
+        self.keys = arr["key"]
+        self.sidx = arr["sidx"]
+        self.dist = arr["dist"]
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def __len__(self):
+        return self.keys.shape[0]
+
+    def lookup(self, keys):
+        """ returns the index position of each key, or -1 if not present """
+        kidx = np.searchsorted(self.keys, keys)
+        kidx[kidx == self.keys.shape[0]] = 0
+        kidx[self.keys[kidx] != keys] = -1
+        return kidx
+
+    def to_matchdict(self):
+        """ returns a dict mapping each barcode string to a sample name """
+        return {unpack_barcode(key): self.snames[sidx] for key, sidx \
+                in itertools.izip(self.keys, self.sidx)}
+
+
+
+def barcode_index_checksum(data):
+    """
+    checksum of the barcodes, in order since ties resolve to the first,
+    and the settings that define an index
+    """
+    hasher = hashlib.md5()
+    hasher.update(json.dumps([data.barcodes.items(),
+                  data.paramsdict["max_barcode_mismatch"]]))
+    return hasher.hexdigest()
+
+
+
+def get_barcode_index(data):
+    """
+    Returns the BarcodeIndex for data, loading it from next to the barcodes
+    file if one exists for the same barcodes and max_barcode_mismatch, 
+    else building and saving it there (or in the fastqs dir if the barcodes
+    dir is not writable). Collisions are written to the fastqs dir.
+    """
+    checksum = barcode_index_checksum(data)
+    paths = []
+    if data.paramsdict["barcodes_path"]:
+        paths.append(data.paramsdict["barcodes_path"] + ".idx")
+    if data.dirs.fastqs:
+        paths.append(os.path.join(data.dirs.fastqs, "barcodes.idx"))
+
+    index = None
+    for path in paths:
+        try:
+            index = BarcodeIndex(path)
+        except (IOError, OSError, ValueError, KeyError):
+            continue
+        if index.checksum == checksum:
+            break
+        index = None
+
+    if not index:
+        for path in paths:
+            try:
+                build_barcode_index(data, path, checksum)
+                index = BarcodeIndex(path)
+                break
+            except (IOError, OSError):
+                LOGGER.info("could not write barcode index to %s", path)
+        else:
+            raise IPyradWarningExit(NO_BARCODE_INDEX.format(paths))
+
+    ## report collisions
+    if index.collisions:
+        if data.dirs.fastqs:
+            handle = os.path.join(data.dirs.fastqs, "s1_barcode_collisions.txt")
+            with open(handle, 'w') as out:
+                out.write("{:<25} {:>25} {:<25} {:>25} {:>10} {:>10}\n"\
+                    .format("assigned_sample", "assigned_barcode",
+                            "other_sample", "other_barcode", 
+                            "distance", "n_shared"))
+                for row in index.collisions:
+                    out.write("{:<25} {:>25} {:<25} {:>25} {:>10} {:>10}\n"\
+                              .format(*row))
+        print(BARCODE_COLLISIONS.format(
+            len(index.collisions), data.paramsdict["max_barcode_mismatch"],
+            data._spacer))
+    return index
+
+
+
+def build_barcode_index(data, path, checksum):
+    """
+    Enumerates the mismatch neighborhood of every barcode with numpy, packs
+    it, and resolves sequences shared by barcodes of different samples to
+    the closest barcode, or if tied to the first in data.barcodes (the
+    order of the barcodes file). Writes the sorted index to path.npy and
+    path.json.
+    """
+    maxmis = data.paramsdict["max_barcode_mismatch"]
+    snames = sorted(set([i.rsplit("-technical-replicate", 1)[0] \
+                         for i in data.barcodes]))
+    allkeys = []
+    allsidx = []
+    alldist = []
+    allbidx = []
+    barcs = []
+    for bidx, (sname, barc) in enumerate(data.barcodes.items()):
+        if len(barc) > MAX_BARCODE_SYMBOLS:
+            raise IPyradWarningExit(BARCODE_TOO_LONG.format(barc))
+        base = BARCODE_SYMBOLS[np.frombuffer(barc, dtype=np.uint8)]
+        if any(base == 7):
+            raise IPyradWarningExit(BAD_BARCODE.format(sname, barc))
+        sname = sname.rsplit("-technical-replicate", 1)[0]
+        barcs.append((sname, barc))
+
+        ## positions that can mutate, i.e., not the 3rad '+'
+        mutable = np.where(base < 6)[0]
+        for ndiffs in xrange(maxmis + 1):
+            combs = list(itertools.combinations(mutable, ndiffs))
+            combs = np.array(combs, dtype=np.int64)\
+                      .reshape(len(combs), ndiffs)
+            ## each changed position takes any of the other 4 of ACGTN
+            shifts = list(itertools.product(range(1, 5), repeat=ndiffs))
+            shifts = np.array(shifts, dtype=np.uint64)\
+                       .reshape(len(shifts), ndiffs)
+            nvars = combs.shape[0] * shifts.shape[0]
+            variants = np.repeat(base[None, :], nvars, axis=0)
+            rows = np.arange(nvars)
+            for col in xrange(ndiffs):
+                pos = np.repeat(combs[:, col], shifts.shape[0])
+                shift = np.tile(shifts[:, col], combs.shape[0])
+                variants[rows, pos] = \
+                    (variants[rows, pos] - 1 + shift) % np.uint64(5) + 1
+            allkeys.append(pack_symbols(variants))
+            allsidx.append(np.zeros(nvars, dtype=np.int32) + \
+                           snames.index(sname))
+            alldist.append(np.zeros(nvars, dtype=np.int8) + ndiffs)
+            allbidx.append(np.zeros(nvars, dtype=np.int32) + bidx)
+
+    keys = np.concatenate(allkeys)
+    sidx = np.concatenate(allsidx)
+    dist = np.concatenate(alldist)
+    bidx = np.concatenate(allbidx)
+
+    ## sort by key, then distance, then barcode order; the first of each
+    ## key is the one it resolves to
+    order = np.lexsort((bidx, dist, keys))
+    keys, sidx, dist, bidx = keys[order], sidx[order], dist[order], bidx[order]
+    first = np.ones(keys.shape[0], dtype=np.bool_)
+    first[1:] = keys[1:] != keys[:-1]
+    winner = np.maximum.accumulate(np.where(first, np.arange(keys.shape[0]), 0))
+
+    ## collisions are keys shared with a barcode of another sample
+    clash = sidx != sidx[winner]
+    pairs = Counter(zip(bidx[winner][clash], bidx[clash]))
+    collisions = []
+    for (wbidx, obidx), nshared in sorted(pairs.items()):
+        wname, wbarc = barcs[wbidx]
+        oname, obarc = barcs[obidx]
+        if len(wbarc) == len(obarc):
+            distance = sum([i != j for i, j in zip(wbarc, obarc)])
+        else:
+            distance = "NA"
+        collisions.append((wname, wbarc, oname, obarc, distance, nshared))
+
+    ## write atomically so concurrent runs never read a partial index
+    arr = np.zeros(int(first.sum()), dtype=[("key", np.uint64), 
+                   ("sidx", np.int32), ("dist", np.int8)])
+    arr["key"] = keys[first]
+    arr["sidx"] = sidx[first]
+    arr["dist"] = dist[first]
+    tmppath = "{}.tmp{}".format(path, os.getpid())
+    with open(tmppath + ".npy", 'wb') as out:
+        np.save(out, arr)
+    with open(tmppath + ".json", 'w') as out:
+        json.dump({"snames": snames, "checksum": checksum, 
+                   "collisions": collisions}, out)
+    os.rename(tmppath + ".npy", path + ".npy")
+    os.rename(tmppath + ".json", path + ".json")
 
-                ## if allowing two base difference things get big
-                ## for each modified bar, allow one modification to other bases
-                if data.paramsdict["max_barcode_mismatch"] > 1:
-                    for idx2, _ in enumerate(tbar1):
-                        ## skip the base that is already modified
-                        if idx2 != idx1:
-                            for diff in bases.difference(tbar1[idx2]):
-                                ltbar = list(tbar1)
-                                ltbar[idx2] = diff
-                                tbar2 = "".join(ltbar)
-                                if tbar2 not in poss:
-                                    matchdict[tbar2] = sname                    
-                                    poss.add(tbar2)
-                                else:
-                                    if matchdict.get(tbar2) != sname:
-                                        print("""\
-        Note: barcodes {}:{} and {}:{} are within {} base change of each other\
-             Ambiguous barcodes that match to both samples will arbitrarily
-             be assigned to the first sample. If you do not like this idea 
-             then lower the value of max_barcode_mismatch and rerun step 1\n"""\
-        .format(sname, barc, 
-                            matchdict[tbar2], data.barcodes[matchdict[tbar2]],
-                            data.paramsdict["max_barcode_mismatch"]))
-    return matchdict
 
 
 ## DEPRECATED for prechecks2
@@ -1088,15 +1717,26 @@ def run2(data, ipyclient, force):
 
     ## wrap funcs to ensure we can kill tmpfiles
     kbd = 0
+    shardinfo = None
     try:
         ## if splitting files, split files into smaller chunks for demuxing
         chunkfiles = splitfiles(data, raws, ipyclient)
 
+        ## block engine can write directly to final files through writers
+        nshards = data._hackersonly["demultiplex_writers"]
+        if nshards and data._hackersonly["demultiplex_engine"] == "block":
+            shardinfo = start_shard_writers(data, nshards)
+
         ## send chunks to be demux'd
-        statdicts = demux2(data, chunkfiles, cutters, longbar, matchdict, ipyclient)
+        statdicts = demux2(data, chunkfiles, cutters, longbar, matchdict, 
+                           ipyclient, shardinfo)
 
-        ## concat tmp files
-        concat_chunks(data, ipyclient)
+        ## finish writing or concat tmp files
+        if shardinfo:
+            stop_shard_writers(shardinfo)
+            shardinfo = None
+        else:
+            concat_chunks(data, ipyclient)
 
         ## build stats from dictionaries
         perfile, fsamplehits, fbarhits, fmisses, fdbars = statdicts    
@@ -1109,6 +1749,10 @@ def run2(data, ipyclient, force):
 
     ## cleanup
     finally:
+        ## kill shard writers if we did not finish
+        if shardinfo:
+            stop_shard_writers(shardinfo, kill=True)
+
         ## cleaning up the tmpdir is safe from ipyclient
         tmpdir = os.path.join(data.paramsdict["project_dir"], "tmp-chunks-"+data.name)
         if os.path.exists(tmpdir):
@@ -1220,6 +1864,11 @@ def splitfiles(data, raws, ipyclient):
         ## if number of lines is > 20M then just submit it
         if nosplit:
             chunkfiles[handle] = [tups]
+        elif all([raw_format(i) != "gzip" for i in tups if i]):
+            ## bgzf or uncompressed files are split into ranges of records
+            ## that engines read directly, no tmp chunk files are written.
+            chunklist = range_chunks(data, tups, ipyclient, optim, start)
+            chunkfiles[handle] = chunklist
         else:
             ## chunk the file using zcat_make_temps
             chunklist = zcat_make_temps(data, tups, fidx, tmpdir, optim, njobs, start)
@@ -1276,7 +1925,9 @@ def concat_chunks(data, ipyclient):
     for sname in set(snames):
         tmp1s = sorted(r1dict[sname])
         tmp2s = sorted(r2dict[sname])
-        writers.append(lbview.apply(collate_files, *[data, sname, tmp1s, tmp2s]))
+        writers.append(lbview.apply(
+            profiled(data, collate_files, "writing/compressing", sname),
+            *[data, sname, tmp1s, tmp2s]))
 
     total = len(writers)
     while 1:
@@ -1435,10 +2086,12 @@ def demux3(data, raws, cutters, longbar, matchdict):
                      
 
 
-def demux2(data, chunkfiles, cutters, longbar, matchdict, ipyclient):
+def demux2(data, chunkfiles, cutters, longbar, matchdict, ipyclient,
+    shardinfo=None):
     """ 
     Submit chunks to be sorted by the barmatch() function then 
-    calls putstats().
+    calls putstats(). If shardinfo is set the blockmatch() jobs push
+    their output to the shard writers.
     """
 
     ## parallel stuff, limit to 1/4 of available cores for RAM limits.
@@ -1446,6 +2099,12 @@ def demux2(data, chunkfiles, cutters, longbar, matchdict, ipyclient):
     printstr = ' sorting reads         | {} | s1 |'
     lbview = ipyclient.load_balanced_view(targets=ipyclient.ids[::4])
 
+    ## select the barcode matching engine
+    if data._hackersonly["demultiplex_engine"] == "block":
+        matchfunc = blockmatch
+    else:
+        matchfunc = barmatch
+
     ## store statcounters and async results in dicts
     perfile = {}
     filesort = {}
@@ -1460,9 +2119,11 @@ def demux2(data, chunkfiles, cutters, longbar, matchdict, ipyclient):
         for fidx, rawtuple in enumerate(rawtuplist):
             #handle = os.path.splitext(os.path.basename(rawtuple[0]))[0]
             args = (data, rawtuple, cutters, longbar, matchdict, fidx)
+            if shardinfo:
+                args += (shardinfo[2],)
 
             ## submit the job
-            async = lbview.apply(barmatch, *args)
+            async = lbview.apply(matchfunc, *args)
             filesort[total] = (handle, async)
             total += 1
 
@@ -1490,6 +2151,11 @@ def demux2(data, chunkfiles, cutters, longbar, matchdict, ipyclient):
             print("")
             break
 
+        ## engines would block forever if a shard writer died
+        if shardinfo:
+            if any([i.exitcode for i in shardinfo[1]]):
+                raise IPyradWarningExit(SHARD_WRITER_FAILED)
+
         ## cleanup
         for key in fin:
             tup = filesort[key]
@@ -1526,7 +2192,8 @@ def demux(data, chunkfiles, cutters, longbar, matchdict, ipyclient):
             args = (data, rawtuple, cutters, longbar, matchdict, fidx)
 
             ## submit the job
-            filesort[handle] = lbview.apply(barmatch, *args)
+            filesort[handle] = lbview.apply(
+                profiled(data, barmatch, "sorting reads"), *args)
 
             ## get ready to receive stats: 'total', 'cutfound', 'matched'
             perfile[handle] = np.zeros(3, dtype=np.int)
@@ -1613,7 +2280,8 @@ def demux(data, chunkfiles, cutters, longbar, matchdict, ipyclient):
         for sname in data.barcodes:
             tmp1s = sorted(r1dict[sname])
             tmp2s = sorted(r2dict[sname])
-            writers.append(lbview.apply(collate_files, 
+            writers.append(lbview.apply(
+                           profiled(data, collate_files, "writing/compressing", sname),
                            *[data, sname, tmp1s, tmp2s]))
         
         ## track progress of collate jobs
@@ -1757,7 +2425,8 @@ def wrapped_run(data, preview, ipyclient, force):
         for tups in tuplist:
             LOGGER.info("tups %s", tups)
             args = [data, tups, cutters, longbar, matchdict, fidx]
-            filesort[fidx].append(tiny.apply(barmatch, *args))
+            filesort[fidx].append(tiny.apply(
+                profiled(data, barmatch, "sorting reads"), *args))
 
     ########################################
     ## collect finished results as they come
@@ -1825,7 +2494,9 @@ def wrapped_run(data, preview, ipyclient, force):
     for sname in data.barcodes:
         tmp1s = sorted(r1dict[sname])
         tmp2s = sorted(r2dict[sname])
-        writers.append(tiny.apply(collate_files, *[data, sname, tmp1s, tmp2s]))
+        writers.append(tiny.apply(
+            profiled(data, collate_files, "writing/compressing", sname),
+            *[data, sname, tmp1s, tmp2s]))
 
     while 1:
         ready = [i.ready() for i in writers]
@@ -1875,11 +2546,216 @@ def putstats(pfile, handle, statdicts):
 
 
 ## used by splitfiles()
+def raw_format(path):
+    """ 
+    Returns 'bgzf' for blocked gzip files (bgzip), 'gzip' for other .gz
+    files, and 'plain' for uncompressed files.
+    """
+    if not path.endswith(".gz"):
+        return "plain"
+    with open(path, 'rb') as infile:
+        head = infile.read(12)
+        if len(head) < 12 or head[:4] != "\x1f\x8b\x08\x04":
+            return "gzip"
+        xlen = struct.unpack("<H", head[10:12])[0]
+        if bgzf_bsize(infile.read(xlen)):
+            return "bgzf"
+    return "gzip"
+
+
+
+def bgzf_bsize(extra):
+    """ returns the total block size from a gzip extra field, or 0 """
+    idx = 0
+    while idx + 4 <= len(extra):
+        slen = struct.unpack("<H", extra[idx+2:idx+4])[0]
+        if extra[idx:idx+2] == "BC" and slen == 2:
+            return struct.unpack("<H", extra[idx+4:idx+6])[0] + 1
+        idx += 4 + slen
+    return 0
+
+
+
+def block_offsets(path, fmt):
+    """
+    Returns an array of the starting byte offset of each block in a file.
+    For bgzf these are read from block headers without decompressing, 
+    for plain files blocks are fixed-size byte ranges.
+    """
+    if fmt == "plain":
+        return np.arange(0, os.path.getsize(path), RAW_BLOCK_SIZE, 
+                         dtype=np.int64)
+
+    offsets = []
+    offset = 0
+    with open(path, 'rb') as infile:
+        while 1:
+            head = infile.read(12)
+            if len(head) < 12:
+                break
+            xlen = struct.unpack("<H", head[10:12])[0]
+            bsize = bgzf_bsize(infile.read(xlen))
+            if not bsize:
+                raise IPyradWarningExit(BAD_BGZF.format(path))
+            offsets.append(offset)
+            offset += bsize
+            infile.seek(offset)
+    return np.array(offsets, dtype=np.int64)
+
+
+
+def read_raw_block(infile, fmt):
+    """ returns the next (decompressed) block from infile, or None at EOF """
+    if fmt == "plain":
+        return infile.read(RAW_BLOCK_SIZE) or None
+    head = infile.read(12)
+    if len(head) < 12:
+        return None
+    xlen = struct.unpack("<H", head[10:12])[0]
+    extra = infile.read(xlen)
+    cdata = infile.read(bgzf_bsize(extra) - 12 - xlen)
+    return zlib.decompress(cdata[:-8], -15)
+
+
+
+def count_block_lines(path, fmt, offset, nblocks):
+    """ 
+    Run on engines. Decompresses nblocks blocks starting at offset and
+    returns the number of newlines in each. 
+    """
+    counts = np.zeros(nblocks, dtype=np.int64)
+    with open(path, 'rb') as infile:
+        infile.seek(offset)
+        for bidx in xrange(nblocks):
+            counts[bidx] = read_raw_block(infile, fmt).count("\n")
+    return counts
+
+
+
+def iter_range_lines(path, fmt, offset, skip, nlines):
+    """
+    Generator that yields nlines lines of a bgzf or plain file starting
+    after the skip'th newline of the block that starts at offset.
+    """
+    with open(path, 'rb') as infile:
+        infile.seek(offset)
+        tail = ""
+        first = True
+        while nlines > 0:
+            block = read_raw_block(infile, fmt)
+            if block is None:
+                ## last line of the file may not end in a newline
+                if tail:
+                    yield tail
+                break
+            if first:
+                first = False
+                pos = -1
+                for _ in xrange(skip):
+                    pos = block.index("\n", pos + 1)
+                block = block[pos + 1:]
+            lines = (tail + block).splitlines(True)
+            tail = ""
+            if lines and not lines[-1].endswith("\n"):
+                tail = lines.pop()
+            for line in lines[:nlines]:
+                yield line
+            nlines -= len(lines)
+
+
+
+def open_chunk(spec):
+    """
+    Returns an iterable of lines with a close() method for a raw file path
+    or for a record range (path, fmt, offset, skip, nlines) of a file from
+    range_chunks().
+    """
+    if isinstance(spec, tuple):
+        return iter_range_lines(*spec)
+    if spec.endswith(".gz"):
+        return gzip.open(spec, 'r')
+    return open(spec, 'r')
+
+
+
+def range_chunks(data, tups, ipyclient, optim, start):
+    """
+    Splits bgzf or uncompressed files into ranges of optim lines without
+    writing chunk files. Engines count the newlines in each block in 
+    parallel, and the start of each range is then located as a block offset
+    and the number of newlines to skip in that block. R1 and R2 are split
+    at the same record indices so pairs stay together.
+    """
+    printstr = ' chunking large files  | {} | s1 |'
+    lbview = ipyclient.load_balanced_view()
+
+    ## send groups of blocks to be counted
+    tables = []
+    for path in [i for i in tups if i]:
+        fmt = raw_format(path)
+        offsets = block_offsets(path, fmt)
+        groups = np.array_split(np.arange(offsets.shape[0]), len(ipyclient))
+        asyncs = [lbview.apply(count_block_lines, 
+                               *(path, fmt, offsets[i[0]], i.shape[0]))
+                  for i in groups if i.shape[0]]
+        tables.append((path, fmt, offsets, asyncs))
+
+    ## track progress
+    alljobs = [i for j in tables for i in j[3]]
+    while 1:
+        ready = [i.ready() for i in alljobs]
+        elapsed = datetime.timedelta(seconds=int(time.time()-start))
+        progressbar(len(ready), sum(ready), 
+                    printstr.format(elapsed), spacer=data._spacer)
+        time.sleep(0.1)
+        if all(ready):
+            break
+    for job in alljobs:
+        if not job.successful():
+            raise IPyradWarningExit(job.exception())
+
+    ## cumulative newlines through each block for each file
+    cumlines = []
+    for path, fmt, offsets, asyncs in tables:
+        counts = np.concatenate([[0]] + [i.get() for i in asyncs])
+        cumlines.append(np.cumsum(counts[1:]))
+
+    ## allow a missing newline at the end of the file
+    totals = []
+    for cum in cumlines:
+        total = int(cum[-1]) if cum.shape[0] else 0
+        if total % 4 == 3:
+            total += 1
+        totals.append(total)
+    if len(set(totals)) > 1:
+        raise IPyradWarningExit("R1 and R2 files are not the same length.")
+
+    ## locate the start of each range of optim lines in each file
+    chunks = []
+    for lstart in xrange(0, totals[0], optim):
+        nlines = min(optim, totals[0] - lstart)
+        specs = []
+        for (path, fmt, offsets, _), cum in zip(tables, cumlines):
+            if not lstart:
+                specs.append((path, fmt, 0, 0, nlines))
+            else:
+                ## block containing the lstart'th newline
+                bidx = int(np.searchsorted(cum, lstart))
+                skip = lstart - (int(cum[bidx - 1]) if bidx else 0)
+                specs.append((path, fmt, int(offsets[bidx]), skip, nlines))
+        if len(specs) == 1:
+            specs.append(0)
+        chunks.append(tuple(specs))
+    return chunks
+
+
+
 def zcat_make_temps(data, raws, num, tmpdir, optim, njobs, start):
     """ 
     Call bash command 'cat' and 'split' to split large files. The goal
     is to create N splitfiles where N is a multiple of the number of processors
-    so that each processor can work on a file in parallel.
+    so that each processor can work on a file in parallel. R1 and R2 files
+    are decompressed and split at the same time.
     """
 
     printstr = ' chunking large files  | {} | s1 |'
@@ -1903,64 +2779,48 @@ def zcat_make_temps(data, raws, num, tmpdir, optim, njobs, start):
     cmd4 = ["split", "-a", "4", "-l", str(int(optim)), "-", 
             os.path.join(tmpdir, "chunk2_"+str(num)+"_")]
 
-    ### run splitter
-    proc1 = sps.Popen(cmd1, stderr=sps.STDOUT, stdout=sps.PIPE)
-    proc3 = sps.Popen(cmd3, stderr=sps.STDOUT, stdout=sps.PIPE, stdin=proc1.stdout)
+    ### run splitters, both reads at once if paired
+    pipes = [(cmd1, cmd3)]
+    if "pair" in data.paramsdict["datatype"]:
+        pipes.append((cmd2, cmd4))
+    procs = []
+    for catc, splitc in pipes:
+        proc1 = sps.Popen(catc, stderr=sps.STDOUT, stdout=sps.PIPE)
+        proc2 = sps.Popen(splitc, stderr=sps.STDOUT, stdout=sps.PIPE, 
+                          stdin=proc1.stdout)
+        ## allow proc1 to receive SIGPIPE if proc2 exits
+        proc1.stdout.close()
+        procs.append((proc1, proc2))
 
     ## wrap the actual call so we can kill it if anything goes awry
     while 1:
         try:
-            if not isinstance(proc3.poll(), int):
-                elapsed = datetime.timedelta(seconds=int(time.time()-start))
+            elapsed = datetime.timedelta(seconds=int(time.time()-start))
+            if not all([isinstance(i[1].poll(), int) for i in procs]):
                 done = len(glob.glob(os.path.join(tmpdir, 'chunk1_*')))
                 progressbar(njobs, min(njobs, done), printstr.format(elapsed), spacer=data._spacer)
                 time.sleep(0.1)
             else:
-                res = proc3.communicate()[0]
-                proc1.stdout.close()
                 break
 
         except KeyboardInterrupt:
-            proc1.kill()
-            proc3.kill()
+            for proc1, proc2 in procs:
+                proc1.kill()
+                proc2.kill()
             raise KeyboardInterrupt()
 
-    if proc3.returncode:
-        raise IPyradWarningExit(" error in %s: %s", cmd3, res)
+    for (proc1, proc2), (_, splitc) in zip(procs, pipes):
+        res = proc2.communicate()[0]
+        proc1.wait()
+        if proc2.returncode:
+            raise IPyradWarningExit(" error in %s: %s", splitc, res)
 
     ## grab output handles
     chunks1 = glob.glob(os.path.join(tmpdir, "chunk1_"+str(num)+"_*"))
     chunks1.sort()
-
     if "pair" in data.paramsdict["datatype"]:
-        proc2 = sps.Popen(cmd2, stderr=sps.STDOUT, stdout=sps.PIPE)
-        proc4 = sps.Popen(cmd4, stderr=sps.STDOUT, stdout=sps.PIPE, stdin=proc2.stdout)
-
-        ## wrap the actual call so we can kill it if anything goes awry
-        while 1:
-            try:
-                if not isinstance(proc4.poll(), int):
-                    elapsed = datetime.timedelta(seconds=int(time.time()-start))
-                    done = len(glob.glob(os.path.join(tmpdir, 'chunk1_*')))
-                    progressbar(njobs, min(njobs, done), printstr.format(elapsed), data._spacer)
-                    time.sleep(0.1)
-                else:
-                    res = proc4.communicate()[0]
-                    proc2.stdout.close()
-                    break
-
-            except KeyboardInterrupt:
-                proc2.kill()
-                proc4.kill()
-                raise KeyboardInterrupt()
-
-        if proc4.returncode:
-            raise IPyradWarningExit(" error in %s: %s", cmd4, res)
-
-        ## grab output handles
         chunks2 = glob.glob(os.path.join(tmpdir, "chunk2_"+str(num)+"_*"))
         chunks2.sort()
-    
     else:
         chunks2 = [0]*len(chunks1)
 
@@ -1982,6 +2842,43 @@ NO_RAWS = """\
     No data found in {}. Fix path to data files.
     """
 
+SHARD_WRITER_FAILED = """\
+    A step 1 shard writer process exited with an error. Set the hackersonly
+    parameter demultiplex_writers to 0 to use tmp files instead.
+    """
+
+## max compressed blocks waiting in each shard queue before engines block
+SHARD_QUEUE_SIZE = 64
+
+BARCODE_TOO_LONG = """\
+    Barcode {} is too long. Barcodes can have at most 21 characters,
+    including the '+' that joins 3rad barcodes.
+    """
+
+BAD_BARCODE = """\
+    Barcode for sample {} contains characters other than ACGTN: {}
+    """
+
+NO_BARCODE_INDEX = """\
+    Could not write barcode index to any of: {}
+    """
+
+BARCODE_COLLISIONS = """\
+{2}Note: {0} pairs of barcodes from different samples are within {1} base 
+{2}changes of a shared sequence. Shared sequences are assigned to the closest
+{2}barcode, or if tied to the one listed first in the barcodes file, see
+{2}s1_barcode_collisions.txt.
+{2}If you do not like this idea then lower the value of max_barcode_mismatch
+{2}and rerun step 1.
+"""
+
+BAD_BGZF = """\
+    Could not read bgzf block header in {}. The file may be truncated.
+    """
+
+## size of the byte ranges that uncompressed raw files are split into
+RAW_BLOCK_SIZE = int(2**22)
+
 OVERWRITING_FASTQS = """\
 {spacer}[force] overwriting fastq files previously created by ipyrad.
 {spacer}This _does not_ affect your original/raw data files."""
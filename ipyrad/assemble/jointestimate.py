@@ -5,20 +5,21 @@
 from __future__ import print_function
 
 import scipy.stats
+import scipy.special
 import scipy.optimize
 import numpy as np
 import numba
 import itertools
 import datetime
 import time
-import gzip
 import io
 import os
 
 from ipyrad.assemble.cluster_within import get_quick_depths
+from ipyrad.assemble.clustfile import iter_clusters
 
-from collections import Counter
 from util import *
+from profiler import profiled
 
 
 # pylint: disable=E1101
@@ -28,112 +29,151 @@ from util import *
 
 
 
-def likelihood1(errors, bfreqs, ustacks):
+def unique_stacks(stacks, counts=None):
     """
-    Probability homozygous. """
-    ## make sure base_frequencies are in the right order
-    #print uniqstackl.sum()-uniqstack, uniqstackl.sum(), 0.001
-    #totals = np.array([ustacks.sum(axis=1)]*4).T
-    totals = np.array([ustacks.sum(axis=1)]*4).T
-    prob = scipy.stats.binom.pmf(totals-ustacks, totals, errors)
-    lik1 = np.sum(bfreqs*prob, axis=1)
-    return lik1
+    Returns the unique rows of an array (nsites, 4) of CATG base counts and
+    the number of sites with each pattern. Rows are compared as single void
+    records (sorted bytewise, much faster than a view with a field per base),
+    and counts (if any) weight each row, so that the unique patterns of
+    several blocks of sites can be merged again.
+    """
+    stacks = np.ascontiguousarray(stacks, dtype=np.uint64)
+    if counts is None:
+        counts = np.ones(stacks.shape[0], dtype=np.uint64)
+    records = stacks.view(np.dtype((np.void, stacks.itemsize * 4))).ravel()
+    urecords, inverse = np.unique(records, return_inverse=True)
+    ucounts = np.bincount(inverse, weights=counts, minlength=urecords.shape[0])
+    ustacks = urecords.view(np.uint64).reshape(-1, 4)
+    return ustacks, ucounts.astype(np.uint64)
 
 
 
-@numba.jit(nopython=True)
-def nblik2_build(ustacks):
+def lik_suffstats(ustacks, bfreqs):
     """
-    JIT'd function builds large array that can be used to calc binom pmf
+    Precomputes the terms of the site likelihoods that do not depend on
+    [H, E] for each unique CATG pattern, so that only the powers of E are
+    left to the kernel. For a homozygous site with base b the likelihood is
+    binom(tot-n_b; tot, E), and for a heterozygous site with bases j<k it is
+    binom(tot-n_j-n_k; tot, 0.5) * binom(n_j; n_j+n_k, 2E/3) weighted by the
+    genotype frequencies from bfreqs.
     """
+    ustacks = ustacks.astype(np.float64)
+    tots = ustacks.sum(axis=1)
+
+    ## homozygous: log binomial coefficients, and n errors, n correct
+    lchoose1 = lchoose(tots[:, None], ustacks)
+    errs1 = tots[:, None] - ustacks
+
+    ## heterozygous: each pair of bases (j, k)
+    pairs = list(itertools.combinations(range(4), 2))
+    jdx = np.array([i[0] for i in pairs])
+    kdx = np.array([i[1] for i in pairs])
+    nj = ustacks[:, jdx]
+    nk = ustacks[:, kdx]
+    lchoose2 = lchoose(nj + nk, nj)
+
+    ## genotype frequencies and the err-independent binomial of other bases
+    four = 1. - np.sum(bfreqs**2)
+    if four > 0:
+        one = 2. * bfreqs[jdx] * bfreqs[kdx]
+        twos = scipy.stats.binom.pmf(tots[:, None] - nj - nk, tots[:, None], 0.5)
+        weights2 = one * twos / four
+    else:
+        weights2 = np.zeros(nj.shape)
 
-    ## store
-    #ret = np.empty(ustacks.shape[0])
-
-    ## fill for pmf later 
-    tots = np.empty((ustacks.shape[0], 1))
-    twos = np.empty((ustacks.shape[0], 6))
-    thrs = np.empty((ustacks.shape[0], 6, 2))
-
-    ## fill big arrays
-    for idx in xrange(ustacks.shape[0]):
+    return (lchoose1, errs1, ustacks, bfreqs.astype(np.float64),
+            weights2, lchoose2, nj, nk)
 
-        ust = ustacks[idx]
-        tot = ust.sum()
-        tots[idx] = tot
 
-        ## fast filling of arrays
-        i = 0
-        for jdx in xrange(4):
-            for kdx in xrange(4):
-                if jdx < kdx:
-                    twos[idx][i] = tot - ust[jdx] - ust[kdx]
-                    thrs[idx][i] = ust[jdx], ust[jdx] + ust[kdx]
-                    i += 1
 
-    return tots, twos, thrs
+def lchoose(nval, kval):
+    """ log of the binomial coefficients n choose k """
+    return scipy.special.gammaln(nval + 1.) - scipy.special.gammaln(kval + 1.) \
+         - scipy.special.gammaln(nval - kval + 1.)
 
 
 
-def lik2_calc(err, one, tots, twos, thrs, four):
-    """ 
-    vectorized calc of binom pmf on large arrays 
+@numba.jit(nopython=True)
+def nblik_kernel(hetero, errors, counts, lchoose1, errs1, oks1, bfreqs,
+                 weights2, lchoose2, nj, nk):
     """
-
-    ## calculate twos
-    _twos = scipy.stats.binom.pmf(twos, tots, 0.5)
-
-    ## calculate threes
-    _thrs = thrs.reshape(thrs.shape[0] * thrs.shape[1], thrs.shape[2])
-    _thrs = scipy.stats.binom.pmf(_thrs[:, 0], _thrs[:, 1], (2.*err) / 3.)
-    _thrs = _thrs.reshape(thrs.shape[0], 6)
-
-    ## calculate return sums
-    return np.sum(one * _twos * (_thrs / four), axis=1)
+    JIT'd negative log likelihood of [H, E] summed over the unique CATG
+    patterns weighted by their counts, and its gradient. Sites with zero
+    likelihood are skipped, as in the old scipy version.
+    """
+    lerr = np.log(errors)
+    lok = np.log(1. - errors)
+    qerr = (2. * errors) / 3.
+    lqerr = np.log(qerr)
+    lqok = np.log(1. - qerr)
+
+    score = 0.
+    dhet = 0.
+    derr = 0.
+    for idx in xrange(counts.shape[0]):
+
+        ## homozygous
+        lik1 = 0.
+        dlik1 = 0.
+        for bdx in xrange(4):
+            term = bfreqs[bdx] * np.exp(lchoose1[idx, bdx] + \
+                   errs1[idx, bdx] * lerr + oks1[idx, bdx] * lok)
+            lik1 += term
+            dlik1 += term * (errs1[idx, bdx] / errors - \
+                             oks1[idx, bdx] / (1. - errors))
+
+        ## heterozygous
+        lik2 = 0.
+        dlik2 = 0.
+        for pdx in xrange(6):
+            if weights2[idx, pdx] > 0:
+                term = weights2[idx, pdx] * np.exp(lchoose2[idx, pdx] + \
+                       nj[idx, pdx] * lqerr + nk[idx, pdx] * lqok)
+                lik2 += term
+                dlik2 += term * (nj[idx, pdx] / qerr - \
+                                 nk[idx, pdx] / (1. - qerr)) * (2. / 3.)
+
+        liks = (1. - hetero) * lik1 + hetero * lik2
+        if liks > 0:
+            score -= counts[idx] * np.log(liks)
+            dhet -= counts[idx] * (lik2 - lik1) / liks
+            derr -= counts[idx] * ((1. - hetero) * dlik1 + hetero * dlik2) / liks
+
+    return score, dhet, derr
+
+
+
+def get_diploid_lik(params, counts, stats):
+    """
+    Log likelihood score and gradient given log values [H, E]. Optimizing
+    on the log scale keeps H and E positive and on a similar scale.
+    """
+    hetero, errors = np.exp(params)
+    score, dhet, derr = nblik_kernel(hetero, errors, counts, *stats)
+    return score, np.array([dhet * hetero, derr * errors])
 
 
 
-def nlikelihood2(errors, bfreqs, ustacks):
-    """ calls nblik2_build and lik2_calc for a given err """
-    one = [2. * bfreqs[i] * bfreqs[j] for i, j in itertools.combinations(range(4), 2)]
-    four = 1. - np.sum(bfreqs**2) 
-    tots, twos, thrs = nblik2_build(ustacks)
-    res2 = lik2_calc(errors, one, tots, twos, thrs, four)
-    return res2
+def get_haploid_lik(params, counts, stats):
+    """ Log likelihood score and gradient given log value [E], H fixed to 0 """
+    errors = np.exp(params[0])
+    score, _, derr = nblik_kernel(0., errors, counts, *stats)
+    return score, np.array([derr * errors])
 
 
 
-def nget_diploid_lik(pstart, bfreqs, ustacks, counts):
-    """ Log likelihood score given values [H,E] """
-    hetero, errors = pstart
-    if (hetero <= 0.) or (errors <= 0.):
-        score = np.exp(100)
-    else:
-        ## get likelihood for all sites
-        lik1 = (1.-hetero) * likelihood1(errors, bfreqs, ustacks)
-        lik2 = (hetero) * nlikelihood2(errors, bfreqs, ustacks)
-        liks = lik1 + lik2
-        logliks = np.log(liks[liks > 0]) * counts[liks > 0]
-        score = -logliks.sum()
-    return score
-
-
-
-def get_haploid_lik(errors, bfreqs, ustacks, counts):
-    """ Log likelihood score given values [E]. """
-    hetero = 0.
-    ## score terribly if below 0
-    if errors <= 0.:
-        score = np.exp(100)
-    else:
-        ## get likelihood for all sites
-        lik1 = ((1.-hetero)*likelihood1(errors, bfreqs, ustacks)) 
-        #lik2 = (hetero)*nlikelihood2(errors, bfreqs, ustacks)
-        #liks = lik1+lik2
-        liks = lik1
-        logliks = np.log(liks[liks > 0])*counts[liks > 0]
-        score = -logliks.sum()
-    return score
+def maximize_lik(func, pstart, counts, stats):
+    """ L-BFGS-B optimization of the log params of a likelihood function """
+    bounds = [(np.log(LIK_BOUNDS[0]), np.log(LIK_BOUNDS[1]))] * len(pstart)
+    res = scipy.optimize.minimize(func, np.log(pstart),
+                                  args=(counts, stats),
+                                  jac=True,
+                                  method="L-BFGS-B",
+                                  bounds=bounds,
+                                  options={"maxiter": LIK_MAXITER})
+    if not res.success:
+        LOGGER.debug("joint estimate did not converge: %s", res.message)
+    return np.exp(res.x)
 
 
 
@@ -189,19 +229,20 @@ def recal_hidepth(data, sample):
 
 def stackarray(data, sample):
     """ 
-    Stacks clusters into arrays
+    Stacks clusters into arrays of CATG base counts per site, and returns
+    the unique site patterns and their counts. Sites are reduced to unique
+    patterns every STACK_BLOCK sites so that memory does not grow with the
+    number of high depth clusters.
     """
 
     ## only use clusters with depth > mindepth_statistical for param estimates
-    sample, _, _, nhidepth, maxlen = recal_hidepth(data, sample)
+    sample, _, _, _, maxlen = recal_hidepth(data, sample)
 
-    ## get clusters file    
-    clusters = gzip.open(sample.files.clusters)
-    pairdealer = itertools.izip(*[iter(clusters)]*2)
-
-    ## we subsample, else use first 10000 loci.
-    dims = (nhidepth, maxlen, 4)
-    stacked = np.zeros(dims, dtype=np.uint64)
+    ## unique patterns so far, and a block of sites not yet reduced
+    ustacks = np.zeros((0, 4), dtype=np.uint64)
+    counts = np.zeros(0, dtype=np.uint64)
+    block = []
+    nblock = 0
 
     ## don't use sequence edges / restriction overhangs
     cutlens = [None, None]
@@ -213,56 +254,48 @@ def stackarray(data, sample):
     #LOGGER.info("cutlens: %s", cutlens)
 
     ## fill stacked
-    nclust = 0
-    done = 0
-    while not done:
-        try:
-            done, chunk = clustdealer(pairdealer, 1)
-        except IndexError:
-            raise IPyradError("  clustfile formatting error in %s", chunk)
-
-        if chunk:
-            piece = chunk[0].strip().split("\n")
-            names = piece[0::2]
-            seqs = piece[1::2]
-            ## pull replicate read info from seqs
-            reps = [int(sname.split(";")[-2][5:]) for sname in names]
-            
-            ## double reps if the read was fully merged... (TODO: Test this!)
-            #merged = ["_m1;s" in sname for sname in names]
-            #if any(merged):
-            #    reps = [i*2 if j else i for i, j in zip(reps, merged)]
-
-            ## get all reps
-            sseqs = [list(seq) for seq in seqs]
-            arrayed = np.concatenate(
-                          [[seq]*rep for seq, rep in zip(sseqs, reps)])
-            
-            ## enforce minimum depth for estimates
-            if arrayed.shape[0] >= data.paramsdict["mindepth_statistical"]:
-                ## remove edge columns and select only the first 500 
-                ## derep reads, just like in step 5
-                arrayed = arrayed[:500, cutlens[0]:cutlens[1]]
-                ## remove cols that are pair separator
-                arrayed = arrayed[:, ~np.any(arrayed == "n", axis=0)]
-                ## remove cols that are all Ns after converting -s to Ns
-                arrayed[arrayed == "-"] = "N"
-                arrayed = arrayed[:, ~np.all(arrayed == "N", axis=0)]
-                ## store in stacked dict
-
-                catg = np.array(\
-                    [np.sum(arrayed == i, axis=0) for i in list("CATG")], 
-                    dtype=np.uint64).T
-
-                stacked[nclust, :catg.shape[0], :] = catg
-                nclust += 1
-
-    ## drop the empty rows in case there are fewer loci than the size of array
-    newstack = stacked[stacked.sum(axis=2) > 0]
-    assert not np.any(newstack.sum(axis=1) == 0), "no zero rows"
-    clusters.close()
-
-    return newstack
+    for names, seqs, reps in iter_clusters(sample.files.clusters):
+        ## double reps if the read was fully merged... (TODO: Test this!)
+        #merged = ["_m1;s" in sname for sname in names]
+        #if any(merged):
+        #    reps = [i*2 if j else i for i, j in zip(reps, merged)]
+
+        ## get one row per seq weighted by its reps
+        arr, reps = stack_cluster(seqs, reps)
+        
+        ## enforce minimum depth for estimates
+        if reps.sum() >= data.paramsdict["mindepth_statistical"]:
+            ## remove edge columns and select only the first 500 
+            ## derep reads, just like in step 5
+            reps = np.minimum(reps, np.maximum(500 - (reps.cumsum() - reps), 0))
+            arrayed = arr[reps > 0, cutlens[0]:cutlens[1]].view("S1")
+            reps = reps[reps > 0]
+            ## remove cols that are pair separator
+            arrayed = arrayed[:, ~np.any(arrayed == "n", axis=0)]
+            ## remove cols that are all Ns after converting -s to Ns
+            arrayed[arrayed == "-"] = "N"
+            arrayed = arrayed[:, ~np.all(arrayed == "N", axis=0)]
+            ## store in stacked dict
+
+            catg = stack_counts(arrayed.view(np.uint8), reps, "CATG")[:maxlen]
+
+            ## drop the empty sites
+            catg = catg[catg.sum(axis=1) > 0]
+            block.append(catg)
+            nblock += catg.shape[0]
+            if nblock >= STACK_BLOCK:
+                ustacks, counts = unique_stacks(
+                    np.concatenate([ustacks] + block),
+                    np.concatenate([counts, np.ones(nblock, dtype=np.uint64)]))
+                block = []
+                nblock = 0
+
+    if block:
+        ustacks, counts = unique_stacks(
+            np.concatenate([ustacks] + block),
+            np.concatenate([counts, np.ones(nblock, dtype=np.uint64)]))
+
+    return ustacks, counts
 
 
 
@@ -277,54 +310,29 @@ def optim(data, sample):
     success = False
 
     try:
-        ## get array of all clusters data
-        stacked = stackarray(data, sample)
+        ## get unique site patterns of all clusters data and their counts
+        ustacks, counts = stackarray(data, sample)
 
         ## get base frequencies
-        bfreqs = stacked.sum(axis=0) / float(stacked.sum())
-        #bfreqs = bfreqs**2
-        #LOGGER.debug(bfreqs)
+        bfreqs = (ustacks * counts[:, None].astype(np.float64)).sum(axis=0)
+        bfreqs = bfreqs / bfreqs.sum()
         if np.isnan(bfreqs).any():
             raise IPyradWarningExit(" Bad stack in getfreqs; {} {}"\
                    .format(sample.name, bfreqs))
 
-        ## put into array, count array items as Byte strings
-        tstack = Counter([j.tostring() for j in stacked])
-
-        ## get keys back as arrays and store vals as separate arrays
-        ustacks = np.array([np.fromstring(i, dtype=np.uint64) \
-                            for i in tstack.iterkeys()])
-
-        ## make bi-allelic only
-        #tris = np.where(np.sum(ustacks > 0, axis=1) > 2)
-        #for tri in tris:
-        #    minv = np.min(ustacks[tri][ustacks[tri] > 0])
-        #    delv = np.where(ustacks[tri] == minv)[0][0]
-        #    ustacks[tri, delv] = 0
-
-        counts = np.array(tstack.values())
-        ## cleanup
-        del tstack
+        ## terms of the likelihood that do not depend on [H, E]
+        stats = lik_suffstats(ustacks, bfreqs)
+        counts = counts.astype(np.float64)
 
         ## if data are haploid fix H to 0
         if int(data.paramsdict["max_alleles_consens"]) == 1:
             pstart = np.array([0.001], dtype=np.float64)
             hetero = 0.
-            errors = scipy.optimize.fmin(get_haploid_lik, pstart,
-                                         (bfreqs, ustacks, counts),
-                                         maxfun=50,
-                                         maxiter=50,
-                                         disp=False,
-                                         full_output=False)
+            errors, = maximize_lik(get_haploid_lik, pstart, counts, stats)
         ## or do joint diploid estimates
         else:
             pstart = np.array([0.01, 0.001], dtype=np.float64)
-            hetero, errors = scipy.optimize.fmin(nget_diploid_lik, pstart,
-                                                (bfreqs, ustacks, counts),
-                                                maxfun=50,
-                                                maxiter=50,
-                                                disp=False,
-                                                full_output=False)
+            hetero, errors = maximize_lik(get_diploid_lik, pstart, counts, stats)
         success = True
 
     except IPyradError as inst:
@@ -389,7 +397,8 @@ def submit(data, subsamples, ipyclient):
 
     ## stores async results using sample names    
     for sample in subsamples:
-        jobs[sample.name] = lbview.apply(optim, *(data, sample))
+        jobs[sample.name] = lbview.apply(
+            profiled(data, optim, "inferring [H, E]", sample), *(data, sample))
 
     ## wrap in a try statement so that stats are saved for finished samples.
     ## each job is submitted to cleanup as it finishes
@@ -471,6 +480,17 @@ def assembly_cleanup(data):
 
 
 
+### GLOBALS
+
+## sites stacked before reducing them to unique patterns
+STACK_BLOCK = 2**20
+
+## range of H and E, and max iterations of the optimizer
+LIK_BOUNDS = (1e-9, 0.5)
+LIK_MAXITER = 200
+
+
+
 if __name__ == "__main__":
 
     import ipyrad as ip
@@ -0,0 +1,297 @@
+#!/usr/bin/env python2.7
+
+"""
+Optional profiling of Assembly steps. When profiling is on (Assembly.run
+with profile=True, or the CLI --profile flag) engine jobs wrapped with
+profiled() record their wall time, CPU time, peak RSS during the job and
+bytes read and written. The records of each step, plus totals for the step and for each
+engine, are written to s<N>_profile.json and s<N>_profile.csv next to the
+step's stats file.
+"""
+
+from __future__ import print_function
+# pylint: disable=W0212
+
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import socket
+import resource
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+
+
+def io_bytes():
+    """
+    bytes read and written by this process and its finished subprocesses
+    (rchar, wchar from /proc), or None where /proc is not available.
+    """
+    try:
+        with open("/proc/self/io", 'r') as procio:
+            counts = dict(i.split(":") for i in procio.read().strip().split("\n"))
+        return int(counts["rchar"]), int(counts["wchar"])
+    except (IOError, KeyError, ValueError):
+        return None, None
+
+
+
+def peak_rss():
+    """
+    high-water mark of the RSS of this process (VmHWM from /proc) since it
+    was last reset by reset_peak_rss, or None where /proc is not available.
+    """
+    try:
+        with open("/proc/self/status", 'r') as procstatus:
+            for line in procstatus:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+
+def reset_peak_rss():
+    """ resets the RSS high-water mark of this process to its current RSS """
+    try:
+        with open("/proc/self/clear_refs", 'w') as clear:
+            clear.write("5")
+    except IOError:
+        pass
+
+
+
+def usage(reset=False):
+    """
+    resource counters of this process and its finished subprocesses, so
+    that time spent in vsearch, muscle, etc. is included in cpu. If reset
+    the RSS high-water mark is reset after the snapshot, so the next one
+    has the peak since this one. Without /proc (e.g., on mac) the peak of
+    this process is its lifetime peak (ru_maxrss). The peak of finished
+    subprocesses is that of the largest one ever waited for.
+    """
+    rself = resource.getrusage(resource.RUSAGE_SELF)
+    rchild = resource.getrusage(resource.RUSAGE_CHILDREN)
+    nread, nwritten = io_bytes()
+    selfrss = peak_rss()
+    snapshot = {
+        "host": socket.gethostname(),
+        "pid": os.getpid(),
+        "wall": time.time(),
+        "cpu": rself.ru_utime + rself.ru_stime + rchild.ru_utime + rchild.ru_stime,
+        "self_rss": selfrss if selfrss is not None else rself.ru_maxrss * RSS_UNIT,
+        "child_rss": rchild.ru_maxrss * RSS_UNIT,
+        "read_bytes": nread,
+        "write_bytes": nwritten,
+        }
+    if reset:
+        reset_peak_rss()
+    return snapshot
+
+
+
+def delta(before, after):
+    """
+    usage between two snapshots. Peak RSS is the peak of this process
+    since the first snapshot (if it was taken with reset), or of a
+    subprocess that finished in between and was the largest so far.
+    """
+    record = {}
+    for key in ["wall", "cpu", "read_bytes", "write_bytes"]:
+        if before[key] is None or after[key] is None:
+            record[key] = None
+        else:
+            record[key] = after[key] - before[key]
+    record["peak_rss"] = after["self_rss"]
+    if after["child_rss"] > before["child_rss"]:
+        record["peak_rss"] = max(record["peak_rss"], after["child_rss"])
+    return record
+
+
+
+class ProfiledJob(object):
+    """
+    Runs an engine job and appends its usage to a file of records for its
+    engine process in the profile directory. The job's return value and
+    exceptions are passed through unchanged.
+    """
+    def __init__(self, func, profdir, step, stage, sample):
+        self.func = func
+        self.profdir = profdir
+        self.step = step
+        self.stage = stage
+        self.sample = sample
+
+
+    def __call__(self, *args, **kwargs):
+        before = usage(reset=True)
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            after = usage()
+            record = delta(before, after)
+            record.update({
+                "level": "job",
+                "step": self.step,
+                "stage": self.stage,
+                "sample": self.sample,
+                "job": self.func.__name__,
+                "host": after["host"],
+                "pid": after["pid"],
+                })
+            handle = os.path.join(self.profdir, "{}-{}.jsonl"\
+                                  .format(after["host"], after["pid"]))
+            with open(handle, 'a') as out:
+                out.write(json.dumps(record)+"\n")
+
+
+
+def profiled(data, func, stage, sample=None):
+    """
+    returns func wrapped to record its usage under the current step, or
+    func itself if profiling is off. stage is the label shown in the
+    progress bar, and sample a Sample object or name if the job has one.
+    """
+    if not data._profile:
+        return func
+    if hasattr(sample, "name"):
+        sample = sample.name
+    return ProfiledJob(func, data._profile["dir"], data._profile["step"],
+                       stage.strip(), sample)
+
+
+
+class StepProfile(object):
+    """
+    Context manager around one step of Assembly.run. Snapshots the usage of
+    the main process and of each engine before and after the step, sets the
+    step for profiled jobs, and writes the step's report when it finishes.
+    Engines are idle between steps so the snapshots do not wait on jobs.
+    """
+    def __init__(self, data, step, ipyclient):
+        self.data = data
+        self.step = str(step)
+        self.ipyclient = ipyclient
+        self.before = None
+        self.engines = None
+
+
+    def __enter__(self):
+        if self.data._profile:
+            self.data._profile["step"] = self.step
+            self.engines = self._engine_usage(reset=True)
+            self.before = usage(reset=True)
+        return self
+
+
+    def __exit__(self, *args):
+        if self.data._profile:
+            try:
+                self._report(usage(), self._engine_usage())
+            except Exception as inst:
+                LOGGER.error("failed to write profile for step %s: %s",
+                             self.step, inst)
+            self.data._profile["step"] = None
+
+
+    def _engine_usage(self, reset=False):
+        """ usage of every engine keyed by engine id """
+        eids = self.ipyclient.ids
+        return dict(zip(eids, self.ipyclient[eids].apply_sync(usage, reset)))
+
+
+    def _report(self, after, engines):
+        """ collect job records and write the step report """
+        records = []
+
+        ## main process over the whole step
+        record = delta(self.before, after)
+        record.update({"level": "step", "step": self.step,
+                       "host": after["host"], "pid": after["pid"]})
+        records.append(record)
+
+        ## each engine over the whole step
+        pids = {}
+        for eid in sorted(engines):
+            if eid not in self.engines:
+                continue
+            record = delta(self.engines[eid], engines[eid])
+            record.update({"level": "engine", "step": self.step, "engine": eid,
+                           "host": engines[eid]["host"],
+                           "pid": engines[eid]["pid"]})
+            records.append(record)
+            pids[(engines[eid]["host"], engines[eid]["pid"])] = eid
+
+        ## each profiled job, matched to its engine
+        profdir = self.data._profile["dir"]
+        for handle in sorted(glob.glob(os.path.join(profdir, "*.jsonl"))):
+            with open(handle, 'r') as infile:
+                for line in infile:
+                    record = json.loads(line)
+                    if record["step"] == self.step:
+                        record["engine"] = pids.get((record["host"], record["pid"]))
+                        records.append(record)
+            os.remove(handle)
+
+        ## each job reset the peak of its engine, so the peak of an engine
+        ## over the step is the largest of its jobs and what came after
+        for record in records:
+            if record["level"] == "job" and record["engine"] is not None:
+                for erecord in records:
+                    if erecord["level"] == "engine" and \
+                        erecord["engine"] == record["engine"]:
+                        erecord["peak_rss"] = max(erecord["peak_rss"],
+                                                  record["peak_rss"])
+
+        ## write next to the stats file of the step
+        outbase = profile_path(self.data, self.step)
+        with open(outbase+".json", 'w') as out:
+            json.dump({"step": self.step, "records": records}, out, indent=1)
+        with open(outbase+".csv", 'wb') as out:
+            writer = csv.DictWriter(out, fieldnames=PROFILE_FIELDS,
+                                    extrasaction="ignore")
+            writer.writeheader()
+            for record in records:
+                writer.writerow(record)
+        LOGGER.info("wrote profile of step %s to %s", self.step, outbase)
+
+
+
+def profile_path(data, step):
+    """ 
+    path (without .json/.csv) of a step's profile report, next to the
+    stats file of the step or in the project dir if it has none.
+    """
+    statsfile = data.stats_files.get("s{}".format(step))
+    if statsfile:
+        outdir = os.path.dirname(statsfile)
+    else:
+        outdir = data.dirs.project
+    return os.path.join(outdir, "s{}_profile".format(step))
+
+
+
+def start_profile(data):
+    """ turn on profiling and make the directory for engine records """
+    profdir = os.path.join(data.dirs.project, data.name+"-profile")
+    if not os.path.exists(profdir):
+        os.makedirs(profdir)
+    data._profile = {"dir": profdir, "step": None}
+
+
+
+### GLOBALS
+
+## ru_maxrss is in kilobytes on linux and bytes on mac
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+## columns of the csv report
+PROFILE_FIELDS = [
+    "level", "step", "stage", "sample", "job", "engine", "host", "pid",
+    "wall", "cpu", "peak_rss", "read_bytes", "write_bytes",
+    ]
@@ -18,6 +18,7 @@ import time
 import datetime
 import numpy as np
 from .util import *
+from .profiler import profiled
 
 try:
     import subprocess32 as sps
@@ -583,10 +584,14 @@ def run_cutadapt(data, subsamples, lbview):
     ## send samples to cutadapt filtering
     if "pair" in data.paramsdict["datatype"]:
         for sample in subsamples:
-            rawedits[sample.name] = lbview.apply(cutadaptit_pairs, *(data, sample))
+            rawedits[sample.name] = lbview.apply(
+                profiled(data, cutadaptit_pairs, "processing reads", sample), 
+                *(data, sample))
     else:
         for sample in subsamples:
-            rawedits[sample.name] = lbview.apply(cutadaptit_single, *(data, sample))
+            rawedits[sample.name] = lbview.apply(
+                profiled(data, cutadaptit_single, "processing reads", sample), 
+                *(data, sample))
 
     ## wait for all to finish
     while 1:
@@ -10,14 +10,21 @@ from __future__ import print_function
 
 import os
 import gzip
-import glob
+import mmap
+import time
 import shutil
 import pysam
+import socket
+import hashlib
+import tempfile
 import ipyrad
 import numpy as np
 import subprocess as sps
 from ipyrad.assemble.util import *
 from ipyrad.assemble.rawedit import comp
+from ipyrad.assemble.clustfile import ClustWriter, ClustFile, clustbin_path, \
+                                      cluster_text, CLUSTBLOCK
+from ipyrad.assemble.storage import DatabaseLock
 
 import logging
 LOGGER = logging.getLogger(__name__)
@@ -51,8 +58,15 @@ def sample_cleanup(data, sample):
 
 def index_reference_sequence(data, force=False):
     """ 
-    Index the reference sequence, unless it already exists. Also make a mapping
-    of scaffolds to index numbers for later user in steps 5-6. 
+    Index the reference sequence for the mapper and for samtools faidx,
+    unless it is already in the index cache, and return the prefix of the
+    index files, which step 3 stores in data.dirs.refindex. Indexes are 
+    cached by the checksum of the reference and by the mapper and its 
+    version (see reference_index_dir), so Assemblies and branches that use 
+    the same reference, on any host, share one index. An index is built in
+    a tmp dir while holding a lock on it and then moved into place, so 
+    concurrent runs wait for the first one to build it. Index files next 
+    to the reference made by older versions are used unless force.
     """
 
     ## get ref file from params
@@ -69,43 +83,89 @@ def index_reference_sequence(data, force=False):
     ## samtools specific index
     index_files.extend([".fai"])
 
-    ## If reference sequence already exists then bail out of this func
+    ## If an older index exists next to the reference then use it
     if not force:
         if all([os.path.isfile(refseq_file+i) for i in index_files]):
-            return
+            return refseq_file
+
+    ## the cache entry of this reference and mapper
+    cachedir = reference_index_dir(data)
+    checksum = reference_checksum(refseq_file, cachedir)
+    key = hashlib.md5("{} {}".format(checksum, mapper_version(data)))
+    entry = os.path.join(cachedir, "{}-{}".format(
+        os.path.basename(refseq_file), key.hexdigest()[:16]))
+    prefix = os.path.join(entry, os.path.basename(refseq_file))
+
+    ## build it unless it exists or another run built it while we waited
+    if not os.path.isdir(entry):
+        with DatabaseLock(entry):
+            if not os.path.isdir(entry):
+                build_reference_index(data, entry, checksum)
+    LOGGER.info("reference index: %s", prefix)
+    return prefix
+
+
+
+def build_reference_index(data, entry, checksum):
+    """ 
+    Builds the mapper and faidx index of the reference in a tmp dir and 
+    renames it to the cache entry dir. The index files are named by the
+    basename of the reference. samtools faidx writes its index next to the
+    fasta, so it indexes a symlink to the reference in the tmp dir. The
+    checksum of the reference is written to <prefix>.md5, to check that 
+    a stored data.dirs.refindex still matches the reference.
+    """
+    refseq_file = os.path.abspath(data.paramsdict['reference_sequence'])
+    builddir = "{}.tmp-{}-{}".format(entry, socket.gethostname(), os.getpid())
+    prefix = os.path.join(builddir, os.path.basename(refseq_file))
+    if os.path.exists(builddir):
+        shutil.rmtree(builddir)
+    os.makedirs(builddir)
+
     #if data._headers:
     #    print(INDEX_MSG.format(data._hackersonly["aligner"]))
+    try:
+        if "smalt" in data._hackersonly["aligner"]:
+            ## Create smalt index for mapping
+            ## smalt index [-k <wordlen>] [-s <stepsiz>]  <index_name> <reference_file>
+            cmd1 = [ipyrad.bins.smalt, "index", 
+                    "-k", str(data._hackersonly["smalt_index_wordlen"]), 
+                    prefix, 
+                    refseq_file]
+        else:
+            ## bwa index -p <index_name> <reference_file>
+            cmd1 = [ipyrad.bins.bwa, "index", "-p", prefix, refseq_file]
 
-    if "smalt" in data._hackersonly["aligner"]:
-        ## Create smalt index for mapping
-        ## smalt index [-k <wordlen>] [-s <stepsiz>]  <index_name> <reference_file>
-        cmd1 = [ipyrad.bins.smalt, "index", 
-                "-k", str(data._hackersonly["smalt_index_wordlen"]), 
-                refseq_file, 
-                refseq_file]
-    else:
-        ## bwa index <reference_file>
-        cmd1 = [ipyrad.bins.bwa, "index", refseq_file]
+        ## call the command
+        LOGGER.info(" ".join(cmd1))
+        proc1 = sps.Popen(cmd1, stderr=sps.STDOUT, stdout=sps.PIPE)
+        error1 = proc1.communicate()[0]
 
-    ## call the command
-    LOGGER.info(" ".join(cmd1))
-    proc1 = sps.Popen(cmd1, stderr=sps.STDOUT, stdout=sps.PIPE)
-    error1 = proc1.communicate()[0]
-
-    ## simple samtools index for grabbing ref seqs
-    cmd2 = [ipyrad.bins.samtools, "faidx", refseq_file]
-    LOGGER.info(" ".join(cmd2))
-    proc2 = sps.Popen(cmd2, stderr=sps.STDOUT, stdout=sps.PIPE)
-    error2 = proc2.communicate()[0]
-
-    ## error handling
-    if proc1.returncode:
-        raise IPyradWarningExit(error1)
-    if error2:
-        if "please use bgzip" in error2:
-            raise IPyradWarningExit(NO_ZIP_BINS.format(refseq_file))
-        else:
-            raise IPyradWarningExit(error2)
+        ## simple samtools index for grabbing ref seqs
+        os.symlink(refseq_file, prefix)
+        cmd2 = [ipyrad.bins.samtools, "faidx", prefix]
+        LOGGER.info(" ".join(cmd2))
+        proc2 = sps.Popen(cmd2, stderr=sps.STDOUT, stdout=sps.PIPE)
+        error2 = proc2.communicate()[0]
+
+        ## error handling
+        if proc1.returncode:
+            raise IPyradWarningExit(error1)
+        if error2:
+            if "please use bgzip" in error2:
+                raise IPyradWarningExit(NO_ZIP_BINS.format(refseq_file))
+            else:
+                raise IPyradWarningExit(error2)
+
+        ## move the complete index into place
+        os.remove(prefix)
+        with open(prefix + ".md5", 'w') as outmd5:
+            outmd5.write(checksum)
+        os.rename(builddir, entry)
+
+    finally:
+        if os.path.exists(builddir):
+            shutil.rmtree(builddir)
 
     ## print finished message
     #if data._headers:
@@ -113,6 +173,102 @@ def index_reference_sequence(data, force=False):
 
 
 
+def reference_index_dir(data):
+    """ 
+    The index cache dir, the _hackersonly reference_index_dir, or if it is
+    not set an ipyrad-refindex dir next to the reference sequence. 
+    """
+    cachedir = data._hackersonly["reference_index_dir"]
+    if not cachedir:
+        cachedir = os.path.join(os.path.dirname(os.path.abspath(
+            data.paramsdict["reference_sequence"])), "ipyrad-refindex")
+    cachedir = os.path.realpath(os.path.expanduser(cachedir))
+    try:
+        os.makedirs(os.path.join(cachedir, "checksums"))
+    except OSError:
+        if not os.path.isdir(os.path.join(cachedir, "checksums")):
+            raise IPyradWarningExit(BAD_INDEX_DIR.format(cachedir))
+    return cachedir
+
+
+
+def reference_checksum(path, cachedir):
+    """ 
+    md5 of the reference file. It is stored in the cache dir by the path,
+    size and mtime of the file, so a reference is only read once.
+    """
+    stat = os.stat(path)
+    stamp = "{}\t{}".format(stat.st_size, repr(stat.st_mtime))
+    memo = os.path.join(cachedir, "checksums", 
+                        hashlib.md5(os.path.abspath(path)).hexdigest())
+    try:
+        with open(memo, 'r') as inmemo:
+            oldstamp, checksum = inmemo.read().rsplit("\t", 1)
+        if oldstamp == stamp:
+            return checksum
+    except (IOError, ValueError):
+        pass
+
+    md5 = hashlib.md5()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(CHECKSUM_BLOCK), ""):
+            md5.update(block)
+    checksum = md5.hexdigest()
+
+    ## write to a tmp file and rename so readers never see a partial memo
+    tmpmemo = "{}.{}-{}".format(memo, socket.gethostname(), os.getpid())
+    with open(tmpmemo, 'w') as outmemo:
+        outmemo.write("{}\t{}".format(stamp, checksum))
+    os.rename(tmpmemo, memo)
+    return checksum
+
+
+
+def mapper_version(data):
+    """ the mapper, its version and its index options, to key the cache """
+    if "smalt" in data._hackersonly["aligner"]:
+        cmd = [ipyrad.bins.smalt, "version"]
+        opts = "-k {}".format(data._hackersonly["smalt_index_wordlen"])
+    else:
+        cmd = [ipyrad.bins.bwa]
+        opts = ""
+
+    ## bwa prints its version in the usage and exits 1
+    proc = sps.Popen(cmd, stderr=sps.STDOUT, stdout=sps.PIPE)
+    res = proc.communicate()[0]
+    version = [i.split(":", 1)[1].strip() for i in res.split("\n") \
+               if i.startswith("Version:")]
+    if not version:
+        raise IPyradWarningExit(NO_MAPPER_VERSION.format(" ".join(cmd), res))
+    return "{} {} {}".format(os.path.basename(cmd[0]), version[0], opts)
+
+
+
+def reference_index(data):
+    """ 
+    prefix of the index files of the reference, <prefix>.fai etc. This is
+    in the index cache if step 3 put it there, else next to the reference.
+    Raises if the reference_sequence has changed since step 3 indexed it.
+    """
+    refseq_file = data.paramsdict["reference_sequence"]
+    prefix = data.dirs.get("refindex")
+    if not prefix:
+        return refseq_file
+
+    ## a cache entry is valid for any reference with its checksum, an
+    ## index next to the reference only for that reference
+    if os.path.exists(prefix + ".md5"):
+        with open(prefix + ".md5", 'r') as inmd5:
+            stored = inmd5.read().strip()
+        current = reference_checksum(refseq_file, reference_index_dir(data))
+        if stored == current:
+            return prefix
+    elif os.path.realpath(prefix) == os.path.realpath(refseq_file):
+        return prefix
+    raise IPyradWarningExit(STALE_REF_INDEX.format(prefix, refseq_file))
+
+
+
 def mapreads(data, sample, nthreads, force):
     """ 
     Attempt to map reads to reference sequence. This reads in the fasta files
@@ -121,7 +277,10 @@ def mapreads(data, sample, nthreads, force):
     are processed and pushed downstream and joined with the rest of the data 
     post muscle_align. 
 
-    Mapped reads end up in a sam file.
+    The SAM output of the mapper is streamed through samtools view, which
+    splits off the unmapped reads, into samtools sort, so the alignments
+    are never written to disk uncompressed. Returns the seconds spent
+    mapping, sorting and indexing, for the throughput stats of step 3.
     """
 
     LOGGER.info("Entering mapreads(): %s %s", sample.name, nthreads)
@@ -163,7 +322,7 @@ def mapreads(data, sample, nthreads, force):
     ##  -M           : Mark split alignments as secondary.
 
     ## (cmd2) samtools view [options] <in.bam>|<in.sam>|<in.cram> [region ...] 
-    ##   -b = write to .bam
+    ##   -u = write uncompressed .bam, it is only piped to sort
     ##   -q = Only keep reads with mapq score >= 30 (seems to be pretty standard)
     ##   -F = Select all reads that DON'T have these flags. 
     ##         0x4 (segment unmapped)
@@ -171,6 +330,7 @@ def mapreads(data, sample, nthreads, force):
     ##         0x800 (supplementary alignment)
     ##   -U = Write out all reads that don't pass the -F filter 
     ##        (all unmapped reads go to this file).
+    ##   -  = Read the SAM stream of the mapper from stdin
 
     ## TODO: Should eventually add `-q 13` to filter low confidence mapping.
     ## If you do this it will throw away some fraction of reads. Ideally you'd
@@ -184,25 +344,24 @@ def mapreads(data, sample, nthreads, force):
     ##        Here we hack it to be samhandle.tmp cuz samtools cleans it up
     ##   -O = Output file format, in this case bam
     ##   -o = Output file name
+    ##   -@ = Number of threads
+    ##   -m = Memory per thread, more than this is spilled to tmp files
 
     if "smalt" in data._hackersonly["aligner"]:
-        ## The output SAM data is written to file (-o)
+        ## The output SAM data is written to stdout
         ## input is either (derep) or (derep-split1, derep-split2)
         cmd1 = [ipyrad.bins.smalt, "map", 
                 "-f", "sam", 
                 "-n", str(max(1, nthreads)),
                 "-y", str(data.paramsdict['clust_threshold']), 
-                "-o", os.path.join(data.dirs.refmapping, sample.name+".sam"),
                 "-x",
-                data.paramsdict['reference_sequence']
+                reference_index(data)
                 ] + sample.files.dereps
-        cmd1_stdout = sps.PIPE
-        cmd1_stderr = sps.STDOUT
     else:
         cmd1 = [ipyrad.bins.bwa, "mem",
                 "-t", str(max(1, nthreads)),
                 "-M",
-                data.paramsdict['reference_sequence']
+                reference_index(data)
                 ] + sample.files.dereps
         ## Insert optional flags for bwa
         try:
@@ -213,29 +372,29 @@ def mapreads(data, sample, nthreads, force):
         except KeyError:
             ## Do nothing
             pass
-        cmd1_stdout = open(os.path.join(data.dirs.refmapping, sample.name+".sam"), 'w')
-        cmd1_stderr = None
 
-    ## Reads in the SAM file from cmd1. It writes the unmapped data to file
+    ## Reads in the SAM stream from cmd1. It writes the unmapped data to file
     ## and it pipes the mapped data to be used in cmd3
     cmd2 = [ipyrad.bins.samtools, "view", 
-           "-b", 
+           "-u", 
            ## TODO: This introduces a bug with PE right now. Think about the case where
            ## R1 has low qual mapping and R2 has high. You get different numbers
            ## of reads in the unmapped tmp files. FML.
            #"-q", "30",
            "-F", "0x904",
            "-U", os.path.join(data.dirs.refmapping, sample.name+"-unmapped.bam"), 
-           os.path.join(data.dirs.refmapping, sample.name+".sam")]
+           "-"]
 
     ## this is gonna catch mapped bam output from cmd2 and write to file
     cmd3 = [ipyrad.bins.samtools, "sort", 
             "-T", os.path.join(data.dirs.refmapping, sample.name+".sam.tmp"),
             "-O", "bam", 
+            "-@", str(max(1, nthreads)),
+            "-m", str(data._hackersonly["refmap_sort_memory"]),
             "-o", sample.files.mapped_reads]
 
-    ## TODO: Unnecessary?
-    ## this is gonna read the sorted BAM file and index it. only for pileup?
+    ## this is gonna read the sorted BAM file and index it, which pysam 
+    ## needs to fetch the reads of each region.
     cmd4 = [ipyrad.bins.samtools, "index", sample.files.mapped_reads]
 
     ## this is gonna read in the unmapped files, args are added below, 
@@ -270,51 +429,53 @@ def mapreads(data, sample, nthreads, force):
         cmd5.insert(2, mumapfile)
         cmd5.insert(2, "-0")
 
-    ## Running cmd1 creates ref_mapping/sname.sam, 
-    LOGGER.debug(" ".join(cmd1))
-    proc1 = sps.Popen(cmd1, stderr=cmd1_stderr, stdout=cmd1_stdout)
+    ## Running cmd1 | cmd2 | cmd3 maps the reads, writes the unmapped reads 
+    ## to ref_mapping/sname-unmapped.bam and the sorted mapped reads to
+    ## ref_mapping/sname-mapped-sorted.bam. The mapper logs to a tmp file 
+    ## because its stdout is the SAM stream.
+    start = time.time()
+    LOGGER.debug(" | ".join(" ".join(i) for i in [cmd1, cmd2, cmd3]))
+    maplog = tempfile.TemporaryFile()
+    proc1 = sps.Popen(cmd1, stderr=maplog, stdout=sps.PIPE)
+    proc2 = sps.Popen(cmd2, stderr=maplog, stdout=sps.PIPE, stdin=proc1.stdout)
+    proc1.stdout.close()
+    proc3 = sps.Popen(cmd3, stderr=sps.STDOUT, stdout=sps.PIPE, stdin=proc2.stdout)
+    proc2.stdout.close()
 
     ## This is really long running job so we wrap it to ensure it dies. 
     try:
-        error1 = proc1.communicate()[0]
+        error3 = proc3.communicate()[0]
+        proc2.wait()
+        proc1.wait()
     except KeyboardInterrupt:
-        proc1.kill()
-
-    ## raise error if one occurred in smalt
-    if proc1.returncode:
-        raise IPyradWarningExit(error1)
-
-    ## Running cmd2 writes to ref_mapping/sname.unmapped.bam, and 
-    ## fills the pipe with mapped BAM data
-    LOGGER.debug(" ".join(cmd2))
-    proc2 = sps.Popen(cmd2, stderr=sps.STDOUT, stdout=sps.PIPE)
-
-    ## Running cmd3 pulls mapped BAM from pipe and writes to 
-    ## ref_mapping/sname.mapped-sorted.bam. 
-    ## Because proc2 pipes to proc3 we just communicate this to run both.
-    LOGGER.debug(" ".join(cmd3))
-    proc3 = sps.Popen(cmd3, stderr=sps.STDOUT, stdout=sps.PIPE, stdin=proc2.stdout)
-    error3 = proc3.communicate()[0]
-    if proc3.returncode:
-        raise IPyradWarningExit(error3)
-    proc2.stdout.close()
+        for proc in [proc1, proc2, proc3]:
+            if proc.poll() is None:
+                proc.kill()
+        raise
 
-    ## Later we're gonna use samtools to grab out regions using 'view', and to
-    ## do that we need it to be indexed. Let's index it now. 
+    ## raise the error of the first command that failed in the pipe
+    for proc in [proc1, proc2, proc3]:
+        if proc.returncode:
+            maplog.seek(0)
+            raise IPyradWarningExit(maplog.read() + error3)
+    maplog.close()
+
+    ## Later we're gonna use pysam to grab out regions, and to do that we 
+    ## need it to be indexed. Running cmd5 at the same time reads the 
+    ## unmapped bam and writes to either edits/sname-refmap_derep.fastq for 
+    ## SE or it makes edits/sname-tmp-umap{12}.fastq for paired data, which 
+    ## will then need to be merged.
     LOGGER.debug(" ".join(cmd4))
+    LOGGER.debug(" ".join(cmd5))
     proc4 = sps.Popen(cmd4, stderr=sps.STDOUT, stdout=sps.PIPE)
+    proc5 = sps.Popen(cmd5, stderr=sps.STDOUT, stdout=sps.PIPE)
+    error5 = proc5.communicate()[0]
     error4 = proc4.communicate()[0]
     if proc4.returncode:
         raise IPyradWarningExit(error4)
-    
-    ## Running cmd5 writes to either edits/sname-refmap_derep.fastq for SE
-    ## or it makes edits/sname-tmp-umap{12}.fastq for paired data, which 
-    ## will then need to be merged.
-    LOGGER.debug(" ".join(cmd5))
-    proc5 = sps.Popen(cmd5, stderr=sps.STDOUT, stdout=sps.PIPE)
-    error5 = proc5.communicate()[0]
     if proc5.returncode:
         raise IPyradWarningExit(error5)
+    elapsed = time.time() - start
 
     ## Finally, merge the unmapped reads, which is what cluster()
     ## expects. If SE, just rename the outfile. In the end
@@ -327,6 +488,9 @@ def mapreads(data, sample, nthreads, force):
         ## second 1 means "really merge" don't just join w/ nnnn
         #merge_pairs(data, [(umap1file, umap2file)], mumapfile, 1, 1)
 
+    LOGGER.info("mapped %s in %.1fs", sample.name, elapsed)
+    return elapsed
+
 
 def fetch_cluster_se(data, samfile, chrom, rstart, rend):
     """
@@ -432,7 +596,9 @@ def fetch_cluster_se(data, samfile, chrom, rstart, rend):
 
 def fetch_cluster_pairs(data, samfile, chrom, rstart, rend):
     """ 
-    Builds a paired cluster from the refmapped data.
+    Builds a paired cluster from the refmapped data. Returns the cluster
+    and whether any of its read pairs overlap, in which case the caller
+    merges its pairs with merge_clusters_after_pysam.
     """
     ## store pairs
     rdict = {}
@@ -456,7 +622,7 @@ def fetch_cluster_pairs(data, samfile, chrom, rstart, rend):
     try:
         read1, read2 = rdict[rkeys[0]]
     except ValueError:
-        return 0
+        return [], False
 
     ## the starting blocks for the seed
     poss = read1.get_reference_positions() + read2.get_reference_positions()
@@ -538,102 +704,151 @@ def fetch_cluster_pairs(data, samfile, chrom, rstart, rend):
                 ## it as a separate cluster that will be aligned separately.
                 pass
 
-    ## merge the pairs prior to returning them
+    ## the pairs are merged by the caller in batches of clusters
     ## Remember, we already tested for quality scores, so
-    ## merge_after_pysam will generate arbitrarily high scores
+    ## merge_clusters_after_pysam will generate arbitrarily high scores
     ## It would be nice to do something here like test if
     ## the average insert length + 2 stdv is > 2*read len
     ## so you can switch off merging for mostly non-overlapping data
-    if reads_overlap:
-        if data._hackersonly["refmap_merge_PE"]:
-            clust = merge_after_pysam(data, clust)
-            #clust = merge_pair_pipes(data, clust)
-
-    return clust
+    return clust, reads_overlap
 
 
 
 
-def ref_build_and_muscle_chunk(data, sample):
+def ref_merge_regions(data, sample):
     """ 
-    1. Run bedtools to get all overlapping regions
-    2. Parse out reads from regions using pysam and dump into chunk files. 
-       We measure it out to create 10 chunk files per sample. 
-    3. If we really wanted to speed this up, though it is pretty fast already, 
-       we could parallelize it since we can easily break the regions into 
-       a list of chunks. 
+    Run bedtools to get all overlapping regions of a sample and write them
+    to a regions file in the tmpdir. The regions are sorted by chrom and
+    position, and each ref_fetch_chunk job takes a contiguous block of them.
     """
+    regions = bedtools_merge(data, sample).strip()
+    with open(ref_regions_path(data, sample), 'w') as out:
+        out.write(regions)
+
 
-    ## get regions using bedtools
-    regions = bedtools_merge(data, sample).strip().split("\n")
+
+def ref_fetch_chunk(data, sample, chunk):
+    """ 
+    Parse out reads from one block of the regions of a sample using pysam,
+    each job reading the indexed bam file on its own, and dump them into a
+    cluster container for the chunk. Chunks are joined in the order of the
+    regions by ref_build_and_muscle_chunk.
+    """
+    ## get this chunk's block of regions
+    with open(ref_regions_path(data, sample), 'r') as inregions:
+        regions = [i for i in inregions.read().split("\n") if i.strip()]
     nregions = len(regions)
-    chunksize = (nregions / 10) + (nregions % 10)
-
-    LOGGER.debug("nregions {} chunksize {}".format(nregions, chunksize))
-    ## create an output file to write clusters to
-    idx = 0
-    tmpfile = os.path.join(data.tmpdir, sample.name+"_chunk_{}.ali")
-    ## remove old files if they exist to avoid append errors
-    for i in range(11):
-        if os.path.exists(tmpfile.format(i)):
-            os.remove(tmpfile.format(i))
-    fopen = open
-
-    ## If reference+denovo we drop the reads back into clust.gz
-    ## and let the muscle_chunker do it's thing back in cluster_within
-    if data.paramsdict["assembly_method"] == "denovo+reference":
-        tmpfile = os.path.join(data.dirs.clusts, sample.name+".clust.gz")
-        fopen = gzip.open
-    
+    start = (nregions * chunk) // REF_FETCH_CHUNKS
+    end = (nregions * (chunk + 1)) // REF_FETCH_CHUNKS
+    LOGGER.debug("%s regions %s-%s of %s", sample.name, start, end, nregions)
+
     ## build clusters for aligning with muscle from the sorted bam file
     samfile = pysam.AlignmentFile(sample.files.mapped_reads, 'rb')
-    #"./tortas_refmapping/PZ70-mapped-sorted.bam", "rb")
+    outfile = ClustWriter(ref_chunk_path(data, sample, chunk))
 
-    ## fill clusts list and dump periodically
+    ## fill clusts list and dump periodically, with the indices of the
+    ## paired clusters in it that need merging
     clusts = []
-    nclusts = 0
-    for region in regions:
-        chrom, pos1, pos2 = region.split()
-        try:
-            ## fetches pairs quickly but then goes slow to merge them.
-            if "pair" in data.paramsdict["datatype"]:
-                clust = fetch_cluster_pairs(data, samfile, chrom, int(pos1), int(pos2))
+    tomerge = []
+    try:
+        for region in regions[start:end]:
+            chrom, pos1, pos2 = region.split()[:3]
+            merge = False
+            try:
+                ## fetches pairs quickly, merged in batches when dumped
+                if "pair" in data.paramsdict["datatype"]:
+                    clust, merge = fetch_cluster_pairs(data, samfile, chrom, int(pos1), int(pos2))
+                    merge = merge and data._hackersonly["refmap_merge_PE"]
+
+                ## fetch but no need to merge
+                else:
+                    clust = fetch_cluster_se(data, samfile, chrom, int(pos1), int(pos2))
+            except IndexError:
+                LOGGER.error("Bad region chrom:start-end {}:{}-{}".format(chrom, pos1, pos2))
+                continue
+            if clust:
+                if merge:
+                    tomerge.append(len(clusts))
+                clusts.append(clust)
+                if len(clusts) == CLUSTBLOCK:
+                    write_fetched_clusters(data, outfile, clusts, tomerge)
+                    clusts = []
+                    tomerge = []
+        write_fetched_clusters(data, outfile, clusts, tomerge)
+
+    ## cleanup
+    finally:
+        outfile.close()
+        samfile.close()
+
+
+
+def write_fetched_clusters(data, outfile, clusts, tomerge):
+    """ 
+    Merges the read pairs of the clusters at the indices tomerge with a 
+    single vsearch call and adds the block of clusters to the outfile.
+    Clusters left without reads after merging are dropped.
+    """
+    if tomerge:
+        merged = merge_clusters_after_pysam(data, [clusts[i] for i in tomerge])
+        for idx, clust in zip(tomerge, merged):
+            clusts[idx] = clust
+    outfile.add_text(["\n".join(i) for i in clusts if i])
+
 
-            ## fetch but no need to merge
-            else:
-                clust = fetch_cluster_se(data, samfile, chrom, int(pos1), int(pos2))
-        except IndexError as inst:
-            LOGGER.error("Bad region chrom:start-end {}:{}-{}".format(chrom, pos1, pos2))
-            continue
-        if clust:
-            clusts.append("\n".join(clust))
-            nclusts += 1
-
-            if nclusts == chunksize:
-                ## write to file
-                tmphandle = tmpfile.format(idx)
-                with fopen(tmphandle, 'a') as tmp:
-                    #LOGGER.debug("Writing tmpfile - {}".format(tmpfile.format(idx)))
-                    #if data.paramsdict["assembly_method"] == "denovo+reference":
-                    #    ## This is dumb, but for this method you need to prepend the
-                    #    ## separator to maintain proper formatting of clust.gz
-                    tmp.write("\n//\n//\n".join(clusts)+"\n//\n//\n")
-                idx += 1
-                nclusts = 0
-                clusts = []
-    if clusts:
-        ## write remaining to file
-        with fopen(tmpfile.format(idx), 'a') as tmp:
-            #tmp.write("\n//\n//\n" + ("\n//\n//\n".join(clusts)))
-            tmp.write("\n//\n//\n".join(clusts)+"\n//\n//\n")
-        clusts = []
-    
-    if not data.paramsdict["assembly_method"] == "denovo+reference":
-        chunkfiles = glob.glob(os.path.join(data.tmpdir, sample.name+"_chunk_*.ali"))
-        LOGGER.info("created chunks %s", chunkfiles)
+
+def ref_build_and_muscle_chunk(data, sample):
+    """ 
+    Joins the clusters built from each block of regions by ref_fetch_chunk,
+    in the order of the regions. If reference+denovo we drop them back into
+    clust.gz and let the muscle_chunker do it's thing back in cluster_within,
+    otherwise they are copied to a new cluster container.
+    """
+    clustfile = os.path.join(data.dirs.clusts, sample.name+".clust.gz")
+    chunks = [ref_chunk_path(data, sample, i) for i in xrange(REF_FETCH_CHUNKS)]
+
+    if data.paramsdict["assembly_method"] == "denovo+reference":
+        with gzip.open(clustfile, 'a') as outfile:
+            for chunk in chunks:
+                with ClustFile(chunk) as inclusts:
+                    clusts = []
+                    for names, seqs, _ in inclusts.iter_clusters():
+                        clusts.append(cluster_text(names, seqs))
+                        if len(clusts) == CLUSTBLOCK:
+                            write_ref_clusters(outfile, clusts)
+                            clusts = []
+                    if clusts:
+                        write_ref_clusters(outfile, clusts)
+    else:
+        with ClustWriter(clustbin_path(clustfile)) as outfile:
+            for chunk in chunks:
+                with ClustFile(chunk) as inclusts:
+                    outfile.add_file(inclusts)
 
     ## cleanup
-    samfile.close()
+    for tmpfile in chunks + [ref_regions_path(data, sample)]:
+        os.remove(tmpfile)
+
+
+
+def ref_regions_path(data, sample):
+    """ the regions file of a sample written by ref_merge_regions """
+    return os.path.join(data.tmpdir, sample.name+"-ref-regions.bed")
+
+
+
+def ref_chunk_path(data, sample, chunk):
+    """ the cluster container of a chunk of regions of a sample """
+    return os.path.join(data.tmpdir, "{}-ref-chunk-{}.hdf5".format(sample.name, chunk))
+
+
+
+def write_ref_clusters(outfile, clusts):
+    """ append clusters to the clust.gz text file or a cluster container """
+    if isinstance(outfile, ClustWriter):
+        outfile.add_text(clusts)
+    else:
+        outfile.write("\n//\n//\n".join(clusts)+"\n//\n//\n")
 
 
 
@@ -974,6 +1189,112 @@ def trim_reference_sequence(fasta):
 
 
 
+class ReferenceFasta(object):
+    """
+    In-process access to regions of the reference sequence by the offsets
+    in its samtools .fai index. An uncompressed reference is memory-mapped
+    read-only, so the engines on a host share the page cache of a single
+    copy of it, and a bgzip compressed reference is read with pysam. The
+    index files are <prefix>.fai (and .gzi), by default next to the 
+    reference. Use reference_fasta() to get the accessor cached on each 
+    engine.
+    """
+    def __init__(self, path, prefix=None):
+        prefix = prefix or path
+        faifile = prefix + ".fai"
+        if not os.path.exists(faifile):
+            raise IPyradError(NO_REF_INDEX.format(faifile))
+        self.path = path
+        self.prefix = prefix
+        self.mtime = os.path.getmtime(faifile)
+        self.tmpdir = None
+
+        ## name: (length, offset, bases per line, bytes per line)
+        self.index = {}
+        with open(faifile, 'r') as infai:
+            for line in infai:
+                if line.strip():
+                    name, length, offset, lbases, lwidth = line.split("\t")[:5]
+                    self.index[name] = (int(length), int(offset), 
+                                        int(lbases), int(lwidth))
+
+        with open(path, 'rb') as infile:
+            bgzip = infile.read(2) == "\x1f\x8b"
+        if bgzip:
+            ## pysam reads the .fai and .gzi next to the fasta, so an index
+            ## in the cache is opened through symlinks in a tmp dir
+            fastapath = path
+            if os.path.abspath(prefix) != os.path.abspath(path):
+                self.tmpdir = tempfile.mkdtemp(prefix="ipyrad-ref-")
+                fastapath = os.path.join(self.tmpdir, os.path.basename(path))
+                os.symlink(os.path.abspath(path), fastapath)
+                for ext in [".fai", ".gzi"]:
+                    if os.path.exists(prefix + ext):
+                        os.symlink(os.path.abspath(prefix + ext), fastapath + ext)
+            self.fasta = pysam.FastaFile(fastapath)
+            self.handle = self.mmap = None
+        else:
+            self.fasta = None
+            self.handle = open(path, 'rb')
+            self.mmap = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+    def fetch(self, chrom, start, end):
+        """ 
+        sequence of the 0-based half-open region start-end of chrom, 
+        clipped to the length of chrom like samtools faidx.
+        """
+        try:
+            length, offset, lbases, lwidth = self.index[chrom]
+        except KeyError:
+            raise IPyradError(BAD_REF_REGION.format(chrom, start, end))
+        start = max(0, start)
+        end = min(end, length)
+        if start >= end:
+            return ""
+        if self.fasta:
+            return self.fasta.fetch(chrom, start, end)
+
+        ## byte offsets of the first and last base, skipping line ends
+        bstart = offset + (start // lbases) * lwidth + (start % lbases)
+        bend = offset + ((end - 1) // lbases) * lwidth + ((end - 1) % lbases) + 1
+        return self.mmap[bstart:bend].replace("\n", "").replace("\r", "")
+
+
+    def close(self):
+        """ unmap the reference """
+        if self.mmap:
+            self.mmap.close()
+            self.handle.close()
+        if self.fasta:
+            self.fasta.close()
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+
+def reference_fasta(data):
+    """
+    The ReferenceFasta of the reference_sequence of an Assembly. It is opened
+    once per engine and kept for later jobs, unless the reference has been
+    reindexed since.
+    """
+    path = data.paramsdict["reference_sequence"]
+    prefix = reference_index(data)
+    reference = REFERENCES.get(path)
+    if reference:
+        try:
+            if (reference.prefix == prefix) and \
+                (os.path.getmtime(prefix + ".fai") == reference.mtime):
+                return reference
+        except OSError:
+            pass
+        reference.close()
+    reference = REFERENCES[path] = ReferenceFasta(path, prefix)
+    return reference
+
+
+
 def bam_region_to_fasta(data, sample, proc1, chrom, region_start, region_end):
     """ 
     Take the chromosome position, and start and end bases and return sequences
@@ -1011,8 +1332,8 @@ def bam_region_to_fasta(data, sample, proc1, chrom, region_start, region_end):
 
     ## a string argument as input to commands, indexed at either 0 or 1, 
     ## and with pipe characters removed from chromo names
-    ## rstring_id1 is for fetching the reference sequence bcz faidx is
-    ## 1 indexed
+    ## rstring_id1 is for naming the reference sequence 1 indexed, like 
+    ## samtools faidx
     rstring_id1 = "{}:{}-{}"\
         .format(chrom, str(int(region_start)+1), region_end)
 
@@ -1035,42 +1356,18 @@ def bam_region_to_fasta(data, sample, proc1, chrom, region_start, region_end):
         .format(chrom, int(region_start) + overlap_buffer,\
                 int(region_end) - overlap_buffer)
 
-    ## The "samtools faidx" command will grab this region from reference 
-    ## which we'll paste in at the top of each stack to aid alignment.
-    cmd1 = [ipyrad.bins.samtools, "faidx", 
-            data.paramsdict["reference_sequence"], 
-            rstring_id1, " ; echo __done__"]
-
-    ## Call the command, I found that it doesn't work with shell=False if 
-    ## the refstring is 'MT':100-200', but it works if it is MT:100-200. 
-    LOGGER.info("Grabbing bam_region_to_fasta:\n {}".format(cmd1))
-    #proc1 = sps.Popen(cmd1, stderr=sps.STDOUT, stdout=sps.PIPE)
-    #ref = proc1.communicate()[0]
-    #if proc1.returncode:
-    #    raise IPyradWarningExit("  error in %s: %s", cmd1, ref)
-
-    ## push the samtools faidx command to our subprocess, then accumulate
-    ## the results from stdout
-    print(" ".join(cmd1), file=proc1.stdin)
-    ref = ""
-    for line in iter(proc1.stdout.readline, "//\n"):
-        if "__done__" in line:
-            break
-        ref += line
-
     ## initialize the fasta list.
     fasta = []
 
-    ## parse sam to fasta. Save ref location to name.
+    ## grab this region from the reference, which we'll paste in at the 
+    ## top of each stack to aid alignment. Save ref location to name.
     ## Set size= an improbably large value so the REF sequence
     ## sorts to the top for muscle aligning.
     try:
-        name, seq = ref.strip().split("\n", 1)
-        seq = "".join(seq.split("\n"))
-        fasta = ["{}_REF;size={};+\n{}".format(name, 1000000, seq)]
-    except ValueError as inst:
-        LOGGER.error("ref failed to parse - {}".format(ref))
-        LOGGER.error(" ".join(cmd1))
+        seq = reference_fasta(data).fetch(chrom, int(region_start), int(region_end))
+        fasta = [">{}_REF;size={};+\n{}".format(rstring_id1, 1000000, seq)]
+    except IPyradError as inst:
+        LOGGER.error("ref failed to fetch - {}".format(inst))
 
     ## if PE then you have to merge the reads here
     if "pair" in data.paramsdict["datatype"]:
@@ -1249,10 +1546,10 @@ def refmap_stats(data, sample):
     proc1 = sps.Popen(cmd1, stderr=sps.STDOUT, stdout=sps.PIPE)
     result1 = proc1.communicate()[0]
 
-    ## get from mapped
-    cmd2 = [ipyrad.bins.samtools, "flagstat", mapf]
-    proc2 = sps.Popen(cmd2, stderr=sps.STDOUT, stdout=sps.PIPE)
-    result2 = proc2.communicate()[0]
+    ## get from mapped, which only has mapped primary alignments, so it
+    ## is the count of mapped reads in its index
+    with pysam.AlignmentFile(mapf, 'rb') as samfile:
+        result2 = str(samfile.mapped)
 
     ## store results
     ## If PE, samtools reports the _actual_ number of reads mapped, both 
@@ -1286,6 +1583,41 @@ def refmap_init(data, sample, force):
 
 
 ## GLOBALS
+
+## blocks of regions that the mapped reads of a sample are fetched in
+REF_FETCH_CHUNKS = 10
+
+## bytes read at a time to checksum the reference
+CHECKSUM_BLOCK = 2**22
+
+## ReferenceFasta of each reference path opened on this engine
+REFERENCES = {}
+
+NO_REF_INDEX = """\
+    Reference index {} not found. It is written by samtools faidx
+    when the reference sequence is indexed in step 3.
+    """
+
+BAD_INDEX_DIR = """\
+    Cannot create the reference index cache dir {}. Set the hackersonly
+    parameter reference_index_dir to a writable directory.
+    """
+
+STALE_REF_INDEX = """\
+    The reference index {} made by step 3 is not an index of the
+    reference_sequence {}. The reference has changed since step 3,
+    rerun step 3 with force to index and map to the new reference.
+    """
+
+NO_MAPPER_VERSION = """\
+    Could not get the version of the mapper from `{}`:
+    {}
+    """
+
+BAD_REF_REGION = """\
+    Reference region {}:{}-{} not found in the reference sequence.
+    """
+
 INDEX_MSG = """\
   *************************************************************
   Indexing reference sequence with {}. 
@@ -0,0 +1,304 @@
+#!/usr/bin/env python2.7
+
+"""
+Storage layout of the step 6 clust_database and the step 7 database. Every
+locus-indexed dataset is chunked in blocks of loci that span all of its
+other dimensions, and step 7 reads the databases in slices of exactly one
+block (the "chunksize" attr of seqs), so both the per-sample writes of
+step 6 and the all-sample reads of step 7 touch whole chunks. The block
+length and the compression filter are set by the _hackersonly parameters
+database_chunk_loci (0=auto) and database_compression (gzip, lzf, blosc
+or None). Existing databases can be rewritten with a new layout by
+rechunk(), and read_throughput() times the step 7 access patterns. Engines
+write slices into a shared database while holding a DatabaseLock.
+"""
+
+from __future__ import print_function
+# pylint: disable=E1101
+# pylint: disable=W0212
+
+import os
+import time
+import fcntl
+import numpy as np
+import pandas as pd
+
+from ipyrad.assemble.util import IPyradError
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+import warnings
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    import h5py
+
+## importing hdf5plugin registers the blosc filter with HDF5
+try:
+    import hdf5plugin
+except ImportError:
+    pass
+
+
+
+class DatabaseLock(object):
+    """
+    Inter-process lock on an hdf5 file, held for as long as the file is
+    open so that engines can write their slices into the same database.
+    HDF5 does not support concurrent writers, so writers hold the lock 
+    exclusively and readers share it. Uses POSIX record locks on a 
+    <path>.lock file, which also hold across hosts on NFS.
+    """
+    def __init__(self, path, write=True):
+        self.path = path + ".lock"
+        self.write = write
+        self.handle = None
+
+
+    def __enter__(self):
+        self.handle = open(self.path, 'a+')
+        fcntl.lockf(self.handle, fcntl.LOCK_EX if self.write else fcntl.LOCK_SH)
+        return self
+
+
+    def __exit__(self, *args):
+        fcntl.lockf(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
+
+
+
+def chunk_loci(data, nsamples, maxlen, nloci):
+    """
+    number of loci in a chunk of the databases. Auto sizes to about 2
+    chunks per core, halved until a slice of catgs across all samples
+    (what step 7 holds in memory) is under CHUNK_MAX_ELEMENTS.
+    """
+    chunks = data._hackersonly["database_chunk_loci"]
+    if chunks:
+        return max(1, min(int(chunks), nloci))
+
+    ## data.cpus is only set while a step runs, e.g., not by rechunk()
+    cpus = max(1, getattr(data, "cpus", 0) or data._ipcluster["cores"])
+    chunks = (nloci // (cpus*2)) + (nloci % (cpus*2))
+    chunklen = chunks * nsamples * maxlen * 4
+    while chunklen > CHUNK_MAX_ELEMENTS:
+        chunks = (chunks // 2) + (chunks % 2)
+        chunklen = chunks * nsamples * maxlen * 4
+    return max(1, chunks)
+
+
+
+def compression_opts(compression, key):
+    """ create_dataset kwargs of a compression filter for a dataset """
+    if key in UNCOMPRESSED or not compression:
+        return {}
+    if compression == "gzip":
+        opts = {"compression": "gzip"}
+    elif compression == "lzf":
+        opts = {"compression": "lzf"}
+    elif compression == "blosc":
+        if not h5py.h5z.filter_avail(BLOSC_FILTER):
+            raise IPyradError(NO_BLOSC)
+        opts = {"compression": BLOSC_FILTER, "compression_opts": BLOSC_OPTS}
+    else:
+        raise IPyradError(BAD_COMPRESSION.format(compression))
+
+    ## byte shuffling helps the compression of the uint32 base counts
+    if key in SHUFFLED and compression != "blosc":
+        opts["shuffle"] = True
+    return opts
+
+
+
+def create_dataset(io5, key, shape, dtype, chunks, compression):
+    """
+    creates a locus-indexed dataset chunked by blocks of chunks loci, with
+    a compression filter (e.g., data._hackersonly["database_compression"])
+    unless it is one of the UNCOMPRESSED flag arrays.
+    """
+    return io5.create_dataset(key, shape,
+        dtype=dtype,
+        chunks=chunk_shape(shape, chunks),
+        **compression_opts(compression, key))
+
+
+
+def chunk_shape(shape, chunks):
+    """ chunk of a locus block spanning all other dims """
+    return (max(1, min(chunks, shape[0])), ) + tuple(shape[1:])
+
+
+
+def rechunk(data, chunks=None, compression="default"):
+    """
+    Rewrites the clust_database (and its per-sample catg files) and the
+    step 7 database of an Assembly with a new chunk length and compression.
+    Defaults to the current _hackersonly settings; compression=None writes
+    uncompressed datasets. Virtual datasets are kept virtual and their
+    source files are rewritten instead.
+    """
+    if not os.path.exists(data.clust_database):
+        raise IPyradError(NO_DATABASE.format(data.name))
+    if compression == "default":
+        compression = data._hackersonly["database_compression"]
+    ## check the filter is available before rewriting anything
+    compression_opts(compression, "seqs")
+    if not chunks:
+        with h5py.File(data.clust_database, 'r') as io5:
+            nloci, nsamples, maxlen = io5["seqs"].shape
+        chunks = chunk_loci(data, nsamples, maxlen, nloci)
+
+    for dbfile in [data.clust_database, data.database]:
+        if dbfile and os.path.exists(dbfile):
+            for source in virtual_sources(dbfile):
+                rechunk_file(source, chunks, compression)
+            rechunk_file(dbfile, chunks, compression)
+    data.chunks = chunks
+    LOGGER.info("rechunked databases of %s to %s loci (%s)",
+                data.name, chunks, compression)
+
+
+
+def virtual_sources(dbfile):
+    """ paths of the files that the virtual datasets of dbfile map to """
+    sources = set()
+    with h5py.File(dbfile, 'r') as io5:
+        for key in io5:
+            if io5[key].is_virtual:
+                for vmap in io5[key].virtual_sources():
+                    sources.add(os.path.join(os.path.dirname(dbfile), vmap.file_name))
+    return sorted(sources)
+
+
+
+def rechunk_file(path, chunks, compression):
+    """
+    rewrites every dataset of a file in blocks of loci to a new file with
+    the new layout and replaces the original. Virtual datasets are copied
+    as virtual datasets with the same mapping.
+    """
+    tmpfile = path + ".rechunk"
+    with h5py.File(path, 'r', rdcc_nbytes=RECHUNK_CACHE) as inh5, \
+         h5py.File(tmpfile, 'w') as outh5:
+        for key in inh5:
+            dset = inh5[key]
+            if dset.is_virtual:
+                new = outh5.create_virtual_dataset(
+                    key, virtual_layout(dset), fillvalue=dset.fillvalue)
+            elif not dset.shape:
+                new = outh5.create_dataset(key, data=dset[()])
+            else:
+                new = create_dataset(outh5, key, dset.shape, dset.dtype,
+                                     chunks, compression)
+                oldchunk = dset.chunks[0] if dset.chunks else chunks
+                block = chunks * max(1, -(-oldchunk // chunks))
+                for start in xrange(0, dset.shape[0], block):
+                    new[start:start+block] = dset[start:start+block]
+
+            ## copy attrs, with the new chunk length
+            for name, value in dset.attrs.items():
+                if name == "chunksize":
+                    value = np.array(value)
+                    value.flat[0] = chunks
+                new.attrs[name] = value
+    os.rename(tmpfile, path)
+
+
+
+def virtual_layout(dset):
+    """
+    the VirtualLayout of an existing virtual dataset. Each mapping must be
+    a simple block, as written by build_catg_database.
+    """
+    layout = h5py.VirtualLayout(shape=dset.shape, dtype=dset.dtype)
+    dbdir = os.path.dirname(dset.file.filename)
+    for vmap in dset.virtual_sources():
+        lower, upper = vmap.vspace.get_select_bounds()
+        index = tuple(slice(i, j+1) for i, j in zip(lower, upper))
+        ## the source space of a mapping does not keep its extent
+        with h5py.File(os.path.join(dbdir, vmap.file_name), 'r') as src:
+            shape = src[vmap.dset_name].shape
+        layout[index] = h5py.VirtualSource(vmap.file_name, vmap.dset_name, shape=shape)
+    return layout
+
+
+
+def read_throughput(data, maxslices=None):
+    """
+    Times the step 7 access pattern, reading slices of one chunk of loci
+    across all samples, on each locus-indexed dataset of the clust_database
+    and the step 7 database. Returns a DataFrame with the chunk shape,
+    compression, MB read (uncompressed) and MB/s and loci/s per dataset.
+    """
+    if not os.path.exists(data.clust_database):
+        raise IPyradError(NO_DATABASE.format(data.name))
+    with h5py.File(data.clust_database, 'r') as io5:
+        optim = int(io5["seqs"].attrs["chunksize"][0])
+
+    stats = []
+    for dbfile in [data.clust_database, data.database]:
+        if not (dbfile and os.path.exists(dbfile)):
+            continue
+        with h5py.File(dbfile, 'r') as io5:
+            for key in io5:
+                dset = io5[key]
+                if not dset.shape:
+                    continue
+                nloci = dset.shape[0]
+                if maxslices:
+                    nloci = min(nloci, optim * maxslices)
+                start = time.time()
+                nbytes = 0
+                for hslice in xrange(0, nloci, optim):
+                    nbytes += dset[hslice:hslice+optim].nbytes
+                elapsed = max(time.time() - start, 1e-9)
+                stats.append({
+                    "file": os.path.basename(dbfile),
+                    "dataset": key,
+                    "chunks": "virtual" if dset.is_virtual else dset.chunks,
+                    "compression": dset.compression,
+                    "MB": nbytes / 1e6,
+                    "MB/s": nbytes / 1e6 / elapsed,
+                    "loci/s": nloci / elapsed,
+                    })
+    stats = pd.DataFrame(stats, columns=THROUGHPUT_COLUMNS)
+    LOGGER.info("database read throughput:\n%s", stats)
+    return stats
+
+
+
+### GLOBALS
+
+## elements in a slice of catgs across all samples
+CHUNK_MAX_ELEMENTS = int(500e6)
+
+## small flag arrays are read and written whole, no filter
+UNCOMPRESSED = ["splits", "duplicates", "filters"]
+
+## datasets of base counts that compress better byte-shuffled
+SHUFFLED = ["catgs", "icatg"]
+
+## registered HDF5 filter id of blosc, and its options
+## (reserved, reserved, reserved, reserved, clevel, shuffle, compressor=lz4)
+BLOSC_FILTER = 32001
+BLOSC_OPTS = (0, 0, 0, 0, 5, 1, 1)
+
+## chunk cache of the input file while rechunking
+RECHUNK_CACHE = 2**26
+
+THROUGHPUT_COLUMNS = [
+    "file", "dataset", "chunks", "compression", "MB", "MB/s", "loci/s"]
+
+NO_BLOSC = """\
+    The blosc HDF5 filter is not available. Install hdf5plugin
+    (conda install -c conda-forge hdf5plugin) or set the hackersonly
+    parameter database_compression to gzip or lzf.
+    """
+
+BAD_COMPRESSION = """\
+    Unknown database_compression {}. Use gzip, lzf, blosc or None.
+    """
+
+NO_DATABASE = """\
+    Assembly {} has no step 6 database. Run step 6 first.
+    """
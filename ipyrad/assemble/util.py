@@ -16,6 +16,7 @@ import tempfile
 import itertools
 import ipyrad
 import gzip
+import numpy as np
 from collections import defaultdict
 
 try:
@@ -443,10 +444,22 @@ def merge_pairs_after_refmapping(data, two_files, merged_out):
 def merge_after_pysam(data, clust):
     """
     This is for pysam post-flight merging. The input is a cluster
-    for an individual locus. We have to split the clusters, write
-    R1 and R2 to files then call merge_pairs(). This is not ideal,
-    it's slow, but it works. This is the absolute worst way to do this,
-    it bounces all the files for each locus off the disk. I/O _hog_.
+    for an individual locus. See merge_clusters_after_pysam, which
+    merges the clusters of many loci at once.
+    """
+    return merge_clusters_after_pysam(data, [clust])[0]
+
+
+
+def merge_clusters_after_pysam(data, clusts):
+    """
+    Merges the read pairs of a batch of clusters with a single call to
+    merge_pairs(), rather than bouncing files off the disk for each locus.
+    The input is a list of clusters, each a list of ">name\nR1nnnnR2" reads.
+    Read names are prefixed with the index of their cluster so the merged
+    reads can be sorted back into their clusters. Returns a list with a
+    cluster of alternating names and seqs for each input cluster, with its
+    merged reads first, the same as merging each cluster on its own.
     """
     try:
         r1file = tempfile.NamedTemporaryFile(mode='wb', delete=False,
@@ -458,25 +471,26 @@ def merge_after_pysam(data, clust):
 
         r1dat = []
         r2dat = []
-        for locus in clust:
-            sname, seq = locus.split("\n")
-            ## Have to munge the sname to make it look like fastq format
-            sname = "@" + sname[1:]
-            r1, r2 = seq.split("nnnn")
-            r1dat.append("{}\n{}\n{}\n{}".format(sname, r1, "+", "B"*(len(r1))))
-            r2dat.append("{}\n{}\n{}\n{}".format(sname, r2, "+", "B"*(len(r2))))
+        for cidx, clust in enumerate(clusts):
+            for locus in clust:
+                sname, seq = locus.split("\n")
+                ## Have to munge the sname to make it look like fastq format
+                sname = "@{}_{}".format(cidx, sname[1:])
+                r1, r2 = seq.split("nnnn")
+                r1dat.append("{}\n{}\n{}\n{}".format(sname, r1, "+", "B"*(len(r1))))
+                r2dat.append("{}\n{}\n{}\n{}".format(sname, r2, "+", "B"*(len(r2))))
 
         r1file.write("\n".join(r1dat))
         r2file.write("\n".join(r2dat))
         r1file.close()
         r2file.close()
 
-        ## Read in the merged data and format to return as a clust
+        ## Read in the merged data and format to return as clusts
         merged_file = tempfile.NamedTemporaryFile(mode='wb',
                                             dir=data.dirs.edits,
                                             suffix="_merged.fastq").name
 
-        clust = []
+        clusts = [[] for _ in clusts]
         merge_pairs(data, [(r1file.name, r2file.name)], merged_file, 0, 1)
 
         with open(merged_file) as infile:
@@ -495,14 +509,14 @@ def merge_after_pysam(data, clust):
                             R1, R2 = seq.split("nnnn")
                             seq = R1 + "nnnn" + revcomp(R2)
                         except ValueError as inst:
-                            LOGGER.error("Failed merge_after_pysam: {} {}".format(sname, seq))
+                            LOGGER.error("Failed merge_clusters_after_pysam: {} {}".format(sname, seq))
                             raise
 
                 except StopIteration:
                     break
-                ## put sname back
-                sname = ">" + sname[1:]
-                clust.extend([sname.strip(), seq.strip()])
+                ## put sname back in its cluster
+                cidx, sname = sname[1:].split("_", 1)
+                clusts[int(cidx)].extend([">" + sname.strip(), seq.strip()])
     except:
         LOGGER.info("Error in merge_pairs post-refmap.")
         raise
@@ -514,7 +528,7 @@ def merge_after_pysam(data, clust):
                 ## if not log_level == "DEBUG":
                 os.remove(i)
 
-    return clust
+    return clusts
 
 
 
@@ -887,6 +901,55 @@ def clustdealer(pairdealer, optim):
 
 
 
+def parse_cluster(chunk):
+    """ 
+    return names, seqs and replicate depths (size=) of a cluster from 
+    clustdealer 
+    """
+    piece = chunk[0].strip().split("\n")
+    names = piece[0::2]
+    seqs = piece[1::2]
+    reps = [int(sname.split(";")[-2][5:]) for sname in names]
+    return names, seqs, reps
+
+
+
+def stack_cluster(seqs, reps, maxlen=None):
+    """
+    return the aligned seqs of a cluster as a uint8 array with one row per
+    seq and an int array of the number of reads each row stands for. This
+    is used instead of copying each seq once per replicate read.
+    """
+    ncols = len(seqs[0])
+    if maxlen is not None:
+        ncols = min(ncols, maxlen)
+    arr = np.fromstring("".join([seq[:ncols] for seq in seqs]), dtype=np.uint8)
+    return arr.reshape(len(seqs), ncols), np.array(reps, dtype=np.int64)
+
+
+
+def stack_counts(arr, reps, symbols="CATG"):
+    """
+    return an array (ncols, len(symbols)) with the number of reads with each
+    symbol in each column of a stack from stack_cluster. Other bytes are not
+    counted.
+    """
+    nsyms = len(symbols) + 1
+    index = np.zeros(256, dtype=np.int64)
+    index.fill(len(symbols))
+    index[np.fromstring(symbols, dtype=np.uint8)] = np.arange(len(symbols))
+
+    ## one bin per symbol per column, weighted by the reads in each row
+    ncols = arr.shape[1]
+    sidx = index[arr] + np.arange(ncols) * nsyms
+    counts = np.bincount(
+        sidx.ravel(), 
+        weights=np.repeat(reps, ncols), 
+        minlength=ncols * nsyms)
+    return counts.reshape(ncols, nsyms)[:, :len(symbols)].astype(np.uint64)
+
+
+
 
 def progressbar(njobs, finished, msg="", spacer="  "):
     """ prints a progress bar """
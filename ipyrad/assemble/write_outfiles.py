@@ -21,18 +21,23 @@ from __future__ import print_function
 import pandas as pd
 import numpy as np
 import datetime
-import shutil
 import numba
+import itertools
+import threading
+import Queue
 import copy
 import time
 import glob
-import gzip
 import re
 import os
 import io
-from collections import Counter, OrderedDict
+from collections import Counter
 from ipyrad import __version__
 from util import *
+from profiler import profiled
+from storage import create_dataset, DatabaseLock
+from bgzf import BgzfWriter, TabixIndex
+from refmap import reference_index
 
 try:
     import subprocess32 as sps
@@ -66,7 +71,7 @@ OUTPUT_FORMATS = {'l': 'loci',
                   'v': 'vcf',
                   't': 'treemix',
                   'm': 'migrate-n'}
-                  #'V': 'vcfFull',   ## currently hidden
+                  #'V': 'vcfFull',   ## hidden, all sites vcf
 
 
 def run(data, samples, force, ipyclient):
@@ -101,10 +106,10 @@ def run(data, samples, force, ipyclient):
     output_formats = data.paramsdict["output_formats"]
 
     ## held separate from *output_formats cuz it's big and parallelized
-    if any([x in output_formats for x in ["v", "V"]]):
-        full = "V" in output_formats
+    ## 'v' is variable sites only, the hidden 'V' all sites.
+    for vcfformat in [x for x in ["v", "V"] if x in output_formats]:
         try:
-            make_vcf(data, samples, ipyclient, full=full)
+            make_vcf(data, samples, ipyclient, full=vcfformat == "V")
         except IPyradWarningExit as inst:
             ## Something fsck vcf build. Sometimes this is simply a memory
             ## issue, so trap the exception and allow it to try building
@@ -356,11 +361,6 @@ def filter_all_clusters(data, samples, ipyclient):
         ## the total number of loci
         nloci = io5["seqs"].shape[0]
 
-    ## make a tmp directory for saving chunked arrays to
-    chunkdir = os.path.join(data.dirs.outfiles, data.name+"_tmpchunks")
-    if not os.path.exists(chunkdir):
-        os.mkdir(chunkdir)
-
     ## get the indices of the samples that we are going to include
     sidx = select_samples(dbsamples, samples)
     ## do the same for the populations samples
@@ -379,7 +379,9 @@ def filter_all_clusters(data, samples, ipyclient):
     LOGGER.info("samples %s \n, dbsamples %s \n, sidx %s \n",
                 samples, dbsamples, sidx)
 
-    ## Put inside a try statement so we can delete tmpchunks
+    ## Put inside a try statement so we can delete the lock file. Each job
+    ## writes its filters, edges and snps into the database.
+    fasyncs = {}
     try:
         ## load a list of args to send to Engines. Each arg contains the index
         ## to sample optim loci from catg, seqs, filters &or edges, which will
@@ -388,11 +390,12 @@ def filter_all_clusters(data, samples, ipyclient):
         ## create job queue
         start = time.time()
         printstr = " filtering loci        | {} | s7 |"
-        fasyncs = {}
         submitted = 0
         while submitted < nloci:
             hslice = np.array([submitted, submitted+optim])
-            fasyncs[hslice[0]] = lbview.apply(filter_stacks, *(data, sidx, hslice))
+            fasyncs[hslice[0]] = lbview.apply(
+                profiled(data, filter_stacks, "filtering loci"), 
+                *(data, sidx, hslice))
             submitted += optim
 
         ## run filter_stacks on all chunks
@@ -415,86 +418,16 @@ def filter_all_clusters(data, samples, ipyclient):
                              .format(async, fasyncs[async].exception()))
         ipyclient.purge_everything()
 
-        ## get all the saved tmp arrays for each slice
-        tmpsnp = glob.glob(os.path.join(chunkdir, "snpf.*.npy"))
-        tmphet = glob.glob(os.path.join(chunkdir, "hetf.*.npy"))
-        tmpmin = glob.glob(os.path.join(chunkdir, "minf.*.npy"))
-        tmpedg = glob.glob(os.path.join(chunkdir, "edgf.*.npy"))
-        tmppld = glob.glob(os.path.join(chunkdir, "pldf.*.npy"))
-        tmpind = glob.glob(os.path.join(chunkdir, "indf.*.npy"))
-
-        ## sort array files within each group
-        arrdict = OrderedDict([('ind', tmpind),
-                               ('snp', tmpsnp), ('het', tmphet),
-                               ('min', tmpmin), ('edg', tmpedg),
-                               ('pld', tmppld)])
-        for arrglob in arrdict.values():
-            arrglob.sort(key=lambda x: int(x.rsplit(".")[-2]))
-
-        ## re-load the full filter array who's order is
-        ## ["duplicates", "max_indels", "max_snps", "max_hets", "min_samps", "max_alleles"]
-        io5 = h5py.File(data.database, 'r+')
-        superfilter = np.zeros(io5["filters"].shape, io5["filters"].dtype)
-
-        ## iterate across filter types (dups is already filled)
-        ## we have [4,4] b/c minf and edgf both write to minf
-        for fidx, ftype in zip([1, 2, 3, 4, 4, 5], arrdict.keys()):
-            ## fill in the edgefilters
-            for ffile in arrdict[ftype]:
-                ## grab a file and get it's slice
-                hslice = int(ffile.split(".")[-2])
-                ## load in the array
-                arr = np.load(ffile)
-                ## store slice into full array (we use += here because the minf
-                ## and edgf arrays both write to the same filter).
-                superfilter[hslice:hslice+optim, fidx] += arr
-
-        ## store to DB
-        io5["filters"][:] += superfilter
-        del arr, superfilter
-
-        ## store the other arrayed values (edges, snps)
-        edgarrs = glob.glob(os.path.join(chunkdir, "edgearr.*.npy"))
-        snparrs = glob.glob(os.path.join(chunkdir, "snpsarr.*.npy"))
-
-        ## sort array files within each group
-        arrdict = OrderedDict([('edges', edgarrs), ('snps', snparrs)])
-        for arrglob in arrdict.values():
-            arrglob.sort(key=lambda x: int(x.rsplit(".")[-2]))
-
-        ## fill the edge array, splits are already in there.
-        superedge = np.zeros(io5['edges'].shape, io5['edges'].dtype)
-        for ffile in arrdict['edges']:
-            ## grab a file and get it's slice
-            hslice = int(ffile.split(".")[-2])
-            ## load in the array w/ shape (hslice, 5)
-            arr = np.load(ffile)
-            ## store slice into full array
-            superedge[hslice:hslice+optim, :] = arr
-        io5["edges"][:, :] = superedge
-        del arr, superedge
-
-        ## fill the snps array. shape= (nloci, maxlen, 2)
-        supersnps = np.zeros(io5['snps'].shape, io5['snps'].dtype)
-        for ffile in arrdict['snps']:
-            ## grab a file and get it's slice
-            hslice = int(ffile.split(".")[-2])
-            ## load in the array w/ shape (hslice, maxlen, 2)
-            arr = np.load(ffile)
-            ## store slice into full array
-            LOGGER.info("shapes, %s %s", supersnps.shape, arr.shape)
-            supersnps[hslice:hslice+optim, :, :] = arr
-        io5["snps"][:] = supersnps
-        del arr
-        io5.close()
-
     finally:
-        ## clean up the tmp files/dirs even if we failed.
-        try:
-            LOGGER.info("finished filtering")
-            shutil.rmtree(chunkdir)
-        except (IOError, OSError):
-            pass
+        ## on an error or interrupt jobs may still hold or wait on the lock,
+        ## so abort those not started and wait for the rest to finish.
+        pending = [i for i in fasyncs.values() if not i.ready()]
+        if pending:
+            ipyclient.abort(pending)
+            ipyclient.wait(pending)
+        lockfile = data.database + ".lock"
+        if os.path.exists(lockfile):
+            os.remove(lockfile)
 
 
 
@@ -553,7 +486,8 @@ def make_loci_and_stats(data, samples, ipyclient):
     loci_asyncs = {}
     for istart in xrange(0, nloci, optim):
         args = [data, optim, pnames, snppad, smask, istart, samplecov, locuscov, 1]
-        loci_asyncs[istart] = lbview.apply(locichunk, args)
+        loci_asyncs[istart] = lbview.apply(
+            profiled(data, locichunk, "building loci/stats"), args)
 
     while 1:
         done = [i.ready() for i in loci_asyncs.values()]
@@ -601,7 +535,8 @@ def make_loci_and_stats(data, samples, ipyclient):
         loci_asyncs = {}
         for istart in xrange(0, nloci, optim):
             args = [data, optim, pnames, snppad, smask, istart, samplecov, locuscov, 0]
-            loci_asyncs[istart] = lbview.apply(locichunk, args)
+            loci_asyncs[istart] = lbview.apply(
+                profiled(data, locichunk, "building loci/stats"), args)
 
         while 1:
             done = [i.ready() for i in loci_asyncs.values()]
@@ -834,25 +769,25 @@ def init_arrays(data):
     chunks = co5["seqs"].attrs["chunksize"][0]
     nloci = co5["seqs"].shape[0]
 
+    ## same chunk length and compression as the clust_database
+    compression = data._hackersonly["database_compression"]
+
     ## make array for snp string, 2 cols, - and *
-    snps = io5.create_dataset("snps", (nloci, maxlen, 2),
-                              dtype=np.bool,
-                              chunks=(chunks, maxlen, 2),
-                              compression='gzip')
+    snps = create_dataset(io5, "snps", (nloci, maxlen, 2),
+                          np.bool, chunks, compression)
     snps.attrs["chunksize"] = chunks
     snps.attrs["names"] = ["-", "*"]
 
     ## array for filters that will be applied in step7
-    filters = io5.create_dataset("filters", (nloci, 6), dtype=np.bool)
+    filters = create_dataset(io5, "filters", (nloci, 6), 
+                             np.bool, chunks, compression)
     filters.attrs["filters"] = ["duplicates", "max_indels",
                                 "max_snps", "max_shared_hets",
                                 "min_samps", "max_alleles"]
 
     ## array for edgetrimming
-    edges = io5.create_dataset("edges", (nloci, 5),
-                               dtype=np.uint16,
-                               chunks=(chunks, 5),
-                               compression="gzip")
+    edges = create_dataset(io5, "edges", (nloci, 5),
+                           np.uint16, chunks, compression)
     edges.attrs["chunksize"] = chunks
     edges.attrs["names"] = ["R1_L", "R1_R", "R2_L", "R2_R", "sep"]
 
@@ -879,9 +814,9 @@ def filter_stacks(data, sidx, hslice):
     """
     LOGGER.info("Entering filter_stacks")
 
-    ## open h5 handles
+    ## open h5 handles, other engines write to the database so hold the
+    ## lock while reading from it.
     io5 = h5py.File(data.clust_database, 'r')
-    co5 = h5py.File(data.database, 'r')
     ## get a chunk (hslice) of loci for the selected samples (sidx)
     #superseqs = io5["seqs"][hslice[0]:hslice[1], sidx,]
     ## get an int view of the seq array
@@ -898,7 +833,9 @@ def filter_stacks(data, sidx, hslice):
     ## clusters to the point that they are below the minlen, and so this
     ## also constitutes a filter, though one that is uncommon. For this
     ## reason we have another filter called edgfilter.
-    splits = co5["edges"][hslice[0]:hslice[1], 4]
+    with DatabaseLock(data.database, write=False), \
+         h5py.File(data.database, 'r') as co5:
+        splits = co5["edges"][hslice[0]:hslice[1], 4]
     edgfilter, edgearr = get_edges(data, superints, splits)
     del splits
     LOGGER.info('passed edges %s', hslice[0])
@@ -914,6 +851,7 @@ def filter_stacks(data, sidx, hslice):
     ## ploidy filter
     pldfilter = io5["nalleles"][hslice[0]:hslice[1]].max(axis=1) > \
                                          data.paramsdict["max_alleles_consens"]
+    io5.close()
 
     ## indel filter, needs a fresh superints b/c get_edges does (-)->(N)
     indfilter = filter_indels(data, superints, edgearr)
@@ -930,43 +868,21 @@ def filter_stacks(data, sidx, hslice):
     LOGGER.info("snp %s", snpfilter.sum())
     LOGGER.info("ind %s", indfilter.sum())
 
-    ## SAVE FILTERS AND INFO TO DISK BY SLICE NUMBER (.0.tmp.h5)
-    chunkdir = os.path.join(data.dirs.outfiles, data.name+"_tmpchunks")
-
-    handle = os.path.join(chunkdir, "edgf.{}.npy".format(hslice[0]))
-    with open(handle, 'w') as out:
-        np.save(out, edgfilter)
-
-    handle = os.path.join(chunkdir, "minf.{}.npy".format(hslice[0]))
-    with open(handle, 'w') as out:
-        np.save(out, minfilter)
-
-    handle = os.path.join(chunkdir, "hetf.{}.npy".format(hslice[0]))
-    with open(handle, 'w') as out:
-        np.save(out, hetfilter)
-
-    handle = os.path.join(chunkdir, "snpf.{}.npy".format(hslice[0]))
-    with open(handle, 'w') as out:
-        np.save(out, snpfilter)
-
-    handle = os.path.join(chunkdir, "pldf.{}.npy".format(hslice[0]))
-    with open(handle, 'w') as out:
-        np.save(out, pldfilter)
-
-    handle = os.path.join(chunkdir, "indf.{}.npy".format(hslice[0]))
-    with open(handle, 'w') as out:
-        np.save(out, indfilter)
-
-    handle = os.path.join(chunkdir, "snpsarr.{}.npy".format(hslice[0]))
-    with open(handle, 'w') as out:
-        np.save(out, snpsarr)
-
-    handle = os.path.join(chunkdir, "edgearr.{}.npy".format(hslice[0]))
-    with open(handle, 'w') as out:
-        np.save(out, edgearr)
-
-    io5.close()
-    co5.close()
+    ## write this slice of filters, edges and snps into the database. The
+    ## filter columns are ["duplicates", "max_indels", "max_snps", 
+    ## "max_hets", "min_samps", "max_alleles"], dups are already filled
+    ## and minf and edgf both write to min_samps.
+    with DatabaseLock(data.database), h5py.File(data.database, 'r+') as co5:
+        end = hslice[0] + superints.shape[0]
+        filters = co5["filters"][hslice[0]:end]
+        filters[:, 1] |= indfilter
+        filters[:, 2] |= snpfilter
+        filters[:, 3] |= hetfilter
+        filters[:, 4] |= minfilter | edgfilter
+        filters[:, 5] |= pldfilter
+        co5["filters"][hslice[0]:end] = filters
+        co5["edges"][hslice[0]:end] = edgearr
+        co5["snps"][hslice[0]:end] = snpsarr
 
 
 
@@ -1424,56 +1340,46 @@ def make_outfiles(data, samples, output_formats, ipyclient):
 
     ## send off outputs as parallel jobs
     lbview = ipyclient.load_balanced_view()
-    start = time.time()
-    results = {}
 
     ## build arrays and outputs from arrays.
     ## these arrays are keys in the tmp h5 array: seqarr, snparr, bisarr, maparr
-    boss_make_arrays(data, sidx, optim, nloci, ipyclient)
+    offsets, sizes = boss_make_arrays(data, sidx, optim, nloci, ipyclient)
 
-    start = time.time()
     ## phy and partitions are a default output ({}.phy, {}.phy.partitions)
     if "p" in output_formats:
         data.outfiles.phy = os.path.join(data.dirs.outfiles, data.name+".phy")
-        async = lbview.apply(write_phy, *[data, sidx, pnames])
-        results['phy'] = async
 
     ## nexus format includes ... additional information ({}.nex)
     if "n" in output_formats:
         data.outfiles.nexus = os.path.join(data.dirs.outfiles, data.name+".nex")
-        async = lbview.apply(write_nex, *[data, sidx, pnames])
-        results['nexus'] = async
 
     ## snps is actually all snps written in phylip format ({}.snps.phy)
     if "s" in output_formats:
         data.outfiles.snpsmap = os.path.join(data.dirs.outfiles, data.name+".snps.map")
         data.outfiles.snpsphy = os.path.join(data.dirs.outfiles, data.name+".snps.phy")
-        async = lbview.apply(write_snps, *[data, sidx, pnames])
-        results['snps'] = async
-        async = lbview.apply(write_snps_map, data)
-        results['snpsmap'] = async
 
     ## usnps is one randomly sampled snp from each locus ({}.u.snps.phy)
     if "u" in output_formats:
         data.outfiles.usnpsphy = os.path.join(data.dirs.outfiles, data.name+".u.snps.phy")
-        async = lbview.apply(write_usnps, *[data, sidx, pnames])
-        results['usnps'] = async
 
     ## str and ustr are for structure analyses. A fairly outdated format, six
     ## columns of empty space. Full and subsample included ({}.str, {}.u.str)
     if "k" in output_formats:
         data.outfiles.str = os.path.join(data.dirs.outfiles, data.name+".str")
         data.outfiles.ustr = os.path.join(data.dirs.outfiles, data.name+".ustr")        
-        async = lbview.apply(write_str, *[data, sidx, pnames])
-        results['structure'] = async
 
     ## geno output is for admixture and other software. We include all SNPs,
     ## but also a .map file which has "distances" between SNPs.
     if 'g' in output_formats:
         data.outfiles.geno = os.path.join(data.dirs.outfiles, data.name+".geno")
         data.outfiles.ugeno = os.path.join(data.dirs.outfiles, data.name+".u.geno")
-        async = lbview.apply(write_geno, *[data, sidx])
-        results['geno'] = async
+
+    ## the array formats are all written in one pass over the arrays
+    start = time.time()
+    results = {}
+    if any([i in output_formats for i in "pnsukg"]):
+        results["arrays"] = lbview.apply(fanout_outfiles, 
+            *[data, pnames, output_formats, offsets, sizes])
 
     ## G-PhoCS output. Have to use cap G here cuz little g is already taken, lol.
     if 'G' in output_formats:
@@ -1493,13 +1399,17 @@ def make_outfiles(data, samples, output_formats, ipyclient):
             break
     print("")
 
-    ## check for errors
+    ## check for errors, of the job or of each array format writer
+    errors = {}
     for suff, async in results.items():
         if not async.successful():
-            print("  Warning: error encountered while writing {} outfile: {}"\
-                  .format(suff, async.exception()))
-            LOGGER.error("  Warning: error in writing %s outfile: %s", \
-                         suff, async.exception())
+            errors[suff] = async.exception()
+        elif suff == "arrays":
+            errors.update(async.result())
+    for suff, err in sorted(errors.items()):
+        print("  Warning: error encountered while writing {} outfile: {}"\
+              .format(suff, err))
+        LOGGER.error("  Warning: error in writing %s outfile: %s", suff, err)
 
     ## remove the tmparrays
     tmparrs = os.path.join(data.dirs.outfiles, "tmp-{}.h5".format(data.name))
@@ -1508,6 +1418,13 @@ def make_outfiles(data, samples, output_formats, ipyclient):
 
 
 def boss_make_arrays(data, sidx, optim, nloci, ipyclient):
+    """
+    Builds the tmp seq, snp, bis and map arrays that the outfiles are 
+    written from. The size of each chunk's part of the arrays is computed
+    first, so that the offset of every chunk is known from their prefix sum
+    and workers can write their parts as they finish, in any order. Returns
+    the offsets and sizes of the chunks, by which the outfiles read them.
+    """
     
     ## make a list of slices to distribute in parallel
     hslices = [start for start in range(0, nloci, optim)]
@@ -1518,88 +1435,101 @@ def boss_make_arrays(data, sidx, optim, nloci, ipyclient):
     ## load the h5 database and grab some needed info
     maxlen = data._hackersonly["max_fragment_length"] + 20
 
-    ## distribute jobs in chunks of optim
-    asyncs = []
-    for hslice in hslices:
-        args = (data, sidx, hslice, optim, maxlen)
-        async = lbview.apply(worker_make_arrays, *args)
-        asyncs.append(async)
-               
-    ## shape of arrays is sidx, we will subsample h5 w/ sidx to match. Seqarr
-    ## will actually be a fair bit smaller since its being loaded with edge
-    with h5py.File(data.database, 'r') as co5:
-        maxsnp = co5["snps"][:].sum()
-        afilt = co5["filters"][:]
-        nkeeps = np.sum(np.sum(afilt, axis=1) == 0)
+    ## get the sizes of each chunk's arrays: seq cols, snps, bis (=loci w/ snps)
+    start = time.time()
+    printstr = " building arrays       | {} | s7 |"
+    njobs = 2 * len(hslices)
+    sasyncs = [lbview.apply(worker_array_sizes, *(data, sidx, hslice, optim))
+               for hslice in hslices]
+    wait_for_arrays(data, ipyclient, sasyncs, njobs, 0, start, printstr)
+    sizes = np.array([i.result() for i in sasyncs], dtype=np.int64).reshape(-1, 3)
+    offsets = np.cumsum(sizes, axis=0) - sizes
+    nseqs, nsnps, nbis = sizes.sum(axis=0)
 
     ## a tmp h5 to hold working arrays (the seq array is not filtered and trimmed
     ## It is the phylip output, essentially.
     h5name = os.path.join(data.dirs.outfiles, "tmp-{}.h5".format(data.name))
     with h5py.File(h5name, 'w') as tmp5:
-
         ## ensure chunksize is not greater than array size
-        shape1 = maxlen*nkeeps
-        tmp5.create_dataset("seqarr", (sum(sidx), shape1), dtype="S1", 
-                            chunks=(sum(sidx), min(shape1, maxlen*optim)))
-        tmp5.create_dataset("snparr", (sum(sidx), maxsnp), dtype="S1", 
-                            chunks=(sum(sidx), min(maxsnp, optim)))
-        tmp5.create_dataset('bisarr', (sum(sidx), nkeeps), dtype="S1", 
-                            chunks=(sum(sidx), min(nkeeps, optim)))
-        tmp5.create_dataset('maparr', (maxsnp, 4), dtype=np.uint32)
-
-        ## track progress, catch errors, and enter results into h5 as it arrive
-        start = time.time()
-        njobs = len(asyncs)
-        ## axis1 counters
-        seqidx = snpidx = bisidx = mapidx = locidx = 0
-        
-        while 1:
-            ## we need to collect results in order!
-            if asyncs[0].ready():
-                if asyncs[0].successful():
-                    ## enter results and del async
-                    seqarr, snparr, bisarr, maparr = asyncs[0].result()
-                    tmp5["seqarr"][:, seqidx:seqidx+seqarr.shape[1]] = seqarr
-                    seqidx += seqarr.shape[1]
-                    tmp5["snparr"][:, snpidx:snpidx+snparr.shape[1]] = snparr
-                    snpidx += snparr.shape[1]
-                    tmp5["bisarr"][:, bisidx:bisidx+bisarr.shape[1]] = bisarr
-                    bisidx += bisarr.shape[1]
-
-                    ## mapfile needs idxs summed, only bother if there is data
-                    ## that passed filtering for this chunk
-                    if maparr.shape[0]:
-                        mapcopy = maparr.copy()
-                        mapcopy[:, 0] += locidx
-                        mapcopy[:, 3] += mapidx
-                        tmp5["maparr"][mapidx:mapidx+maparr.shape[0], :] = mapcopy
-                        locidx = mapcopy[-1, 0]
-                        mapidx += mapcopy.shape[0]
-                    del asyncs[0]
-                        
-                else:
-                    print(asyncs[0].exception())
+        tmp5.create_dataset("seqarr", (sum(sidx), nseqs), dtype="S1", 
+                            chunks=(sum(sidx), max(1, min(nseqs, maxlen*optim))))
+        tmp5.create_dataset("snparr", (sum(sidx), nsnps), dtype="S1", 
+                            chunks=(sum(sidx), max(1, min(nsnps, optim))))
+        tmp5.create_dataset('bisarr', (sum(sidx), nbis), dtype="S1", 
+                            chunks=(sum(sidx), max(1, min(nbis, optim))))
+        tmp5.create_dataset('maparr', (nsnps, 4), dtype=np.uint32)
+
+    ## build and enter each chunk's arrays at its offsets
+    asyncs = []
+    for idx, hslice in enumerate(hslices):
+        args = (data, sidx, hslice, optim, maxlen, offsets[idx], sizes[idx])
+        asyncs.append(lbview.apply(worker_make_arrays, *args))
+    try:
+        wait_for_arrays(data, ipyclient, asyncs, njobs, len(hslices), start, printstr)
+    finally:
+        if os.path.exists(h5name + ".lock"):
+            os.remove(h5name + ".lock")
+    print("")
+    return offsets, sizes
 
-            ## print progress            
-            time.sleep(0.1)
-            elapsed = datetime.timedelta(seconds=int(time.time()-start))
-            progressbar(njobs, njobs-len(asyncs), 
-                " building arrays       | {} | s7 |".format(elapsed), 
-                spacer=data._spacer)
-            
-            ## are we done?
-            if not asyncs:
-                print("")
-                break
 
-    #return 
+
+def wait_for_arrays(data, ipyclient, asyncs, njobs, done, start, printstr):
+    """ tracks progress of array jobs and raises the first error """
+    while 1:
+        ipyclient.wait(asyncs, timeout=0.5)
+        finished = [i for i in asyncs if i.ready()]
+        elapsed = datetime.timedelta(seconds=int(time.time()-start))
+        progressbar(njobs, done+len(finished), printstr.format(elapsed), 
+                    spacer=data._spacer)
+        for async in finished:
+            if not async.successful():
+                LOGGER.error("error building arrays: %s", async.exception())
+                raise IPyradWarningExit(async.exception())
+        if len(finished) == len(asyncs):
+            break
+
+
+
+def worker_array_sizes(data, sidx, hslice, optim):
+    """
+    Number of seq columns, snps and bis snps that worker_make_arrays will
+    enter for a chunk of loci: the non-empty columns between edges, the 
+    snp sites and one snp per locus with snps, for loci that pass filters.
+    """
+    with h5py.File(data.database, 'r') as co5:
+        afilt = co5["filters"][hslice:hslice+optim, :]
+        aedge = co5["edges"][hslice:hslice+optim, :].astype(np.int64)
+        asnps = co5["snps"][hslice:hslice+optim, :]
+    with h5py.File(data.clust_database, 'r') as io5:
+        aseqs = np.char.upper(io5["seqs"][hslice:hslice+optim, sidx, :])
+
+    ## which loci passed all filters
+    keep = np.sum(afilt, axis=1) == 0
+
+    ## snps per locus
+    nsnps = asnps.sum(axis=2).astype(np.bool).sum(axis=1)[keep]
+
+    ## seq columns between edges that are not all N or -
+    bcols = np.all((aseqs == "N") | (aseqs == "-"), axis=1)
+    cols = np.arange(aseqs.shape[2])
+    inr1 = (cols >= aedge[:, 0:1]) & (cols <= aedge[:, 1:2])
+    nseqs = np.sum(inr1 & ~bcols, axis=1)
+    if "pair" in data.paramsdict["datatype"]:
+        inr2 = (cols >= aedge[:, 2:3]) & (cols <= aedge[:, 3:4])
+        nseqs += np.sum(inr2 & ~bcols, axis=1)
+    nseqs = nseqs[keep]
+
+    return nseqs.sum(), nsnps.sum(), np.sum(nsnps > 0)
     
 
     
-def worker_make_arrays(data, sidx, hslice, optim, maxlen):
+def worker_make_arrays(data, sidx, hslice, optim, maxlen, offsets, sizes):
     """
     Parallelized worker to build array chunks for output files. One main 
-    goal here is to keep seqarr to less than ~1GB RAM.
+    goal here is to keep seqarr to less than ~1GB RAM. The arrays are 
+    entered into the tmp h5 at offsets (seq cols, snps, bis) computed from
+    the sizes of the chunks before it.
     """
     
     ## big data arrays
@@ -1686,317 +1616,291 @@ def worker_make_arrays(data, sidx, hslice, optim, maxlen):
     co5.close()
     
     ## trim trailing edges b/c we made the array bigger than needed.
-    ridx = np.all(seqarr == "", axis=0)
-    seqarr = seqarr[:, ~ridx]
-    ridx = np.all(snparr == "", axis=0)
-    snparr = snparr[:, ~ridx]
-    ridx = np.all(bisarr == "", axis=0)
-    bisarr = bisarr[:, ~ridx]
-    ridx = np.all(maparr == 0, axis=1)
-    maparr = maparr[~ridx, :]
-
-    ## return these three arrays which are pretty small
-    ## catg array gets to be pretty huge, so we return only
-    return seqarr, snparr, bisarr, maparr
+    if [seqleft, snpleft, bis] != list(sizes):
+        raise IPyradError(BAD_ARRAY_SIZES.format(hslice, sizes, [seqleft, snpleft, bis]))
+    seqarr = seqarr[:, :seqleft]
+    snparr = snparr[:, :snpleft]
+    bisarr = bisarr[:, :bis]
+    maparr = maparr[:mapsnp, :]
+
+    ## mapfile needs locus and snp counters offset by the earlier chunks
+    maparr[:, 0] += int(offsets[2])
+    maparr[:, 3] += int(offsets[1])
+
+    ## enter into the tmp h5, other engines write to it too.
+    seqidx, snpidx, bisidx = offsets
+    h5name = os.path.join(data.dirs.outfiles, "tmp-{}.h5".format(data.name))
+    with DatabaseLock(h5name), h5py.File(h5name, 'r+') as tmp5:
+        tmp5["seqarr"][:, seqidx:seqidx+seqleft] = seqarr
+        tmp5["snparr"][:, snpidx:snpidx+snpleft] = snparr
+        tmp5["bisarr"][:, bisidx:bisidx+bis] = bisarr
+        tmp5["maparr"][snpidx:snpidx+mapsnp, :] = maparr
   
   
 
-def write_phy(data, sidx, pnames):
-    """ 
-    write the phylip output file from the tmparr[seqarray] 
+def fanout_outfiles(data, pnames, formats, offsets, sizes):
+    """
+    Writes the array based outfiles in a single pass over the tmp arrays.
+    Each chunk's block of the arrays is read once and handed to the writer
+    of each requested format, every writer running in its own thread, so
+    that formats add writing time but not reading. Returns a dict of the
+    errors of any writers that failed, by their name.
     """
+    nseqs, nsnps, nbis = sizes.sum(axis=0)
+    writers = []
+    if "p" in formats:
+        writers.append(PhylipWriter("phy", data.outfiles.phy, pnames, nseqs, "seqarr"))
+    if "n" in formats:
+        writers.append(NexusWriter("nexus", data.outfiles.nexus, pnames, nseqs))
+    if "s" in formats:
+        writers.append(PhylipWriter("snps", data.outfiles.snpsphy, pnames, nsnps, "snparr"))
+        writers.append(SnpsMapWriter("snpsmap", data.outfiles.snpsmap))
+    if "u" in formats:
+        writers.append(PhylipWriter("usnps", data.outfiles.usnpsphy, pnames, nbis, "bisarr"))
+    if "k" in formats:
+        writers.append(StrWriter("structure", data.outfiles.str, data.outfiles.ustr,
+                                 pnames, data.paramsdict["max_alleles_consens"] > 1))
+    if "g" in formats:
+        writers.append(GenoWriter("geno", data.outfiles.geno, data.outfiles.ugeno))
+    keys = set(itertools.chain(*[i.keys for i in writers]))
+
+    ## start a thread and queue for each writer
+    errors = {}
+    queues = [Queue.Queue(maxsize=FANOUT_QUEUE_SIZE) for _ in writers]
+    threads = [threading.Thread(target=fanout_writer, args=(i, j, errors))
+               for i, j in zip(writers, queues)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    ## read the arrays of each chunk once and share them with all writers
+    h5name = os.path.join(data.dirs.outfiles, "tmp-{}.h5".format(data.name))
+    try:
+        with h5py.File(h5name, 'r') as tmp5:
+            for offset, size in zip(offsets, sizes):
+                block = {}
+                for key, col in [("seqarr", 0), ("snparr", 1), ("bisarr", 2)]:
+                    if key in keys:
+                        block[key] = tmp5[key][:, offset[col]:offset[col]+size[col]]
+                if "maparr" in keys:
+                    block["maparr"] = tmp5["maparr"][offset[1]:offset[1]+size[1]]
+                for queue in queues:
+                    queue.put(block)
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+    return errors
 
-    ## grab seq data from tmparr
-    start = time.time()
-    tmparrs = os.path.join(data.dirs.outfiles, "tmp-{}.h5".format(data.name)) 
-    with h5py.File(tmparrs, 'r') as io5:
-        seqarr = io5["seqarr"]
-
-        ## trim to size b/c it was made longer than actual
-        end = np.where(np.all(seqarr[:] == "", axis=0))[0]
-        if np.any(end):
-            end = end.min()
-        else:
-            end = seqarr.shape[1] 
 
-        ## write to phylip 
-        with open(data.outfiles.phy, 'w') as out:
-            ## write header
-            out.write("{} {}\n".format(seqarr.shape[0], end))
 
-            ## write data rows
-            for idx, name in enumerate(pnames):
-                out.write("{}{}\n".format(name, "".join(seqarr[idx, :end])))
-    LOGGER.debug("finished writing phy in: %s", time.time() - start)
+def fanout_writer(writer, queue, errors):
+    """
+    Adds the blocks from a queue to a writer until a None. After an error
+    the rest of the blocks are drained so that the reader does not block.
+    """
+    while 1:
+        block = queue.get()
+        if block is None:
+            break
+        if writer.name not in errors:
+            try:
+                writer.add(block)
+            except Exception as inst:
+                LOGGER.error("error writing %s: %s", writer.name, inst)
+                errors[writer.name] = str(inst)
+    try:
+        writer.close()
+    except Exception as inst:
+        LOGGER.error("error writing %s: %s", writer.name, inst)
+        errors.setdefault(writer.name, str(inst))
 
 
 
-def write_nex(data, sidx, pnames):
+class PhylipWriter(object):
     """ 
-    write the nexus output file from the tmparr[seqarray] and tmparr[maparr]
-    """    
-
-    ## grab seq data from tmparr
-    start = time.time()
-    tmparrs = os.path.join(data.dirs.outfiles, "tmp-{}.h5".format(data.name)) 
-    with h5py.File(tmparrs, 'r') as io5:
-        seqarr = io5["seqarr"]
-
-        ## trim to size b/c it was made longer than actual
-        end = np.where(np.all(seqarr[:] == "", axis=0))[0]
-        if np.any(end):
-            end = end.min()
-        else:
-            end = seqarr.shape[1] 
-
-        ## write to nexus
-        data.outfiles.nex = os.path.join(data.dirs.outfiles, data.name+".nex")
+    Writes a phylip file of a (samples, ncols) array added in blocks of 
+    columns. Every row has a fixed width, so each block is written at its
+    column offset in every row, with the names and newlines written first.
+    Used for the .phy, .snps.phy and .u.snps.phy outfiles.
+    """
+    def __init__(self, name, path, pnames, ncols, key):
+        self.name = name
+        self.keys = [key]
+        self.ncols = ncols
+        self.done = 0
+        self.out = open(path, 'wb')
+        header = "{} {}\n".format(len(pnames), ncols)
+        self.out.write(header)
+        self.starts = []
+        pos = len(header)
+        for pname in pnames:
+            self.starts.append(pos + len(pname))
+            self.out.seek(pos)
+            self.out.write(pname)
+            self.out.seek(pos + len(pname) + ncols)
+            self.out.write("\n")
+            pos += len(pname) + ncols + 1
+
+
+    def add(self, block):
+        arr = block[self.keys[0]]
+        for idx, start in enumerate(self.starts):
+            self.out.seek(start + self.done)
+            self.out.write(arr[idx].tostring())
+        self.done += arr.shape[1]
+
+
+    def close(self):
+        self.out.close()
+        if self.done != self.ncols:
+            raise IPyradError(BAD_OUTFILE_SIZE.format(
+                self.name, self.done, self.ncols))
+
+
+
+class NexusWriter(object):
+    """ 
+    Writes the seqs to the .nex outfile, interleaved in blocks of 100 
+    columns. Columns past the last full block are held for the next add.
+    """
+    def __init__(self, name, path, pnames, ncols):
+        self.name = name
+        self.keys = ["seqarr"]
+        self.pnames = pnames
+        self.carry = np.zeros((len(pnames), 0), dtype="S1")
+        self.out = open(path, 'w')
+        self.out.write(NEXHEADER.format(len(pnames), ncols))
 
-        with open(data.outfiles.nex, 'w') as out:
 
-            ## write nexus seq header
-            out.write(NEXHEADER.format(seqarr.shape[0], end))
+    def add(self, block):
+        arr = np.concatenate([self.carry, block["seqarr"]], axis=1)
+        full = arr.shape[1] - (arr.shape[1] % 100)
+        self._write(arr[:, :full])
+        self.carry = arr[:, full:]
 
-            ## grab a big block of data
-            chunksize = 100000  # this should be a multiple of 100
-            for bidx in xrange(0, end, chunksize):
-                bigblock = seqarr[:, bidx:bidx+chunksize]
-                lend = end-bidx
-                #LOGGER.info("BIG: %s %s %s %s", bigblock.shape, bidx, lend, end)
 
-                ## write interleaved seqs 100 chars with longname+2 before
-                tmpout = []            
-                for block in xrange(0, min(chunksize, lend), 100):
-                    stop = min(block+100, end)
+    def _write(self, arr):
+        """ write interleaved seqs 100 chars with longname+2 before """
+        tmpout = []
+        for start in xrange(0, arr.shape[1], 100):
+            for idx, name in enumerate(self.pnames):
+                tmpout.append("  {}{}\n".format(name, arr[idx, start:start+100].tostring()))
+            tmpout.append("\n")
+        self.out.write("".join(tmpout))
 
-                    for idx, name in enumerate(pnames):
-                        seqdat = bigblock[idx, block:stop]
-                        tmpout.append("  {}{}\n".format(name, "".join(seqdat)))
-                    tmpout.append("\n")
 
-                ## print intermediate result and clear
-                if any(tmpout):
-                    out.write("".join(tmpout))
-            ## closer
-            out.write(NEXCLOSER)
-    LOGGER.debug("finished writing nex in: %s", time.time() - start)
+    def close(self):
+        self._write(self.carry)
+        self.out.write(NEXCLOSER)
+        self.out.close()
 
 
 
 ## TODO: this could have much more information for reference aligned data
-def write_snps_map(data):
-    """ write a map file with linkage information for SNPs file"""
+class SnpsMapWriter(object):
+    """ writes a map file with linkage information for SNPs file """
+    def __init__(self, name, path):
+        self.name = name
+        self.keys = ["maparr"]
+        self.out = open(path, 'w')
 
-    ## grab map data from tmparr
-    start = time.time()
-    tmparrs = os.path.join(data.dirs.outfiles, "tmp-{}.h5".format(data.name)) 
-    with h5py.File(tmparrs, 'r') as io5:
-        maparr = io5["maparr"][:]
-
-        ## get last data 
-        end = np.where(np.all(maparr[:] == 0, axis=1))[0]
-        if np.any(end):
-            end = end.min()
-        else:
-            end = maparr.shape[0]
-
-        ## write to map file (this is too slow...)
-        outchunk = []
-        with open(data.outfiles.snpsmap, 'w') as out:
-            for idx in xrange(end):
-                ## build to list
-                line = maparr[idx, :]
-                #print(line)
-                outchunk.append(\
-                    "{}\trad{}_snp{}\t{}\t{}\n"\
-                    .format(line[0], line[1], line[2], 0, line[3]))
-                ## clear list
-                if not idx % 10000:
-                    out.write("".join(outchunk))
-                    outchunk = []
-            ## write remaining
-            out.write("".join(outchunk))
-    LOGGER.debug("finished writing snps_map in: %s", time.time() - start)
-
-
-
-def write_snps(data, sidx, pnames):
-    """ write the snp string """
-
-    ## grab snp data from tmparr
-    start = time.time()
-    tmparrs = os.path.join(data.dirs.outfiles, "tmp-{}.h5".format(data.name)) 
-    with h5py.File(tmparrs, 'r') as io5:
-        snparr = io5["snparr"]
-
-        ## trim to size b/c it was made longer than actual
-        end = np.where(np.all(snparr[:] == "", axis=0))[0]
-        if np.any(end):
-            end = end.min()
-        else:
-            end = snparr.shape[1]        
 
-        ## write to snps file
-        with open(data.outfiles.snpsphy, 'w') as out:
-            out.write("{} {}\n".format(snparr.shape[0], end))
-            for idx, name in enumerate(pnames):
-                out.write("{}{}\n".format(name, "".join(snparr[idx, :end])))
-    LOGGER.debug("finished writing snps in: %s", time.time() - start)
+    def add(self, block):
+        self.out.write("".join(["%d\trad%d_snp%d\t0\t%d\n" % tuple(i) \
+                                for i in block["maparr"].tolist()]))
 
 
+    def close(self):
+        self.out.close()
 
-def write_usnps(data, sidx, pnames):
-    """ write the bisnp string """
 
-    ## grab bis data from tmparr
-    tmparrs = os.path.join(data.dirs.outfiles, "tmp-{}.h5".format(data.name)) 
-    with h5py.File(tmparrs, 'r') as io5:
-        bisarr = io5["bisarr"]
-
-        ## trim to size b/c it was made longer than actual
-        end = np.where(np.all(bisarr[:] == "", axis=0))[0]
-        if np.any(end):
-            end = end.min()
-        else:
-            end = bisarr.shape[1]        
-
-        ## write to usnps file
-        with open(data.outfiles.usnpsphy, 'w') as out:
-            out.write("{} {}\n".format(bisarr.shape[0], end))
-            for idx, name in enumerate(pnames):
-                out.write("{}{}\n".format(name, "".join(bisarr[idx, :end])))
 
+class StrWriter(object):
+    """ 
+    Writes STRUCTURE format for all SNPs and unlinked SNPs. Rows are per
+    sample with a variable width, so the SNPs are held until close.
+    """
+    def __init__(self, name, path, upath, pnames, diploid):
+        self.name = name
+        self.keys = ["snparr", "bisarr"]
+        self.paths = [path, upath]
+        self.pnames = pnames
+        self.diploid = diploid
+        self.blocks = {"snparr": [], "bisarr": []}
 
 
-def write_str(data, sidx, pnames):
-    """ Write STRUCTURE format for all SNPs and unlinked SNPs """
+    def add(self, block):
+        for key in self.keys:
+            self.blocks[key].append(block[key])
 
-    ## grab snp and bis data from tmparr
-    start = time.time()
-    tmparrs = os.path.join(data.dirs.outfiles, "tmp-{}.h5".format(data.name)) 
-    with h5py.File(tmparrs, 'r') as io5:
-        snparr = io5["snparr"]
-        bisarr = io5["bisarr"]
-
-        ## trim to size b/c it was made longer than actual
-        bend = np.where(np.all(bisarr[:] == "", axis=0))[0]
-        if np.any(bend):
-            bend = bend.min()
-        else:
-            bend = bisarr.shape[1]        
 
-        send = np.where(np.all(snparr[:] == "", axis=0))[0]       
-        if np.any(send):
-            send = send.min()
-        else:
-            send = snparr.shape[1]        
-
-        ## write to str and ustr
-        out1 = open(data.outfiles.str, 'w')
-        out2 = open(data.outfiles.ustr, 'w')
-        numdict = {'A': '0', 'T': '1', 'G': '2', 'C': '3', 'N': '-9', '-': '-9'}
-        if data.paramsdict["max_alleles_consens"] > 1:
-            for idx, name in enumerate(pnames):
-                out1.write("{}\t\t\t\t\t{}\n"\
-                    .format(name,
-                    "\t".join([numdict[DUCT[i][0]] for i in snparr[idx, :send]])))
-                out1.write("{}\t\t\t\t\t{}\n"\
-                    .format(name,
-                    "\t".join([numdict[DUCT[i][1]] for i in snparr[idx, :send]])))
-                out2.write("{}\t\t\t\t\t{}\n"\
-                    .format(name,
-                    "\t".join([numdict[DUCT[i][0]] for i in bisarr[idx, :bend]])))
-                out2.write("{}\t\t\t\t\t{}\n"\
-                    .format(name,
-                    "\t".join([numdict[DUCT[i][1]] for i in bisarr[idx, :bend]])))
-        else:
-            ## haploid output
-            for idx, name in enumerate(pnames):
-                out1.write("{}\t\t\t\t\t{}\n"\
-                    .format(name,
-                    "\t".join([numdict[DUCT[i][0]] for i in snparr[idx, :send]])))
-                out2.write("{}\t\t\t\t\t{}\n"\
-                    .format(name,
-                    "\t".join([numdict[DUCT[i][0]] for i in bisarr[idx, :bend]])))
-        out1.close()
-        out2.close()
-    LOGGER.debug("finished writing str in: %s", time.time() - start)
+    def close(self):
+        ## the two alleles of each site with ambiguities resolved
+        alleles = [0, 1] if self.diploid else [0]
+        for key, path in zip(self.keys, self.paths):
+            arr = np.concatenate([np.zeros((len(self.pnames), 0), dtype="S1")] 
+                                 + self.blocks[key], axis=1).view(np.uint8)
+            with open(path, 'w') as out:
+                for idx, name in enumerate(self.pnames):
+                    for allele in alleles:
+                        out.write("{}\t\t\t\t\t{}\n".format(name, 
+                            "\t".join(STR_ALLELES[allele][arr[idx]].tolist())))
+            self.blocks[key] = []
 
 
 
-def write_geno(data, sidx):
+class GenoWriter(object):
     """
-    write the geno output formerly used by admixture, still supported by 
-    adegenet, perhaps. Also, sNMF still likes .geno.
+    Writes the geno output formerly used by admixture, still supported by 
+    adegenet, perhaps. Also, sNMF still likes .geno. One line per SNP, so
+    each block is written as it comes.
     """
+    def __init__(self, name, path, upath):
+        self.name = name
+        self.keys = ["snparr", "bisarr"]
+        self.outs = [open(path, 'w'), open(upath, 'w')]
 
-    ## grab snp and bis data from tmparr
-    start = time.time()
-    tmparrs = os.path.join(data.dirs.outfiles, "tmp-{}.h5".format(data.name)) 
-    with h5py.File(tmparrs, 'r') as io5:
-        snparr = io5["snparr"]
-        bisarr = io5["bisarr"]
-
-        ## trim to size b/c it was made longer than actual
-        bend = np.where(np.all(bisarr[:] == "", axis=0))[0]
-        if np.any(bend):
-            bend = bend.min()
-        else:
-            bend = bisarr.shape[1]        
-
-        send = np.where(np.all(snparr[:] == "", axis=0))[0]       
-        if np.any(send):
-            send = send.min()
-        else:
-            send = snparr.shape[1]        
-
-        ## get most common base at each SNP as a pseudo-reference
-        ## and record 0,1,2 or missing=9 for counts of the ref allele
-        snpref = reftrick(snparr[:, :send].view(np.int8), GETCONS).view("S1")
-        bisref = reftrick(bisarr[:, :bend].view(np.int8), GETCONS).view("S1")
 
-        ## geno matrix to fill (9 is empty)
-        snpgeno = np.zeros((snparr.shape[0], send), dtype=np.uint8)
-        snpgeno.fill(9)
-        bisgeno = np.zeros((bisarr.shape[0], bend), dtype=np.uint8)
-        bisgeno.fill(9)
+    def add(self, block):
+        for key, out in zip(self.keys, self.outs):
+            if block[key].shape[1]:
+                geno = genotype_counts(block[key])
+                geno = np.concatenate([geno.T + 48, 
+                                       np.zeros((geno.shape[1], 1), np.uint8) + 10],
+                                      axis=1)
+                out.write(geno.tostring())
 
-        ##--------------------------------------------------------------------
-        ## fill in complete hits (match to first column ref base)
-        mask2 = np.array(snparr[:, :send] == snpref[:, 0])
-        snpgeno[mask2] = 2
 
-        ## fill in single hits (heteros) match to hetero of first+second column
-        ambref = np.apply_along_axis(lambda x: TRANSFULL[tuple(x)], 1, snpref[:, :2])
-        mask1 = np.array(snparr[:, :send] == ambref)
-        snpgeno[mask1] = 1
+    def close(self):
+        for out in self.outs:
+            out.close()
 
-        ## fill in zero hits, meaning a perfect match to the second column base
-        ## anything else is left at 9 (missing), b/c it's either missing or it
-        ## is not bi-allelic. 
-        mask0 = np.array(snparr[:, :send] == snpref[:, 1])
-        snpgeno[mask0] = 0
 
-        ##--------------------------------------------------------------------
 
-        ## fill in complete hits
-        mask2 = np.array(bisarr[:, :bend] == bisref[:, 0])
-        bisgeno[mask2] = 2
+def genotype_counts(snparr):
+    """
+    Counts of the most common base at each SNP of a (samples, snps) array
+    as a pseudo-reference: 2 for the ref base, 1 for the heterozygote of
+    the ref and the second most common base, 0 for the second base, and 
+    missing=9 for anything else b/c it's either missing or it is not 
+    bi-allelic. 
+    """
+    snpref = reftrick(snparr.view(np.int8), GETCONS).view("S1")
+    geno = np.zeros(snparr.shape, dtype=np.uint8)
+    geno.fill(9)
 
-        ## fill in single hits (heteros)
-        ambref = np.apply_along_axis(lambda x: TRANSFULL[tuple(x)], 1, bisref[:, :2])
-        mask1 = np.array(bisarr[:, :bend] == ambref)
-        bisgeno[mask1] = 1
+    ## fill in complete hits (match to first column ref base)
+    geno[snparr == snpref[:, 0]] = 2
 
-        ## fill in zero hits (match to second base)
-        mask0 = np.array(bisarr[:, :bend] == bisref[:, 1])
-        bisgeno[mask0] = 0
+    ## fill in single hits (heteros) match to hetero of first+second column
+    ambref = np.array([TRANSFULL.get(tuple(i), "") for i in snpref[:, :2].tolist()])
+    geno[snparr == ambref] = 1
 
-        ##---------------------------------------------------------------------
-        ## print to files
-        np.savetxt(data.outfiles.geno, snpgeno.T, delimiter="", fmt="%d")
-        np.savetxt(data.outfiles.ugeno, bisgeno.T, delimiter="", fmt="%d")
-    LOGGER.debug("finished writing geno in: %s", time.time() - start)
+    ## fill in zero hits, meaning a perfect match to the second column base
+    geno[snparr == snpref[:, 1]] = 0
+    return geno
 
 
 
@@ -2063,9 +1967,13 @@ def write_gphocs(data, sidx):
 
 def make_vcf(data, samples, ipyclient, full=0):
     """
-    Write the full VCF for loci passing filtering. Other vcf formats are
-    possible, like SNPs-only, or with filtered loci included but the filter
-    explicitly labeled. These are not yet supported, however.
+    Write the VCF for loci passing filtering, either of the variable sites
+    only (the .vcf) or of all sites within the edges of each locus (the
+    .allsites.vcf.gz, from the hidden 'V' output format). Chunks of loci
+    are built on the engines and then concatenated, sorted by CHROM and
+    POS for reference assemblies. Compressed output is written as BGZF
+    with a tabix index, which is also used for the variable sites VCF if
+    the _hackersonly parameter vcf_bgzip is set.
     """
     ## start vcf progress bar
     start = time.time()
@@ -2074,10 +1982,16 @@ def make_vcf(data, samples, ipyclient, full=0):
     elapsed = datetime.timedelta(seconds=int(time.time()-start))
     progressbar(20, 0, printstr.format(elapsed), spacer=data._spacer)
 
-    ## create outputs for v and V, gzip V to be friendly
-    data.outfiles.vcf = os.path.join(data.dirs.outfiles, data.name+".vcf")
+    ## create outputs for v and V, compress V to be friendly
     if full:
-        data.outfiles.VCF = os.path.join(data.dirs.outfiles, data.name+".vcf.gz")
+        data.outfiles.VCF = os.path.join(data.dirs.outfiles, 
+                                         data.name+".allsites.vcf.gz")
+        outfile = data.outfiles.VCF
+    else:
+        data.outfiles.vcf = os.path.join(data.dirs.outfiles, data.name+".vcf")
+        if data._hackersonly["vcf_bgzip"]:
+            data.outfiles.vcf += ".gz"
+        outfile = data.outfiles.vcf
 
     ## get some db info
     with h5py.File(data.clust_database, 'r') as io5:
@@ -2092,15 +2006,16 @@ def make_vcf(data, samples, ipyclient, full=0):
     ## get names index
     sidx = np.array([i in snames for i in anames])
 
-    ## client for sending jobs to parallel engines, for this step we'll limit
-    ## to half of the available cpus if
+    ## client for sending jobs to parallel engines
     lbview = ipyclient.load_balanced_view()
 
     ## send jobs in chunks
     vasyncs = {}
     total = 0
     for chunk in xrange(0, nloci, optim):
-        vasyncs[chunk] = lbview.apply(vcfchunk, *(data, optim, sidx, chunk, full))
+        vasyncs[chunk] = lbview.apply(
+            profiled(data, vcfchunk, "building vcf file"), 
+            *(data, optim, sidx, chunk, full, outfile))
         total += 1
 
     ## tmp files get left behind and intensive processes are left running when a
@@ -2120,7 +2035,7 @@ def make_vcf(data, samples, ipyclient, full=0):
                     ## free up memory
                     del vasyncs[job]
 
-            finished = total - len(vasyncs) #sum([i.ready() for i in vasyncs.values()])
+            finished = total - len(vasyncs)
             elapsed = datetime.timedelta(seconds=int(time.time()-start))
             progressbar(total, finished, printstr.format(elapsed), spacer=data._spacer)
             time.sleep(0.5)
@@ -2133,59 +2048,44 @@ def make_vcf(data, samples, ipyclient, full=0):
         keys = [i for (i, j) in vasyncs.items() if not j.ready()]
         try:
             for job in keys:
-                #vasyncs[job].abort()
                 vasyncs[job].cancel()
         except Exception:
             pass
         ## make sure all tmp files are destroyed
-        vcfchunks = glob.glob(os.path.join(data.dirs.outfiles, "*.vcf.[0-9]*"))
-        h5chunks = glob.glob(os.path.join(data.dirs.outfiles, ".tmp.[0-9]*.h5"))
-        for dfile in vcfchunks+h5chunks:
+        for dfile in glob.glob(outfile+".[0-9]*"):
             os.remove(dfile)
         ## reraise the error
         raise inst
 
-
     ## writing full vcf file to disk
     start = time.time()
     printstr = " writing vcf file      | {} | s7 |"
-    res = lbview.apply(concat_vcf, *(data, names, full))
-    ogchunks = len(glob.glob(data.outfiles.vcf+".*"))
+    res = lbview.apply(concat_vcf, *(data, names, outfile))
+    ogchunks = len(glob.glob(outfile+".[0-9]*"))
     while 1:
         elapsed = datetime.timedelta(seconds=int(time.time()-start))
-        curchunks = len(glob.glob(data.outfiles.vcf+".*"))
+        curchunks = len(glob.glob(outfile+".[0-9]*"))
         progressbar(ogchunks, ogchunks-curchunks, printstr.format(elapsed), spacer=data._spacer)
         time.sleep(0.1)
         if res.ready():
             break
+    if not res.successful():
+        raise IPyradWarningExit(" error in vcf concat: {}".format(res.result()))
     elapsed = datetime.timedelta(seconds=int(time.time()-start))
     progressbar(1, 1, printstr.format(elapsed), spacer=data._spacer)
     print("")
 
 
 
-def concat_vcf(data, names, full):
+def concat_vcf(data, names, outfile):
     """
-    Sorts, concatenates, and gzips VCF chunks. Also cleans up chunks.
+    Sorts and concatenates VCF chunks to outfile, as BGZF with a tabix 
+    index (outfile.tbi) if outfile ends in .gz. Also cleans up chunks.
     """
-    ## open handle and write headers
-    if not full:
-        writer = open(data.outfiles.vcf, 'w')
-    else:
-        writer = gzip.open(data.outfiles.VCF, 'w')
-    vcfheader(data, names, writer)
-    writer.close()
-
     ## get vcf chunks
-    vcfchunks = glob.glob(data.outfiles.vcf+".*")
+    vcfchunks = glob.glob(outfile+".[0-9]*")
     vcfchunks.sort(key=lambda x: int(x.rsplit(".")[-1]))
 
-    ## concatenate
-    if not full:
-        writer = open(data.outfiles.vcf, 'a')
-    else:
-        writer = gzip.open(data.outfiles.VCF, 'a')
-
     ## what order do users want? The order in the original ref file?
     ## Sorted by the size of chroms? that is the order in faidx.
     ## If reference mapping then it's nice to sort the vcf data by
@@ -2198,248 +2098,181 @@ def concat_vcf(data, names, full):
         ## but relatively unordered CHROMs (locus105 will be before locus11).
         cmd = ["cat"] + vcfchunks + [" | sort -k 2,2 -n | sort -k 1,1 -s"]
         cmd = " ".join(cmd)
-        proc = sps.Popen(cmd, shell=True, stderr=sps.STDOUT, stdout=writer, close_fds=True)
+        kwargs = {"shell": True}
+    else:
+        cmd = ["cat"] + vcfchunks
+        kwargs = {}
+
+    if not outfile.endswith(".gz"):
+        with open(outfile, 'w') as writer:
+            vcfheader(data, names, writer)
+            writer.flush()
+            proc = sps.Popen(cmd, stderr=sps.STDOUT, stdout=writer, 
+                             close_fds=True, **kwargs)
+            err = proc.communicate()[0]
+
     else:
-        proc = sps.Popen(["cat"] + vcfchunks, stderr=sps.STDOUT, stdout=writer, close_fds=True)
+        ## stream records into blocks and index the offsets of each
+        index = TabixIndex()
+        with BgzfWriter(outfile) as writer:
+            vcfheader(data, names, writer)
+            proc = sps.Popen(cmd, stderr=sps.PIPE, stdout=sps.PIPE, 
+                             close_fds=True, **kwargs)
+            for line in iter(proc.stdout.readline, ""):
+                chrom, pos, _, ref, _ = line.split("\t", 4)
+                beg = int(pos) - 1
+                vstart = writer.tell()
+                writer.write(line)
+                index.add(chrom, beg, beg + len(ref), vstart, writer.tell())
+            err = proc.communicate()[1]
+        index.write(outfile+".tbi")
 
-    err = proc.communicate()[0]
     if proc.returncode:
-        raise IPyradWarningExit("err in concat_vcf: %s", err)
-    writer.close()
+        raise IPyradWarningExit("err in concat_vcf: {}".format(err))
 
     for chunk in vcfchunks:
         os.remove(chunk)
 
 
 
-def vcfchunk(data, optim, sidx, chunk, full):
+def vcfchunk(data, optim, sidx, chunk, full, outfile):
     """
-    Function called within make_vcf to run chunks on separate engines.
+    Function called within make_vcf to run chunks on separate engines. 
+    Builds the VCF records of all sites of a chunk of loci at once from 
+    the seqs and catgs arrays and writes them to outfile.<chunk>.
     """
-    ## empty array to be filled before writing
-    ## will not actually be optim*maxlen, extra needs to be trimmed
-    maxlen = data._hackersonly["max_fragment_length"] + 20
-
     ## get data sliced (optim chunks at a time)
     hslice = [chunk, chunk+optim]
+    pairs = "pair" in data.paramsdict["datatype"]
+
+    ## loci that passed all filters, their edges, and their snps
+    with h5py.File(data.database, 'r') as co5:
+        keepmask = co5["filters"][hslice[0]:hslice[1], :].sum(axis=1) == 0
+        aedge = co5["edges"][hslice[0]:hslice[1], :][keepmask].astype(np.int64)
+        if not full:
+            asnps = co5["snps"][hslice[0]:hslice[1], :][keepmask].sum(axis=2) > 0
+    locindex = np.where(keepmask)[0]
+    if not locindex.shape[0]:
+        return 0
 
     ## read all taxa from disk (faster), then subsample taxa with sidx and
     ## keepmask to greatly reduce the memory load
-    with h5py.File(data.database, 'r') as co5:
-        afilt = co5["filters"][hslice[0]:hslice[1], :]
-        keepmask = afilt.sum(axis=1) == 0
-        ## apply mask to edges
-        aedge = co5["edges"][hslice[0]:hslice[1], :]
-        aedge = aedge[keepmask, :]
-    del afilt
-    ## same memory subsampling.
     with h5py.File(data.clust_database, 'r') as io5:
-        ## apply mask to edges to aseqs and acatg
-        #aseqs = io5["seqs"][hslice[0]:hslice[1], :, :].view(np.uint8)
-        ## need to read in seqs with upper b/c lowercase allele info
-        aseqs = np.char.upper(io5["seqs"][hslice[0]:hslice[1], :, :]).view(np.uint8)
-        aseqs = aseqs[keepmask, :]
-        aseqs = aseqs[:, sidx, :]
-        acatg = io5["catgs"][hslice[0]:hslice[1], :, :, :]
-        acatg = acatg[keepmask, :]
-        acatg = acatg[:, sidx, :, :]
-        achrom = io5["chroms"][hslice[0]:hslice[1]]
-        achrom = achrom[keepmask, :]        
-
-    LOGGER.info('acatg.shape %s', acatg.shape)
-    ## to save memory some columns are stored in diff dtypes until printing
+        aseqs = io5["seqs"][hslice[0]:hslice[1]][keepmask][:, sidx].view(np.uint8)
+        acatg = io5["catgs"][hslice[0]:hslice[1]][keepmask][:, sidx]
+        achrom = io5["chroms"][hslice[0]:hslice[1]][keepmask]
+
+    ## sites between the edges (both reads of pairs), or only the snps. 
+    ## POS is counted along the trimmed locus with the reads joined.
+    cols = np.arange(aseqs.shape[2])
+    insite = (cols >= aedge[:, 0:1]) & (cols <= aedge[:, 1:2])
+    if pairs:
+        insite |= (cols >= aedge[:, 2:3]) & (cols <= aedge[:, 3:4])
+    sitepos = np.cumsum(insite, axis=1)
     if not full:
-        with h5py.File(data.database, 'r') as co5:
-            snps = co5["snps"][hslice[0]:hslice[1], :]
-            snps = snps[keepmask, :]
-            snps = snps.sum(axis=2)
-        snpidxs = snps > 0
-        maxsnplen = snps.sum()
-
-    ## vcf info to fill, this is bigger than the actual array
-    nrows = maxsnplen
-    cols0 = np.zeros(nrows, dtype=np.int64) #h5py.special_dtype(vlen=bytes))
-    cols1 = np.zeros(nrows, dtype=np.uint32)
-    cols34 = np.zeros((nrows, 2), dtype="S5")
-    cols7 = np.zeros((nrows, 1), dtype="S20")
-
-    ## when nsamples is high this blows up memory (e.g., dim=(5M x 500))
-    ## so we'll instead create a list of arrays with 10 samples at a time.
-    ## maybe later replace this with a h5 array
-    tmph = os.path.join(data.dirs.outfiles, ".tmp.{}.h5".format(hslice[0]))
-    htmp = h5py.File(tmph, 'w')
-    htmp.create_dataset("vcf", shape=(nrows, sum(sidx)), dtype="S20")
-
-    ## which loci passed all filters
-    init = 0
-
-    ## write loci that passed after trimming edges, then write snp string
-    locindex = np.where(keepmask)[0]
-    for iloc in xrange(aseqs.shape[0]):
-        edg = aedge[iloc]
-        ## grab all seqs between edges
-        if not 'pair' in data.paramsdict["datatype"]:
-            seq = aseqs[iloc, :, edg[0]:edg[1]+1]
-            catg = acatg[iloc, :, edg[0]:edg[1]+1]
-            if not full:
-                snpidx = snpidxs[iloc, edg[0]:edg[1]+1]
-                seq = seq[:, snpidx]
-                catg = catg[:, snpidx]
-        else:
-            seq = np.hstack([aseqs[iloc, :, edg[0]:edg[1]+1],
-                             aseqs[iloc, :, edg[2]:edg[3]+1]])
-            catg = np.hstack([acatg[iloc, :, edg[0]:edg[1]+1],
-                              acatg[iloc, :, edg[2]:edg[3]+1]])
-            if not full:
-                snpidx = np.hstack([snpidxs[iloc, edg[0]:edg[1]+1],
-                                    snpidxs[iloc, edg[2]:edg[3]+1]])
-                seq = seq[:, snpidx]
-                catg = catg[:, snpidx]
-
-        ## empty arrs to fill
-        alleles = np.zeros((nrows, 4), dtype=np.uint8)
-        genos = np.zeros((seq.shape[1], sum(sidx)), dtype="S4")
-        genos[:] = "./.:"
-
-        ## ----  build string array ----
-        pos = 0
-        ## If any < 0 this indicates an anonymous locus in denovo+ref assembly
-        if achrom[iloc][0] > 0:
-            pos = achrom[iloc][1]
-            cols0[init:init+seq.shape[1]] = achrom[iloc][0]
-            cols1[init:init+seq.shape[1]] = pos + np.where(snpidx)[0] + 1
-        else:
-            if full:
-                cols1[init:init+seq.shape[1]] = pos + np.arange(seq.shape[1]) + 1
-            else:
-                cols1[init:init+seq.shape[1]] = pos + np.where(snpidx)[0] + 1
-                cols0[init:init+seq.shape[1]] = (chunk + locindex[iloc] + 1) * -1
-
-        ## fill reference base
-        alleles = reftrick(seq, GETCONS)
-
-        ## get the info string column
-        tmp0 = np.sum(catg, axis=2)
-        tmp1 = tmp0 != 0
-        tmp2 = tmp1.sum(axis=1) > 0
-        nsamp = np.sum(tmp1, axis=0)
-        depth = np.sum(tmp0, axis=0)
-        list7 = [["NS={};DP={}".format(i, j)] for i, j in zip(nsamp, depth)]
-        if list7:
-            cols7[init:init+seq.shape[1]] = list7
-
-        ## default fill cons sites where no variants
-        genos[tmp1.T] = "0/0:"
-
-        ## fill cons genotypes for sites with alt alleles for taxa in order
-        mask = alleles[:, 1] == 46
-        mask += alleles[:, 1] == 45
-
-        obs = alleles[~mask, :]
-        alts = seq[:, ~mask]
-        who = np.where(mask == False)[0]
-        ## fill variable sites
-        for site in xrange(alts.shape[1]):
-            bases = alts[:, site]
-            #LOGGER.info("bases %s", bases)
-            ohere = obs[site][obs[site] != 0]
-            #LOGGER.info("ohere %s", ohere)
-            alls = np.array([DCONS[i] for i in bases], dtype=np.uint32)
-            #LOGGER.info("all %s", alls)
-            for jdx in xrange(ohere.shape[0]):
-                alls[alls == ohere[jdx]] = jdx
-
-            #LOGGER.info("all2 %s", alls)
-            ## fill into array
-            for cidx in xrange(catg.shape[0]):
-                if tmp2[cidx]:
-                    if alls[cidx][0] < 5:
-                        genos[who[site], cidx] = "/".join(alls[cidx].astype("S1").tolist())+":"
-                    else:
-                        genos[who[site], cidx] = "./.:"
-                    #LOGGER.info("genos filled: %s %s %s", who[site], cidx, genos)
-
-        ## build geno+depth strings
-        ## for each taxon enter 4 catg values
-        fulltmp = np.zeros((seq.shape[1], catg.shape[0]), dtype="S20")
-        for cidx in xrange(catg.shape[0]):
-            ## fill catgs from catgs
-            tmp0 = [str(i.sum()) for i in catg[cidx]]
-            tmp1 = [",".join(i) for i in catg[cidx].astype("S4").tolist()]
-            tmp2 = ["".join(i+j+":"+k) for i, j, k in zip(genos[:, cidx], tmp0, tmp1)]
-            ## fill tmp allcidx
-            fulltmp[:, cidx] = tmp2
-
-        ## write to h5 for this locus
-        htmp["vcf"][init:init+seq.shape[1], :] = fulltmp
-
-        cols34[init:init+seq.shape[1], 0] = alleles[:, 0].view("S1")
-        cols34[init:init+seq.shape[1], 1] = [",".join([j for j in i if j]) \
-                                    for i in alleles[:, 1:].view("S1").tolist()]
-
-        ## advance counter
-        init += seq.shape[1]
-
-    ## trim off empty rows if they exist
-    withdat = cols0 != 0
-    tot = withdat.sum()
-
-    ## get scaffold names
-    faidict = {}
-    if (data.paramsdict["assembly_method"] in ["reference", "denovo+reference"]) and \
-       (os.path.exists(data.paramsdict["reference_sequence"])):
-        fai = pd.read_csv(data.paramsdict["reference_sequence"] + ".fai", 
-                names=['scaffold', 'size', 'sumsize', 'a', 'b'],
-                sep="\t")
-        faidict = {i+1:j for i,j in enumerate(fai.scaffold)}
-    try:
-        ## This is hax, but it's the only way it will work. The faidict uses positive numbers
-        ## for reference sequence mapped loci for the CHROM/POS info, and it uses negative
-        ## numbers for anonymous loci. Both are 1 indexed, which is where that last `+ 2` comes from.
-        faidict.update({-i:"locus_{}".format(i-1) for i in xrange(chunk+1, chunk + optim + 2)})
-        chroms = [faidict[i] for i in cols0]
-    except Exception as inst:
-        LOGGER.error("Invalid chromosome dictionary indexwat: {}".format(inst))
-        LOGGER.debug("faidict {}".format([str(k)+"/"+str(v) for k, v in faidict.items() if "locus" in v]))
-        LOGGER.debug("chroms {}".format([x for x in cols0 if x < 0]))
-        raise
-    cols0 = np.array(chroms)
-    #else:
-    #    cols0 = np.array(["locus_{}".format(i) for i in cols0-1])
-
-    ## Only write if there is some data that passed filtering
-    if tot:
-        LOGGER.debug("Writing data to vcf")
-        if not full:
-            writer = open(data.outfiles.vcf+".{}".format(chunk), 'w')
-        else:
-            writer = gzip.open(data.outfiles.vcf+".{}".format(chunk), 'w')
-
+        insite &= asnps
+    lidx, cidx = np.where(insite)
+    nsites = lidx.shape[0]
+    if not nsites:
+        return 0
+
+    ## (sites, samples) bases upper-cased, and (sites, samples, 4) counts
+    seqs = aseqs[lidx, :, cidx]
+    seqs[(seqs >= 97) & (seqs <= 122)] -= 32
+    catg = acatg[lidx, :, cidx]
+    del aseqs, acatg
+
+    ## CHROM and POS, from the reference for mapped loci
+    refmapped = achrom[:, 0] > 0
+    locnames = np.array(["locus_{}".format(chunk + i) for i in locindex], dtype=object)
+    if refmapped.any():
+        scaffolds = fai_names(data)
         try:
-            ## write in iterations b/c it can be freakin huge.
-            ## for cols0 and cols1 the 'newaxis' slice and the transpose
-            ## are for turning the 1d arrays into column vectors.
-            np.savetxt(writer,
-                np.concatenate(
-                   (cols0[:tot][np.newaxis].T,
-                    cols1[:tot][np.newaxis].T,
-                    np.array([["."]]*tot, dtype="S1"),
-                    cols34[:tot, :],
-                    np.array([["13", "PASS"]]*tot, dtype="S4"),
-                    cols7[:tot, :],
-                    np.array([["GT:DP:CATG"]]*tot, dtype="S10"),
-                    htmp["vcf"][:tot, :],
-                    ),
-                    axis=1),
-                delimiter="\t", fmt="%s")
-        except Exception as inst:
-            LOGGER.error("Error building vcf file - ".format(inst))
+            locnames[refmapped] = [scaffolds[i - 1] for i in achrom[refmapped, 0]]
+        except IndexError as inst:
+            LOGGER.error("Invalid chromosome index %s: %s", chunk, inst)
             raise
-        writer.close()
-
-    ## close and remove tmp h5
-    htmp.close()
-    os.remove(tmph)
+    chroms = locnames[lidx]
+    pos = sitepos[lidx, cidx] + np.where(refmapped, achrom[:, 1], 0)[lidx]
+
+    ## REF and ALT, the most common bases with ambiguities split, ties to
+    ## the lowest base. Same as reftrick() for each site.
+    counts = np.zeros((nsites, 4), dtype=np.int64)
+    for bidx, base in enumerate(VCF_BASES):
+        counts[:, bidx] = (seqs == base).sum(axis=1)
+    for amb, base1, base2 in GETCONS:
+        namb = (seqs == amb).sum(axis=1)
+        counts[:, VCF_BASES.index(base1)] += namb
+        counts[:, VCF_BASES.index(base2)] += namb
+
+    ## sites/samples with data, and samples with data anywhere in the locus
+    depth = catg.sum(axis=2)
+    hasdepth = depth > 0
+    _, firsts, inverse = np.unique(lidx, return_index=True, return_inverse=True)
+    locdepth = np.logical_or.reduceat(hasdepth, firsts, axis=0)[inverse]
+
+    ## drop sites where all selected samples are N or -, they have no REF
+    keep = counts.sum(axis=1) > 0
+    if not keep.all():
+        seqs, catg, chroms, pos, counts = \
+            seqs[keep], catg[keep], chroms[keep], pos[keep], counts[keep]
+        depth, hasdepth, locdepth = depth[keep], hasdepth[keep], locdepth[keep]
+        nsites = int(keep.sum())
+        if not nsites:
+            return 0
+
+    order = np.argsort(-counts, axis=1, kind="mergesort")
+    alleles = np.array(VCF_BASES, dtype=np.uint8)[order]
+    alleles[np.sort(-counts, axis=1) == 0] = 0
+    ref = alleles[:, :1].copy().view("S1").ravel()
+    altkeys, altidx = np.unique(alleles[:, 1:].copy().view("S3").ravel(), 
+                                return_inverse=True)
+    alts = np.array([",".join(i) or "." for i in altkeys], dtype=object)[altidx]
+
+    ## genotypes: alleles of the two bases of each call at variable sites, 
+    ## 0/0 at invariant sites with data, ./. for missing and N calls.
+    gtbases = VCF_DIPLOID[seqs]
+    gts = np.zeros(gtbases.shape, dtype=np.uint8) + 4
+    for aidx in xrange(4):
+        allele = alleles[:, aidx, None, None]
+        gts[(gtbases == allele) & (allele > 0)] = aidx
+    gtcode = hasdepth.astype(np.uint8)
+    varcall = (alleles[:, 1] > 0)[:, None] & locdepth
+    called = (gts < 4).all(axis=2)
+    gtcode[varcall] = np.where(called, 1 + (gts[:, :, 0] * 4) + gts[:, :, 1], 0)[varcall]
+    gtstrs = np.array(VCF_GENOTYPES, dtype=object)[gtcode]
+
+    ## write records in blocks of sites, formatting whole rows at once
+    nsamples = seqs.shape[1]
+    rowfmt = "\t".join([VCF_SITE_FORMAT] + [VCF_SAMPLE_FORMAT]*nsamples) + "\n"
+    with open(outfile+".{}".format(chunk), 'w') as out:
+        for block in xrange(0, nsites, VCF_BLOCK):
+            bslice = slice(block, block + VCF_BLOCK)
+            bsites = chroms[bslice].shape[0]
+            cells = np.empty((bsites, nsamples, 6), dtype=object)
+            cells[:, :, 0] = gtstrs[bslice]
+            cells[:, :, 1] = depth[bslice]
+            cells[:, :, 2:] = catg[bslice]
+            rows = np.empty((bsites, 6 + (nsamples * 6)), dtype=object)
+            rows[:, 0] = chroms[bslice]
+            rows[:, 1] = pos[bslice]
+            rows[:, 2] = ref[bslice]
+            rows[:, 3] = alts[bslice]
+            rows[:, 4] = hasdepth[bslice].sum(axis=1)
+            rows[:, 5] = depth[bslice].sum(axis=1)
+            rows[:, 6:] = cells.reshape(bsites, nsamples * 6)
+            out.write("".join([rowfmt % tuple(row) for row in rows.tolist()]))
+    return nsites
+
+
+
+def fai_names(data):
+    """ scaffold names of the reference in the order of its .fai index """
+    faifile = reference_index(data) + ".fai"
+    if not os.path.exists(faifile):
+        raise IPyradError(NO_FAI.format(faifile))
+    with open(faifile, 'r') as infai:
+        return [i.split("\t", 1)[0] for i in infai if i.strip()]
 
 
 
@@ -2522,6 +2355,30 @@ DCONS = {67: [67, 67],
          78: [46, 46],
          45: [46, 46]}
 
+## the VCF engine: bases in REF/ALT order on ties, bases of the diploid
+## calls (N and - are missing), and the genotype of each call code
+VCF_BASES = [65, 67, 71, 84]
+VCF_DIPLOID = np.zeros((256, 2), dtype=np.uint8)
+for _base in [i for i in DCONS if i not in [78, 45]]:
+    VCF_DIPLOID[_base] = DCONS[_base]
+VCF_GENOTYPES = ["./."] + ["{}/{}".format(i, j) for i in range(4) for j in range(4)]
+
+## STRUCTURE codes of the first and second allele of each base
+STR_ALLELES = np.array([["-9"] * 256, ["-9"] * 256], dtype=object)
+for _base in DUCT:
+    for _allele in [0, 1]:
+        STR_ALLELES[_allele, ord(_base)] = \
+            {'A': '0', 'T': '1', 'G': '2', 'C': '3'}.get(DUCT[_base][_allele], '-9')
+
+## blocks held in the queue of each outfile writer
+FANOUT_QUEUE_SIZE = 2
+
+## VCF record columns through FORMAT, and of each sample, and the number
+## of records formatted at a time
+VCF_SITE_FORMAT = "%s\t%d\t.\t%s\t%s\t13\tPASS\tNS=%d;DP=%d\tGT:DP:CATG"
+VCF_SAMPLE_FORMAT = "%s:%d:%d,%d,%d,%d"
+VCF_BLOCK = 10000
+
 # GETCONS = np.array([["C", "C", "C"],
 #                     ["A", "A", "A"],
 #                     ["T", "T", "T"],
@@ -2597,6 +2454,20 @@ NEXCLOSER = """\
 end;
 """
 
+BAD_OUTFILE_SIZE = """\
+    The {} outfile was written with {} columns, expected {}.
+    """
+
+NO_FAI = """\
+    Reference index {} not found. It is written by samtools faidx
+    during step 3, rerun step 3 or index the reference_sequence.
+    """
+
+BAD_ARRAY_SIZES = """\
+    Output arrays of the chunk at locus {} do not match their precomputed
+    sizes (seqs, snps, bis): expected {}, built {}.
+    """
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,417 @@
+#!/usr/bin/env python2.7
+
+"""
+Throughput benchmarks for ipyrad. Simulates a multiplexed RAD dataset of a
+given size (samples x loci x depth x error rate) for one of the datatypes
+rad, ddrad, pairddrad, gbs or 3rad, runs steps 1-7 on it with profiling on,
+then runs the baba and tetrad analysis tools on the results. Reports
+reads/sec, loci/sec and peak memory per step, and can compare a run to a
+stored baseline.
+
+    python -m ipyrad.benchmark -d pairddrad -n 12 -l 2000 --save base.json
+    python -m ipyrad.benchmark -d pairddrad -n 12 -l 2000 --baseline base.json
+"""
+
+from __future__ import print_function
+# pylint: disable=E1101
+# pylint: disable=W0212
+
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import argparse
+import numpy as np
+import ipyrad as ip
+import ipyparallel as ipp
+
+from ipyrad.assemble.util import IPyradError, IPyradWarningExit, comp, detect_cpus
+from ipyrad.assemble.profiler import profile_path
+from ipyrad.core.parallel import start_ipcluster, get_client
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+
+
+def simulate(workdir, datatype="rad", nsamples=12, nloci=1000, depth=20,
+             error=0.001, theta=0.01, readlen=100, seed=123):
+    """
+    Writes simulated raw fastq files (<datatype>_R1_.fastq.gz, and R2 for
+    paired types) and a barcodes file to workdir. Each locus is a random
+    fragment. Each sample has two haplotypes of it that differ from the
+    fragment at a rate of theta, and gets Poisson(depth) reads from them
+    with sequencing errors at a rate of error. Returns a dict with the
+    paths and number of reads written.
+    """
+    if datatype not in SIMTYPES:
+        raise IPyradError(BAD_DATATYPE.format(datatype, sorted(SIMTYPES)))
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    rng = np.random.RandomState(seed)
+    paired = datatype in ["pairddrad", "3rad"]
+    cut1, cut2 = SIMTYPES[datatype]
+
+    ## sample names and barcodes, 3rad has a second barcode on read2
+    snames = ["{}{}".format(SIMPREFIX, idx) for idx in xrange(nsamples)]
+    barcodes = sim_barcodes(rng, nsamples * (2 if datatype == "3rad" else 1))
+    bars1 = barcodes[:nsamples]
+    bars2 = barcodes[nsamples:]
+    barfile = os.path.join(workdir, datatype+"_barcodes.txt")
+    with open(barfile, 'w') as out:
+        for idx, sname in enumerate(snames):
+            if bars2:
+                out.write("{}\t{}\t{}\n".format(sname, bars1[idx], bars2[idx]))
+            else:
+                out.write("{}\t{}\n".format(sname, bars1[idx]))
+
+    ## loci, and two haplotypes of each locus for each sample
+    fraglen = readlen * 3 if paired else readlen
+    loci = rng.randint(0, 4, (nloci, fraglen)).astype(np.uint8)
+    mutated = rng.binomial(1, theta, (nsamples, 2, nloci, fraglen)).astype(np.bool_)
+    shifts = rng.randint(1, 4, mutated.shape).astype(np.uint8)
+    haplos = (loci[np.newaxis, np.newaxis] + mutated * shifts) % 4
+
+    r1file = os.path.join(workdir, datatype+"_R1_.fastq.gz")
+    r2file = os.path.join(workdir, datatype+"_R2_.fastq.gz")
+    out1 = gzip.open(r1file, 'wb')
+    out2 = gzip.open(r2file, 'wb') if paired else None
+    nreads = 0
+    for sidx in xrange(nsamples):
+        reads1 = []
+        reads2 = []
+        for lidx, nsim in enumerate(rng.poisson(depth, nloci)):
+            hidx = rng.randint(0, 2, nsim)
+            seqs = haplos[sidx, hidx, lidx]
+            errs = rng.binomial(1, error, seqs.shape) * rng.randint(1, 4, seqs.shape)
+            seqs = (seqs + errs) % 4
+            for seq in seqs:
+                seq = BASES[seq].tostring()
+                ## gbs cuts at both ends of the fragment, reads go both ways
+                if (datatype == "gbs") and rng.randint(2):
+                    seq = comp(seq)[::-1]
+                name = "@{}_{}_{} 1:N:0:\n".format(snames[sidx], lidx, nreads)
+                read1 = bars1[sidx] + cut1 + seq
+                read1 = read1[:readlen]
+                reads1.append("{}{}\n+\n{}\n".format(name, read1, "I"*len(read1)))
+                if paired:
+                    read2 = (bars2[sidx] if bars2 else "") + cut2 + comp(seq)[::-1]
+                    read2 = read2[:readlen]
+                    reads2.append("{}{}\n+\n{}\n".format(
+                        name.replace(" 1:", " 2:"), read2, "I"*len(read2)))
+                nreads += 1
+        out1.write("".join(reads1))
+        if paired:
+            out2.write("".join(reads2))
+    out1.close()
+    if paired:
+        out2.close()
+
+    return {
+        "raw_fastq_path": os.path.join(workdir, datatype+"_R*_.fastq.gz"),
+        "barcodes_path": barfile,
+        "restriction_overhang": (cut1, cut2),
+        "nreads": nreads,
+        "snames": snames,
+        }
+
+
+
+def sim_barcodes(rng, nbars, length=8):
+    """ random barcodes that differ from each other at >= 2 sites """
+    barcodes = []
+    while len(barcodes) < nbars:
+        new = BASES[rng.randint(0, 4, length)].tostring()
+        if all(sum(i != j for i, j in zip(new, bar)) > 1 for bar in barcodes):
+            barcodes.append(new)
+    return barcodes
+
+
+
+def run_benchmark(ipyclient, workdir, datatype="rad", nsamples=12, nloci=1000,
+                  depth=20, error=0.001, seed=123, analysis=True):
+    """
+    Simulates a dataset in workdir, assembles it with steps 1-7 with
+    profiling on, and runs the analysis tools. Returns a dict of results
+    that can be saved as a baseline and passed to compare(). The results
+    of an earlier benchmark in workdir are removed, but any other existing
+    non-empty workdir is refused.
+    """
+    clean_workdir(workdir)
+    sim = simulate(os.path.join(workdir, "raw"), datatype, nsamples, nloci,
+                   depth, error, seed=seed)
+
+    ## assemble it
+    data = ip.Assembly("bench", quiet=True)
+    data.set_params("project_dir", os.path.join(workdir, "assembly"))
+    data.set_params("raw_fastq_path", sim["raw_fastq_path"])
+    data.set_params("barcodes_path", sim["barcodes_path"])
+    data.set_params("datatype", datatype)
+    data.set_params("restriction_overhang", sim["restriction_overhang"])
+    data.set_params("min_samples_locus", min(4, nsamples))
+    data.run("1234567", ipyclient=ipyclient, profile=True)
+
+    ## collect throughput of each step from its profile
+    results = {
+        "version": ip.__version__,
+        "config": {"datatype": datatype, "nsamples": nsamples, "nloci": nloci,
+                   "depth": depth, "error": error, "seed": seed,
+                   "nreads": sim["nreads"]},
+        "steps": {},
+        "analysis": {},
+        }
+    for step in "1234567":
+        try:
+            with open(profile_path(data, step)+".json") as infile:
+                records = json.load(infile)["records"]
+        except IOError:
+            raise IPyradWarningExit(NO_PROFILE.format(step, workdir))
+        wall = [i["wall"] for i in records if i["level"] == "step"][0]
+        results["steps"][step] = {
+            "wall": wall,
+            "cpu": sum(i["cpu"] for i in records if i["level"] in ["step", "engine"]),
+            "peak_rss": max(i["peak_rss"] for i in records),
+            "reads_per_sec": sim["nreads"] / wall,
+            "loci_per_sec": nloci / wall,
+            }
+
+    ## run the analysis tools on the outputs
+    if analysis:
+        results["analysis"] = run_analysis(data, ipyclient, workdir, nloci)
+    return results
+
+
+
+def clean_workdir(workdir):
+    """
+    removes an earlier benchmark workdir (one with a BENCH_MARKER file) and
+    makes a new empty one with the marker. Raises if workdir is a file or a
+    non-empty directory that was not made by the benchmark.
+    """
+    if os.path.exists(workdir):
+        if not os.path.isdir(workdir):
+            raise IPyradWarningExit(NOT_BENCH_DIR.format(workdir))
+        if os.listdir(workdir):
+            if not os.path.exists(os.path.join(workdir, BENCH_MARKER)):
+                raise IPyradWarningExit(NOT_BENCH_DIR.format(workdir))
+            shutil.rmtree(workdir)
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    open(os.path.join(workdir, BENCH_MARKER), 'w').close()
+
+
+
+def run_analysis(data, ipyclient, workdir, nloci):
+    """ times the analysis tools on the assembled data """
+    results = {}
+    ## the analysis tools exit if an optional dependency is missing
+    try:
+        import ipyrad.analysis as ipa
+    except (ImportError, IPyradError, IPyradWarningExit) as inst:
+        LOGGER.warn("skipping analysis benchmarks: %s", inst)
+        return results
+
+    snames = sorted(data.samples)[:4]
+    tools = [
+        ("baba", lambda: ipa.baba(
+            data=data.outfiles.loci,
+            tests={"p1": [snames[0]], "p2": [snames[1]],
+                   "p3": [snames[2]], "p4": [snames[3]]},
+            nboots=100).run(ipyclient)),
+        ## ipa.tetrad is the Tetrad of tetrad2, whose run() takes quiet
+        ("tetrad", lambda: ipa.tetrad(
+            name="bench",
+            data=data.outfiles.snpsphy,
+            mapfile=data.outfiles.snpsmap,
+            workdir=os.path.join(workdir, "analysis-tetrad"),
+            quiet=True).run(force=True, quiet=True, ipyclient=ipyclient)),
+        ]
+    for name, tool in tools:
+        start = time.time()
+        try:
+            tool()
+        ## a bad call to a tool is a bug here, not a failed benchmark
+        except TypeError:
+            raise
+        except Exception as inst:
+            LOGGER.warn("analysis benchmark %s failed: %s", name, inst)
+            results[name] = {"error": str(inst)}
+            continue
+        wall = time.time() - start
+        results[name] = {"wall": wall, "loci_per_sec": nloci / wall}
+    return results
+
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Returns a list of regressions of results against a baseline: steps or
+    tools whose reads/sec or loci/sec dropped, or whose peak memory grew,
+    by more than tolerance (a fraction).
+    """
+    if results["config"] != baseline["config"]:
+        LOGGER.warn("benchmark configs differ: %s %s",
+                    results["config"], baseline["config"])
+
+    regressions = []
+    for group in ["steps", "analysis"]:
+        for key in sorted(baseline.get(group, {})):
+            base = baseline[group][key]
+            new = results.get(group, {}).get(key)
+            if not new or ("error" in new) or ("error" in base):
+                continue
+            for stat in ["reads_per_sec", "loci_per_sec"]:
+                if stat in base and new[stat] < base[stat] * (1 - tolerance):
+                    regressions.append(REGRESSION.format(
+                        group, key, stat, base[stat], new[stat]))
+            if "peak_rss" in base and \
+                new["peak_rss"] > base["peak_rss"] * (1 + tolerance):
+                regressions.append(REGRESSION.format(
+                    group, key, "peak_rss", base["peak_rss"], new["peak_rss"]))
+    return regressions
+
+
+
+def report(results, baseline=None):
+    """ returns a table of results, with the baseline values if given """
+    lines = [REPORT_HEADER]
+    for step in sorted(results["steps"]):
+        stats = results["steps"][step]
+        lines.append("  step {:<8} {:>10.1f} {:>12.0f} {:>12.1f} {:>10.0f}".format(
+            step, stats["wall"], stats["reads_per_sec"], stats["loci_per_sec"],
+            stats["peak_rss"] / 1e6))
+        if baseline and step in baseline["steps"]:
+            stats = baseline["steps"][step]
+            lines.append("    baseline    {:>10.1f} {:>12.0f} {:>12.1f} {:>10.0f}".format(
+                stats["wall"], stats["reads_per_sec"], stats["loci_per_sec"],
+                stats["peak_rss"] / 1e6))
+    for name in sorted(results["analysis"]):
+        stats = results["analysis"][name]
+        if "error" in stats:
+            lines.append("  {:<13} error: {}".format(name, stats["error"]))
+        else:
+            lines.append("  {:<13} {:>10.1f} {:>12} {:>12.1f}".format(
+                name, stats["wall"], "", stats["loci_per_sec"]))
+    return "\n".join(lines)
+
+
+
+def parse_command_line():
+    """ parse CLI args """
+    parser = argparse.ArgumentParser(
+        description="Benchmark ipyrad steps 1-7 on simulated data")
+    parser.add_argument("-d", dest="datatype", default="rad",
+        choices=sorted(SIMTYPES), help="datatype to simulate (Default=rad)")
+    parser.add_argument("-n", dest="nsamples", type=int, default=12,
+        help="number of samples (Default=12)")
+    parser.add_argument("-l", dest="nloci", type=int, default=1000,
+        help="number of loci (Default=1000)")
+    parser.add_argument("-x", dest="depth", type=float, default=20,
+        help="mean read depth per locus per sample (Default=20)")
+    parser.add_argument("-e", dest="error", type=float, default=0.001,
+        help="sequencing error rate (Default=0.001)")
+    parser.add_argument("--seed", type=int, default=123,
+        help="random seed of the simulation (Default=123)")
+    parser.add_argument("-w", dest="workdir", default="./ipyrad-benchmark",
+        help="directory for the simulated data and assembly")
+    parser.add_argument("-c", dest="cores", type=int, default=0,
+        help="number of CPU cores to use (Default=0=All)")
+    parser.add_argument("--ipcluster", metavar="ipcluster", type=str,
+        help="connect to a running ipcluster profile")
+    parser.add_argument("--no-analysis", dest="analysis", action="store_false",
+        help="skip the analysis tools")
+    parser.add_argument("--save", help="save results as a baseline json")
+    parser.add_argument("--baseline", help="compare results to a baseline json")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+        help="fraction of change reported as a regression (Default=0.2)")
+    return parser.parse_args()
+
+
+
+def main():
+    """ run a benchmark from the command line """
+    args = parse_command_line()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+
+    ## connect to or start an ipcluster
+    if args.ipcluster:
+        ipyclient = ipp.Client(profile=args.ipcluster)
+        cluster_id = None
+    else:
+        tmp = ip.Assembly("bench", quiet=True)
+        tmp._ipcluster["cores"] = args.cores if args.cores else detect_cpus()
+        tmp._ipcluster["cluster_id"] = "ipyrad-bench-"+str(os.getpid())
+        start_ipcluster(tmp)
+        ipyclient = get_client(spacer="  ", **tmp._ipcluster)
+        cluster_id = tmp._ipcluster["cluster_id"]
+
+    try:
+        results = run_benchmark(ipyclient, os.path.realpath(args.workdir),
+                                args.datatype, args.nsamples, args.nloci,
+                                args.depth, args.error, args.seed, args.analysis)
+    finally:
+        if cluster_id:
+            ipyclient.shutdown(hub=True, block=False)
+            ipyclient.close()
+
+    print(report(results, baseline))
+    if args.save:
+        with open(args.save, 'w') as out:
+            json.dump(results, out, indent=1, sort_keys=True)
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(regression)
+        if regressions:
+            sys.exit(1)
+        print("\n  no regressions against {}".format(args.baseline))
+
+
+
+### GLOBALS
+
+BASES = np.array(list("ACGT"))
+
+SIMPREFIX = "sim"
+
+## cut site overhangs at the start of read1 and read2 for each datatype
+SIMTYPES = {
+    "rad": ("TGCAG", ""),
+    "ddrad": ("TGCAG", "CGG"),
+    "pairddrad": ("TGCAG", "CGG"),
+    "gbs": ("TGCAG", ""),
+    "3rad": ("TGCAG", "CGG"),
+    }
+
+## file that marks a workdir as made by the benchmark
+BENCH_MARKER = ".ipyrad-benchmark"
+
+BAD_DATATYPE = """\
+    Cannot simulate datatype {}. Choose one of {}.
+    """
+
+NO_PROFILE = """\
+    No profile was written for step {}. The assembly in {} may have failed,
+    see ./ipyrad_log.txt.
+    """
+
+NOT_BENCH_DIR = """\
+    The workdir {}
+    exists and was not made by the benchmark, which removes its workdir
+    before each run. Choose a new or empty directory (-w).
+    """
+
+REGRESSION = "  regression: {} {} {} baseline={:.1f} new={:.1f}"
+
+REPORT_HEADER = "\n              {:>10} {:>12} {:>12} {:>10}".format(
+    "wall(s)", "reads/sec", "loci/sec", "peak(MB)")
+
+
+
+if __name__ == "__main__":
+    main()
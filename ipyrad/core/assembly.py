@@ -32,6 +32,7 @@ import ipyparallel as ipp
 from collections import OrderedDict
 from ipyrad.assemble.util import *
 from ipyrad.assemble.refmap import index_reference_sequence
+from ipyrad.assemble.profiler import StepProfile, start_profile
 from ipyrad.core.paramsinfo import paraminfo, paramname
 from ipyrad.core.sample import Sample
 from ipyrad import assemble
@@ -138,6 +139,9 @@ class Assembly(object):
         ## used to set checkpoints within step 6
         self._checkpoint = 0
 
+        ## profiling settings, only set while run(profile=True) is running
+        self._profile = None
+
         ## statsfiles is a dict with file locations
         ## stats_dfs is a dict with pandas dataframes
         self.stats_files = ObjDict({})
@@ -223,7 +227,16 @@ class Assembly(object):
                         ("aligner", "bwa"),
                         ("min_SE_refmap_overlap", 10),
                         ("refmap_merge_PE", True),
-                        ("bwa_args", "")
+                        ("bwa_args", ""),
+                        ("demultiplex_engine", "barmatch"),
+                        ("demultiplex_writers", 0),
+                        ("write_clust_text", True),
+                        ("build_clusters_memory", "1G"),
+                        ("database_chunk_loci", 0),
+                        ("database_compression", "gzip"),
+                        ("vcf_bgzip", False),
+                        ("refmap_sort_memory", "768M"),
+                        ("reference_index_dir", ""),
         ])
 
     def __str__(self):
@@ -556,10 +569,10 @@ class Assembly(object):
 
     def _link_barcodes(self):
         """
-        Private function. Links Sample barcodes in a dictionary as
+        Private function. Links Sample barcodes in an ordered dictionary as
         [Assembly].barcodes, with barcodes parsed from the 'barcodes_path'
-        parameter. This function is called during set_params() when setting
-        the barcodes_path.
+        parameter in the order of the file. This function is called during
+        set_params() when setting the barcodes_path.
         """
 
         ## parse barcodefile
@@ -597,14 +610,14 @@ class Assembly(object):
             if "3rad" in self.paramsdict["datatype"]:
                 try:
                     bdf[2] = bdf[2].str.upper()
-                    self.barcodes = dict(zip(bdf[0], bdf[1] + "+" + bdf[2]))
+                    self.barcodes = OrderedDict(zip(bdf[0], bdf[1] + "+" + bdf[2]))
                 except KeyError as inst:
                     msg = "    3rad assumes multiplexed barcodes. Doublecheck your barcodes file."
                     LOGGER.error(msg)
                     raise IPyradError(msg)
             else:
                 ## set attribute on Assembly object
-                self.barcodes = dict(zip(bdf[0], bdf[1]))
+                self.barcodes = OrderedDict(zip(bdf[0], bdf[1]))
 
         except (IOError, IndexError):
             raise IPyradWarningExit(\
@@ -1042,6 +1055,7 @@ class Assembly(object):
                 ## error check
                 if not async.successful():
                     raise IPyradWarningExit(async.result())
+                self.dirs.refindex = async.get()
 
         ## Get sample objects from list of strings
         samples = _get_samples(self, samples)
@@ -1238,13 +1252,14 @@ class Assembly(object):
 
 
     def run(self, steps=0, force=False, preview=False, ipyclient=None, 
-        show_cluster=0, **kwargs):
+        show_cluster=0, profile=False, **kwargs):
         """
         Run assembly steps of an ipyrad analysis. Enter steps as a string,
         e.g., "1", "123", "12345". This step checks for an existing
         ipcluster instance otherwise it raises an exception. The ipyparallel
         connection is made using information from the _ipcluster dict of the
-        Assembly class object.
+        Assembly class object. If profile=True the time, memory and I/O of 
+        each step is written to s<N>_profile.json/.csv files.
         """
         ## check that mindepth params are compatible, fix and report warning.
         self._compatible_params_check()
@@ -1287,42 +1302,53 @@ class Assembly(object):
                     self._ipcluster["pids"][eid] = pid
             #ipyclient[:].apply(os.getpid).get_dict()
 
+            ## turn on profiling of steps and their jobs
+            if profile:
+                start_profile(self)
+
             ## has many fixed arguments right now, but we may add these to
             ## hackerz_only, or they may be accessed in the API.
             if '1' in steps:
-                self._step1func(force, preview, ipyclient)
+                with StepProfile(self, 1, ipyclient):
+                    self._step1func(force, preview, ipyclient)
                 self.save()
                 ipyclient.purge_everything()
 
             if '2' in steps:
-                self._step2func(samples=None, force=force, ipyclient=ipyclient)
+                with StepProfile(self, 2, ipyclient):
+                    self._step2func(samples=None, force=force, ipyclient=ipyclient)
                 self.save()
                 ipyclient.purge_everything()
 
             if '3' in steps:
-                self._step3func(samples=None, noreverse=0, force=force,
+                with StepProfile(self, 3, ipyclient):
+                    self._step3func(samples=None, noreverse=0, force=force,
                              maxindels=8, preview=preview, ipyclient=ipyclient)
                 self.save()
                 ipyclient.purge_everything()
 
             if '4' in steps:
-                self._step4func(samples=None, force=force, ipyclient=ipyclient)
+                with StepProfile(self, 4, ipyclient):
+                    self._step4func(samples=None, force=force, ipyclient=ipyclient)
                 self.save()
                 ipyclient.purge_everything()
 
             if '5' in steps:
-                self._step5func(samples=None, force=force, ipyclient=ipyclient)
+                with StepProfile(self, 5, ipyclient):
+                    self._step5func(samples=None, force=force, ipyclient=ipyclient)
                 self.save()
                 ipyclient.purge_everything()
 
             if '6' in steps:
-                self._step6func(samples=None, noreverse=0, randomseed=12345,
+                with StepProfile(self, 6, ipyclient):
+                    self._step6func(samples=None, noreverse=0, randomseed=12345,
                                 force=force, ipyclient=ipyclient, **kwargs)
                 self.save()
                 ipyclient.purge_everything()
 
             if '7' in steps:
-                self._step7func(samples=None, force=force, ipyclient=ipyclient)
+                with StepProfile(self, 7, ipyclient):
+                    self._step7func(samples=None, force=force, ipyclient=ipyclient)
                 self.save()
                 ipyclient.purge_everything()
 
@@ -1347,6 +1373,9 @@ class Assembly(object):
         ## close client when done or interrupted
         finally:
             try:
+                ## profiling is only on for this run
+                self._profile = None
+
                 ## save the Assembly
                 self.save()
 
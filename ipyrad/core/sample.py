@@ -74,6 +74,8 @@ class Sample(object):
                                      "sd_depth_mj",
                                      "sd_depth_stat",
                                      "filtered_bad_align",
+                                     "aligns_bypassed",
+                                     "refseq_reads_per_sec",
                                      ]).astype(np.object),
 
               "s4": pd.Series(index=["hetero_est",
@@ -262,8 +262,11 @@ def load_json(path, quiet=False, cli=False):
                    d=lostkeys,
                    e=null._version))
 
-    ## load in remaining shared Assembly attributes to null
+    ## load in remaining shared Assembly attributes to null. Barcodes that
+    ## set_params relinked from the barcodes file keep the order of the file.
     for key in sharedkeys:
+        if key == "barcodes" and null.barcodes:
+            continue
         null.__setattr__(key, fullj["assembly"][key])
 
     ## load in svd results if they exist